@@ -68,6 +68,23 @@ if BOT_VARIABLES_LOADED.lower() == 'false':
 DEBUG = os.getenv('DEBUG', 'false')
 
 TG_TOKEN = os.getenv('TG_BOT_TOKEN', '')
+# Bot API server, e.g. a local fake one for load tests
+TG_API_URL = os.getenv('TG_BOT_API_URL', '')
+# Outbound messages, Telegram flood limits
+SEND_GLOBAL_RATE = float(os.getenv('TG_BOT_SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('TG_BOT_SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.getenv('TG_BOT_SEND_CHAT_BURST', '3'))
+SEND_MAX_RETRIES = int(os.getenv('TG_BOT_SEND_MAX_RETRIES', '3'))
+# Webhook server
+WEBHOOK_URL = os.getenv('TG_BOT_WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('TG_BOT_WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('TG_BOT_WEBHOOK_SECRET') or None
+WEBHOOK_HOST = os.getenv('TG_BOT_WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('TG_BOT_WEBHOOK_PORT', '8080'))
+# several workers need redis FSM storage
+WEBHOOK_WORKERS = int(os.getenv('TG_BOT_WEBHOOK_WORKERS', '1'))
+WEBHOOK_CONCURRENCY = int(os.getenv('TG_BOT_WEBHOOK_CONCURRENCY', '50'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('TG_BOT_WEBHOOK_QUEUE_SIZE', '1000'))
 # Read RabbitMQ settings and credentials from environment
 MESSAGE_BROKER_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
 MESSAGE_BROKER_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
@@ -77,12 +94,34 @@ MESSAGE_BROKER_EXCHANGE = os.getenv('TG_BOT_RABBITMQ_EXCHANGE', '')
 MESSAGE_BROKER_QUEUE = os.getenv('TG_BOT_RABBITMQ_QUEUE', '')
 MESSAGE_BROKER_USERNAME = os.getenv('TG_BOT_RABBITMQ_USERNAME', '')
 MESSAGE_BROKER_PASSWORD = os.getenv('TG_BOT_RABBITMQ_PASSWORD', '')
+# commands from other services handled at once, commands of a chat are handled in order
+MESSAGE_BROKER_CONCURRENCY = int(os.getenv('TG_BOT_RABBITMQ_CONCURRENCY', '50'))
+# unacked messages delivered to the bot, commands waiting for an earlier one of their chat count too
+MESSAGE_BROKER_PREFETCH = int(os.getenv('TG_BOT_RABBITMQ_PREFETCH', str(2 * MESSAGE_BROKER_CONCURRENCY)))
+# times recipients a batch command failed for are sent a smaller batch again
+BATCH_MAX_RETRIES = int(os.getenv('TG_BOT_BATCH_MAX_RETRIES', '2'))
+# seconds to wait for datemaker replies, Telegram expects callback answers within 15 seconds
+RPC_TIMEOUT = float(os.getenv('TG_BOT_RPC_TIMEOUT', '10'))
 # Read Postgres credentials from environment
 POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
 POSTGRES_PORT = int(os.getenv('POSTGRES_PORT', '5432'))
 POSTGRES_DB = os.getenv('POSTGRES_DB', '')
 POSTGRES_USER = os.getenv('TG_BOT_POSTGRES_USER', '')
 POSTGRES_PASSWORD = os.getenv('TG_BOT_POSTGRES_PASSWORD', '')
+# in-memory cache of users and events read by menus
+POSTGRES_CACHE_USERS_TTL = float(os.getenv('TG_BOT_POSTGRES_CACHE_USERS_TTL', '60'))
+POSTGRES_CACHE_EVENTS_TTL = float(os.getenv('TG_BOT_POSTGRES_CACHE_EVENTS_TTL', '30'))
+POSTGRES_CACHE_SIZE = int(os.getenv('TG_BOT_POSTGRES_CACHE_SIZE', '10000'))
+# FSM storage: memory for a single local bot, redis to share state between replicas
+FSM_STORAGE = os.getenv('TG_BOT_FSM_STORAGE', 'memory')
+FSM_TTL = int(os.getenv('TG_BOT_FSM_TTL', str(7 * 24 * 3600)))
+# seconds an update of a chat holds the redis lock of the chat, it expires if the worker dies
+FSM_LOCK_TIMEOUT = float(os.getenv('TG_BOT_FSM_LOCK_TIMEOUT', '60'))
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('TG_BOT_REDIS_DB', '0'))
+REDIS_USERNAME = os.getenv('TG_BOT_REDIS_USERNAME') or None
+REDIS_PASSWORD = os.getenv('TG_BOT_REDIS_PASSWORD') or None
 # Read AWS credentials from environment variables
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID', '')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY', '')
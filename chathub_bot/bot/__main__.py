@@ -4,8 +4,9 @@ main file for calling module
 import argparse
 import asyncio
 
-from bot import TG_TOKEN
+from bot import TG_TOKEN, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_WORKERS
 from .bot import DatingBot
+from .webhook import run_webhook_workers
 
 if __name__ == "__main__":
     """
@@ -20,11 +21,23 @@ if __name__ == "__main__":
         action='store_true',
         help='To properly run while developing'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=WEBHOOK_WORKERS,
+        help='Webhook server processes'
+    )
 
     args = parser.parse_args()
 
-    dating_bot = DatingBot(tg_token=TG_TOKEN, debug=getattr(args, 'debug', False))
     if getattr(args, 'long_polling', False):
+        dating_bot = DatingBot(tg_token=TG_TOKEN, debug=getattr(args, 'debug', False))
         asyncio.run(dating_bot.start_long_polling())
     else:
-        asyncio.run(dating_bot.start_webhook())
+        run_webhook_workers(
+            args.workers,
+            tg_token=TG_TOKEN,
+            webhook_url=WEBHOOK_URL,
+            debug=getattr(args, 'debug', False),
+            secret_token=WEBHOOK_SECRET,
+        )
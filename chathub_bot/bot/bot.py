@@ -1,43 +1,84 @@
 import asyncio
 import json
 import logging
+import signal
+from functools import partial
+from typing import Optional
 
 import aio_pika
 from aiogram import Bot
 from aiogram import Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.fsm.scene import SceneRegistry
+from aiogram.fsm.storage.base import DefaultKeyBuilder
 from aiogram.fsm.storage.memory import SimpleEventIsolation, MemoryStorage
+from aiogram.fsm.storage.redis import RedisEventIsolation, RedisStorage
 from aiogram.fsm.strategy import FSMStrategy
+from aiogram.methods import TelegramMethod
 from aiogram.utils.i18n import I18n, SimpleI18nMiddleware
+from aiohttp import web
 
 from bot import (
     MESSAGE_BROKER_HOST, MESSAGE_BROKER_PORT,
     MESSAGE_BROKER_VIRTUAL_HOST, MESSAGE_BROKER_EXCHANGE, MESSAGE_BROKER_QUEUE,
-    MESSAGE_BROKER_USERNAME, MESSAGE_BROKER_PASSWORD,
+    MESSAGE_BROKER_USERNAME, MESSAGE_BROKER_PASSWORD, RPC_TIMEOUT,
+    MESSAGE_BROKER_CONCURRENCY, MESSAGE_BROKER_PREFETCH,
     POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD,
-    AWS_SECRET_ACCESS_KEY, AWS_ACCESS_KEY_ID, AWS_BUCKET, setup_logger
+    POSTGRES_CACHE_USERS_TTL, POSTGRES_CACHE_EVENTS_TTL, POSTGRES_CACHE_SIZE,
+    AWS_SECRET_ACCESS_KEY, AWS_ACCESS_KEY_ID, AWS_BUCKET, setup_logger,
+    FSM_STORAGE, FSM_TTL, FSM_LOCK_TIMEOUT, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_USERNAME, REDIS_PASSWORD,
+    TG_API_URL, SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_CONCURRENCY, WEBHOOK_QUEUE_SIZE,
 )
-from bot.commands_handler import UnknownBotCommandError, BotCommandsHandlerMixin
+from bot.commands_handler import BotCommandsHandlerMixin
 from bot.data_handler import DataHandlerMixin
+from bot.metrics import ConsumerMetrics
 from bot.middlewares import CallbackI18nMiddleware
 from bot.scenes import scenes_router, RegistrationScene, ProfileEditingScene
 from bot.scenes.dating import DatingScene
+from bot.send_scheduler import SendScheduler, current_send_priority
 from bot.tmp_files_manager import TempFileManager
+from bot.webhook import create_app
 from chathub_connectors.aws_connectors import S3Client
-from chathub_connectors.postgres_connector import AsyncPgConnector
-from chathub_connectors.rabbitmq_connector import AIORabbitMQConnector
+from chathub_connectors.envelope import (
+    BATCH_SIZE_HEADER, COMMAND_HEADER, Envelope, EnvelopeError, UnknownCommandError,
+)
+from chathub_connectors.postgres_cache import CachedPgConnector
+from chathub_connectors.rabbitmq_connector import AIORabbitMQConnector, OrderedConcurrentProcessor
+from chathub_connectors.redis_connector import RedisConnector
 
 LOGGER = setup_logger(__name__)
 
+# methods counted by Telegram flood limits
+RATE_LIMITED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendMediaGroup', 'sendDocument', 'sendVideo', 'sendAnimation',
+    'sendAudio', 'sendVoice', 'sendVideoNote', 'sendSticker', 'sendLocation', 'sendVenue',
+    'sendContact', 'sendPoll', 'sendDice', 'copyMessage', 'copyMessages', 'forwardMessage',
+    'forwardMessages',
+}
+
+
+def command_order_key(message: aio_pika.abc.AbstractIncomingMessage):
+    """
+    Commands of a chat are handled one after another. Batches have no chat,
+    batches of the same command of an event are handled one after another.
+    """
+    headers = message.headers or {}
+    if BATCH_SIZE_HEADER in headers:
+        return 'batch', headers.get('event_id'), headers.get(COMMAND_HEADER)
+    return headers.get('chat_id')
+
 
 class CustomBot(Bot):
     # to be able to use these connectors while handling events
     pg = None
     rmq = None
+    redis = None
     s3 = None
     tfm = None
+    send_scheduler = None
 
     # stats
     sent_messages = 0
@@ -47,23 +88,52 @@ class CustomBot(Bot):
         self,
         token: str,
         default: DefaultBotProperties,
+        send_global_rate: float = SEND_GLOBAL_RATE,
     ):
         super().__init__(
             token=token,
-            default=default
+            default=default,
+            session=AiohttpSession(api=TelegramAPIServer.from_base(TG_API_URL)) if TG_API_URL else None,
+        )
+        self.send_scheduler = SendScheduler(
+            global_rate=send_global_rate,
+            chat_rate=SEND_CHAT_RATE,
+            chat_burst=SEND_CHAT_BURST,
+            max_retries=SEND_MAX_RETRIES,
+        )
+
+    async def __call__(self, method: TelegramMethod, request_timeout: Optional[int] = None):
+        # messages go through the scheduler to keep within Telegram flood limits
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or method.__api_method__ not in RATE_LIMITED_METHODS \
+                or not self.send_scheduler.running:
+            return await super().__call__(method, request_timeout)
+        return await self.send_scheduler.send(
+            str(chat_id),
+            partial(Bot.__call__, self, method, request_timeout),
+            current_send_priority.get(),
         )
 
 
 class DatingBot(DataHandlerMixin, BotCommandsHandlerMixin, CustomBot):
-    def __init__(self, tg_token: str, default: DefaultBotProperties = None, debug: bool = False):
-        CustomBot.__init__(self, token=tg_token, default=default)
+    def __init__(
+            self,
+            tg_token: str,
+            default: DefaultBotProperties = None,
+            debug: bool = False,
+            send_global_rate: float = SEND_GLOBAL_RATE,
+    ):
+        CustomBot.__init__(self, token=tg_token, default=default, send_global_rate=send_global_rate)
 
-        self.pg = AsyncPgConnector(
+        self.pg = CachedPgConnector(
             host=POSTGRES_HOST,
             port=POSTGRES_PORT,
             db=POSTGRES_DB,
             username=POSTGRES_USER,
             password=POSTGRES_PASSWORD,
+            users_ttl=POSTGRES_CACHE_USERS_TTL,
+            events_ttl=POSTGRES_CACHE_EVENTS_TTL,
+            max_size=POSTGRES_CACHE_SIZE,
         )
 
         self.rmq = AIORabbitMQConnector(
@@ -74,6 +144,17 @@ class DatingBot(DataHandlerMixin, BotCommandsHandlerMixin, CustomBot):
             username=MESSAGE_BROKER_USERNAME,
             password=MESSAGE_BROKER_PASSWORD,
             caller_service='tg-bot',
+            rpc_timeout=RPC_TIMEOUT,
+        )
+        self.datemaker_calls = set()
+
+        # commands are handled concurrently, the ones of a chat one after another
+        self.rmq_metrics = ConsumerMetrics()
+        self.rmq_processor = OrderedConcurrentProcessor(
+            self.process_rmq_message,
+            key=command_order_key,
+            concurrency=MESSAGE_BROKER_CONCURRENCY,
+            observe=self.rmq_metrics.observe,
         )
 
         self.s3 = S3Client(
@@ -84,10 +165,35 @@ class DatingBot(DataHandlerMixin, BotCommandsHandlerMixin, CustomBot):
 
         self.tfm = TempFileManager()
 
+        if FSM_STORAGE == 'redis':
+            # scene state survives restarts and is shared by bot replicas
+            self.redis = RedisConnector(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                db=REDIS_DB,
+                username=REDIS_USERNAME,
+                password=REDIS_PASSWORD,
+            )
+            key_builder = DefaultKeyBuilder(prefix='chathub_fsm', with_bot_id=True, with_destiny=True)
+            storage = RedisStorage(
+                self.redis.async_client,
+                key_builder=key_builder,
+                state_ttl=FSM_TTL,
+                data_ttl=FSM_TTL,
+            )
+            events_isolation = RedisEventIsolation(
+                self.redis.async_client,
+                key_builder=key_builder,
+                lock_kwargs={'timeout': FSM_LOCK_TIMEOUT},
+            )
+        else:
+            storage = MemoryStorage()
+            events_isolation = SimpleEventIsolation()
+
         self._dp = Dispatcher(
             # needed for fast user responses
-            events_isolation=SimpleEventIsolation(),
-            storage=MemoryStorage(),  # replace for Redis storage
+            events_isolation=events_isolation,
+            storage=storage,
             fsm_strategy=FSMStrategy.USER_IN_CHAT,  # choose a correct strategy
         )
 
@@ -117,26 +223,15 @@ class DatingBot(DataHandlerMixin, BotCommandsHandlerMixin, CustomBot):
 
     async def process_rmq_message(self, message: aio_pika.abc.AbstractIncomingMessage):
         async with message.process(ignore_processed=True):
-            chat_id = message.properties.headers["chat_id"]
+            # replies to the bot requests come to the reply queue of AIORabbitMQConnector.call
             can_ack = False
             try:
-                message_id = message.properties.headers["message_id"]
-                key = f'{chat_id}_{message_id}'
-                can_ack = await self.waiting[key](
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    data=json.loads(message.body)
-                )
-            except KeyError:
-                LOGGER.debug(f'Trying to process command {message.body[:100]} for user {chat_id}...')
-                can_ack = await self.process_commands(
-                    message.body.decode('utf-8'),
-                    message.headers,
-                    chat_id
-                )
-            except UnknownBotCommandError as e:
+                envelope = Envelope.from_message(message.body, message.headers)
+                LOGGER.debug(f'Trying to process {envelope}...')
+                can_ack = await self.process_commands(envelope, message)
+            except UnknownCommandError as e:
                 LOGGER.warning(e)
-            except json.decoder.JSONDecodeError:
+            except (EnvelopeError, json.decoder.JSONDecodeError):
                 LOGGER.error(
                     f'Got badly structured response from message broker: {message.body[:30]}'
                 )
@@ -144,20 +239,86 @@ class DatingBot(DataHandlerMixin, BotCommandsHandlerMixin, CustomBot):
             if can_ack:
                 await message.ack()
 
+    async def _listen_commands(self):
+        await self.rmq.listen_queue(
+            queue_name=MESSAGE_BROKER_QUEUE,
+            callback=self.rmq_processor,
+            prefetch_count=MESSAGE_BROKER_PREFETCH,
+        )
+
+    async def _finish_commands(self, timeout: float = 10):
+        # no new commands are delivered while the handled ones are drained,
+        # unacked commands are redelivered to another replica anyway
+        await self.rmq.stop_listening(MESSAGE_BROKER_QUEUE)
+        try:
+            await asyncio.wait_for(self.rmq_processor.join(), timeout)
+        except asyncio.TimeoutError:
+            LOGGER.warning(f'{self.rmq_processor.waiting} commands left unhandled on shutdown')
+
     async def start_long_polling(self) -> None:
         LOGGER.debug('Starting long polling...')
         try:
             loop = asyncio.get_running_loop()
             await self.pg.connect(custom_loop=loop)
             await self.rmq.connect(custom_loop=loop)
-            await self.rmq.listen_queue(
-                queue_name=MESSAGE_BROKER_QUEUE,
-                callback=self.process_rmq_message
-            )
+            self.send_scheduler.start()
+            await self._listen_commands()
             await self._dp.start_polling(self)
 
         except KeyboardInterrupt:
             LOGGER.info('Shutting down...')
+        finally:
+            await self._finish_commands()
+            await self.send_scheduler.close()
+
+    async def register_webhook(self, url: str, secret_token: Optional[str] = None):
+        try:
+            await self.set_webhook(url=url, secret_token=secret_token)
+            LOGGER.info(f'Webhook set to {url}')
+        finally:
+            # the session is bound to the loop it was created in
+            await self.session.close()
+
+    async def start_webhook(
+            self,
+            host: str = WEBHOOK_HOST,
+            port: int = WEBHOOK_PORT,
+            path: str = WEBHOOK_PATH,
+            secret_token: Optional[str] = None,
+            concurrency: int = WEBHOOK_CONCURRENCY,
+            max_queue_size: int = WEBHOOK_QUEUE_SIZE,
+    ) -> None:
+        """
+        Serves Telegram updates posted to the webhook until SIGTERM or SIGINT.
+        The port is opened with SO_REUSEPORT, so several processes can serve it,
+        see `bot.webhook.run_webhook_workers`. The webhook must be registered with
+        `register_webhook` beforehand.
+        """
+        LOGGER.debug('Starting webhook server...')
+        loop = asyncio.get_running_loop()
+        await self.pg.connect(custom_loop=loop)
+        await self.rmq.connect(custom_loop=loop)
+        self.send_scheduler.start()
+        await self._listen_commands()
+
+        app = create_app(
+            self,
+            self._dp,
+            path=path,
+            secret_token=secret_token,
+            concurrency=concurrency,
+            max_queue_size=max_queue_size,
+        )
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port, reuse_port=True).start()
+        LOGGER.info(f'Webhook server is listening on {host}:{port}{path}')
 
-    async def start_webhook(self) -> None:
-        ...
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        LOGGER.info('Shutting down webhook server...')
+        await runner.cleanup()
+        await self._finish_commands()
+        await self.send_scheduler.close()
@@ -1,65 +1,142 @@
-import json
+import asyncio
+from typing import Dict, Optional
 
+import aio_pika
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from tzlocal import get_localzone
 
-from bot import BotCommands
+from bot import BotCommands, BATCH_MAX_RETRIES, setup_logger
 from bot.scenes.callback_data import DatingEventCallbackData, DatingEventActions, PartnerActions, \
     PartnerActionsCallbackData
+from bot.send_scheduler import SendPriority, send_priority
 from bot.utils import escape_markdown_v2 as __
+from chathub_connectors.envelope import CommandRegistry, Envelope
 
+LOGGER = setup_logger(__name__)
 
-class UnknownBotCommandError(Exception):
-    pass
+# command handlers of the bot by command name
+BOT_COMMANDS = CommandRegistry()
+
+# times the recipients of a batch were sent again
+BATCH_ATTEMPT_HEADER = 'batch_attempt'
+# the user blocked the bot or the chat is gone, sending again does not help
+PERMANENT_SEND_ERRORS = (TelegramForbiddenError, TelegramBadRequest)
 
 
 class BotCommandsHandlerMixin:
-    async def process_commands(self, message, headers: dict, user_id: int):
-        if BotCommands.CONFIRM_USER_EVENT_REGISTRATION.value in message:
-            await self.request_event_registration_confirmation(headers, user_id)
-        elif BotCommands.SEND_RULES.value in message:
-            await self.send_pre_event_rules(user_id)
-        elif BotCommands.INVITE_TO_MEETING.value in message:
-            await self.send_meeting_invitation(message, headers)
-        elif BotCommands.SEND_PARTNER_PROFILE.value in message:
-            # implement later
-            ...
-        elif BotCommands.SEND_PARTNER_RATING_REQUEST.value in message:
-            await self.send_partner_rating_request(message, headers)
-        elif BotCommands.SEND_PARTNER_PROFILE_VERIFICATION_REQUEST.value in message:
-            # implement later
-            ...
-        elif BotCommands.SEND_FINAL_DATING_MESSAGE.value in message:
-            await self.send_final_dating_message(message, headers)
-        elif BotCommands.SEND_MATCH_MESSAGE.value in message:
-            await self.send_match_messages(message, headers)
-        elif BotCommands.SEND_READY_FOR_EVENT_REQUEST.value in message:
-            await self.send_ready_for_event_request(message, headers)
-        elif BotCommands.SEND_BREAK_MESSAGE.value in message:
-            await self.send_break_message(message, headers)
-        elif BotCommands.SEND_USER_WILL_TAKE_PART_IN_EVENT.value in message:
-            await self.send_will_take_part_in_event_message(message, headers)
-        elif BotCommands.SEND_USER_WILL_NOT_TAKE_PART_IN_EVENT.value in message:
-            await self.send_will_not_take_part_in_event_message(message, headers)
-        else:
-            raise UnknownBotCommandError(f'Cannot process command, message: {message[:100]}')
+    async def process_commands(self, envelope: Envelope, message: Optional[aio_pika.abc.AbstractIncomingMessage] = None):
+        """
+        Handles the command, or the command of every recipient of a batch. The
+        recipients are handled at once, their messages are paced by the send
+        scheduler. A recipient that failed does not fail the batch, so others
+        do not get the message twice: the failed recipients are published
+        again as a smaller batch, see `_retry_batch`.
+
+        :param message: Message of the envelope, batches are published again
+                    to its exchange and routing key.
+        :raises UnknownCommandError: There is no handler for the command.
+        """
+        if not envelope.is_batch:
+            await BOT_COMMANDS.dispatch(self, envelope)
+            return True
+
+        handler = BOT_COMMANDS.get(envelope.command)
+        recipients = list(envelope.expand())
+        results = await asyncio.gather(
+            *(handler(self, recipient) for recipient in recipients),
+            return_exceptions=True,
+        )
+        errors = {
+            recipient.headers.get('user_id'): result
+            for recipient, result in zip(recipients, results)
+            if isinstance(result, Exception)
+        }
+        if not errors:
+            self.rmq_metrics.observe_batch(len(recipients), 0)
+            return True
+
+        user_id, error = next(iter(errors.items()))
+        LOGGER.warning(
+            f'Command {envelope.command} failed for {len(errors)} of {len(recipients)} users '
+            f'{list(errors)[:20]}, user {user_id}: {error}'
+        )
+        retried = await self._retry_batch(envelope, errors, message)
+        self.rmq_metrics.observe_batch(len(recipients), len(errors), retried, len(errors) - retried)
         return True
 
-    async def request_event_registration_confirmation(self, headers: dict, user_id: int):
+    async def _retry_batch(
+            self,
+            envelope: Envelope,
+            errors: Dict[int, Exception],
+            message: Optional[aio_pika.abc.AbstractIncomingMessage],
+    ) -> int:
+        """
+        Publishes the batch again for recipients that failed with a transient
+        error, at most `BATCH_MAX_RETRIES` times. Others are dropped and logged.
+
+        :return: Number of recipients published again.
+        """
+        attempt = int(envelope.headers.get(BATCH_ATTEMPT_HEADER, 0)) + 1
+        recipients = [
+            user_id for user_id, error in errors.items()
+            if not isinstance(error, PERMANENT_SEND_ERRORS)
+        ]
+        if message is None or not recipients or attempt > BATCH_MAX_RETRIES:
+            LOGGER.error(
+                f'Dropping command {envelope.command} of event {envelope.headers.get("event_id")} '
+                f'for {len(errors)} users {list(errors)[:20]}'
+            )
+            return 0
+
+        body, headers = Envelope(
+            envelope.command,
+            envelope.payload,
+            {**envelope.headers, BATCH_ATTEMPT_HEADER: attempt},
+            recipients=recipients,
+        ).encode()
+        try:
+            await self.rmq.publish(body, message.routing_key, message.exchange, headers)
+        except Exception as e:
+            LOGGER.error(f'Failed to publish command {envelope.command} again for {len(recipients)} users: {e}')
+            return 0
+        if len(recipients) < len(errors):
+            LOGGER.error(
+                f'Dropping command {envelope.command} of event {envelope.headers.get("event_id")} '
+                f'for {len(errors) - len(recipients)} users who can not get messages'
+            )
+        return len(recipients)
+
+    @BOT_COMMANDS.register(
+        BotCommands.SEND_PARTNER_PROFILE,
+        BotCommands.SEND_PARTNER_PROFILE_VERIFICATION_REQUEST,
+    )
+    async def skip_command(self, envelope: Envelope):
+        # implement later
+        ...
+
+    @BOT_COMMANDS.register(BotCommands.CONFIRM_USER_EVENT_REGISTRATION)
+    @send_priority(SendPriority.NOTIFICATION)
+    async def request_event_registration_confirmation(self, envelope: Envelope):
         _ = self.i18n.gettext
-        events = await self.pg.get_dating_events(
-            user={'id': int(user_id)},
-            timezone=get_localzone()
+        user_id = envelope.headers.get('chat_id')
+        target_event = await self.pg.get_dating_event(
+            int(envelope.headers.get('event_id', 0)),
+            timezone=get_localzone(),
         )
-        target_event = [e for e in events if e.get('id') == int(headers.get('event_id', 0))][0]
+        if target_event is None:
+            LOGGER.warning(
+                f'Event {envelope.headers.get("event_id")} to confirm registration of {user_id} not found'
+            )
+            return
 
         builder = InlineKeyboardBuilder()
         builder.button(
             text=_('confirm button'),
             callback_data=DatingEventCallbackData(
                 action=DatingEventActions.CONFIRM.value,
-                event_id=headers.get('event_id', 0),
+                event_id=envelope.headers.get('event_id', 0),
                 user_id=user_id,
                 confirmed=False,
             )
@@ -75,8 +152,11 @@ class BotCommandsHandlerMixin:
             reply_markup=builder.as_markup(),
         )
 
-    async def send_pre_event_rules(self, user_id: int):
+    @BOT_COMMANDS.register(BotCommands.SEND_RULES)
+    @send_priority(SendPriority.BROADCAST)
+    async def send_pre_event_rules(self, envelope: Envelope):
         _ = self.i18n.gettext
+        user_id = envelope.headers.get('chat_id')
 
         await self.send_message(
             chat_id=user_id,
@@ -89,21 +169,25 @@ class BotCommandsHandlerMixin:
             parse_mode=ParseMode.MARKDOWN_V2,
         )
 
-    async def send_meeting_invitation(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.INVITE_TO_MEETING)
+    @send_priority(SendPriority.INVITATION)
+    async def send_meeting_invitation(self, envelope: Envelope):
         _ = self.i18n.gettext
 
-        data = json.loads(message)[BotCommands.INVITE_TO_MEETING.value]
+        data = envelope.payload or {}
 
         await self.send_message(
-            chat_id=headers.get('user_id'),
+            chat_id=envelope.headers.get('user_id'),
             text=__(_('meeting invitation {url}').format(url=data.get('url'))),
             parse_mode=ParseMode.MARKDOWN_V2,
         )
 
-    async def send_partner_rating_request(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.SEND_PARTNER_RATING_REQUEST)
+    @send_priority(SendPriority.NOTIFICATION)
+    async def send_partner_rating_request(self, envelope: Envelope):
         _ = self.i18n.gettext
 
-        data = json.loads(message)[BotCommands.SEND_PARTNER_RATING_REQUEST.value]
+        data = envelope.payload or {}
         partner_id = int(data.get('partner_id'))
 
         builder = InlineKeyboardBuilder()
@@ -111,8 +195,8 @@ class BotCommandsHandlerMixin:
             text=_('like button'),
             callback_data=PartnerActionsCallbackData(
                 action=PartnerActions.LIKE.value,
-                event_id=headers.get('event_id'),
-                user_id=headers.get('user_id'),
+                event_id=envelope.headers.get('event_id'),
+                user_id=envelope.headers.get('user_id'),
                 partner_id=partner_id,
             )
         )
@@ -120,8 +204,8 @@ class BotCommandsHandlerMixin:
             text=_('dislike button'),
             callback_data=PartnerActionsCallbackData(
                 action=PartnerActions.DISLIKE.value,
-                event_id=headers.get('event_id'),
-                user_id=headers.get('user_id'),
+                event_id=envelope.headers.get('event_id'),
+                user_id=envelope.headers.get('user_id'),
                 partner_id=partner_id,
             )
         )
@@ -129,40 +213,44 @@ class BotCommandsHandlerMixin:
             text=_('report button'),
             callback_data=PartnerActionsCallbackData(
                 action=PartnerActions.REPORT.value,
-                event_id=headers.get('event_id'),
-                user_id=headers.get('user_id'),
+                event_id=envelope.headers.get('event_id'),
+                user_id=envelope.headers.get('user_id'),
                 partner_id=partner_id,
             )
         )
         builder.adjust(2)
 
         await self.send_message(
-            chat_id=headers.get('user_id'),
+            chat_id=envelope.headers.get('user_id'),
             text=__(_("please rate partners performance")),
             parse_mode=ParseMode.MARKDOWN_V2,
             reply_markup=builder.as_markup(),
         )
 
-    async def send_final_dating_message(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.SEND_FINAL_DATING_MESSAGE)
+    @send_priority(SendPriority.BROADCAST)
+    async def send_final_dating_message(self, envelope: Envelope):
         _ = self.i18n.gettext
 
         await self.send_message(
-            chat_id=headers.get('user_id'),
+            chat_id=envelope.headers.get('user_id'),
             text=__(_('final dating message')),
             parse_mode=ParseMode.MARKDOWN_V2,
         )
 
-    async def send_match_messages(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.SEND_MATCH_MESSAGE)
+    @send_priority(SendPriority.NOTIFICATION)
+    async def send_match_messages(self, envelope: Envelope):
         _ = self.i18n.gettext
 
         matches = await self.pg.get_user_matches(
-            user_id=int(headers.get('user_id')),
-            event_id=int(headers.get('event_id')),
+            user_id=int(envelope.headers.get('user_id')),
+            event_id=int(envelope.headers.get('event_id')),
         )
 
         for match in matches:
             await self.send_message(
-                chat_id=headers.get('user_id'),
+                chat_id=envelope.headers.get('user_id'),
                 text=__(_('you match with {partner_name}, his contact {partner_contact}').format(
                     partner_name=match.get('name'),
                     partner_contact=f'@{match.get("username")}',
@@ -170,7 +258,9 @@ class BotCommandsHandlerMixin:
                 parse_mode=ParseMode.MARKDOWN_V2,
             )
 
-    async def send_ready_for_event_request(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.SEND_READY_FOR_EVENT_REQUEST)
+    @send_priority(SendPriority.INVITATION)
+    async def send_ready_for_event_request(self, envelope: Envelope):
         _ = self.i18n.gettext
 
         builder = InlineKeyboardBuilder()
@@ -178,41 +268,47 @@ class BotCommandsHandlerMixin:
             text=_('i am ready button'),
             callback_data=DatingEventCallbackData(
                 action=DatingEventActions.READY.value,
-                event_id=headers.get('event_id'),
-                user_id=headers.get('user_id'),
+                event_id=envelope.headers.get('event_id'),
+                user_id=envelope.headers.get('user_id'),
                 confirmed=False,
             ))
 
         await self.send_message(
-            chat_id=headers.get('user_id'),
+            chat_id=envelope.headers.get('user_id'),
             text=__(_('are you ready to start event?')),
             parse_mode=ParseMode.MARKDOWN_V2,
             reply_markup=builder.as_markup(),
         )
 
-    async def send_break_message(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.SEND_BREAK_MESSAGE)
+    @send_priority(SendPriority.BROADCAST)
+    async def send_break_message(self, envelope: Envelope):
         _ = self.i18n.gettext
 
         await self.send_message(
-            chat_id=headers.get('user_id'),
+            chat_id=envelope.headers.get('user_id'),
             text=__(_('break message')),
             parse_mode=ParseMode.MARKDOWN_V2,
         )
 
-    async def send_will_take_part_in_event_message(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.SEND_USER_WILL_TAKE_PART_IN_EVENT)
+    @send_priority(SendPriority.NOTIFICATION)
+    async def send_will_take_part_in_event_message(self, envelope: Envelope):
         _ = self.i18n.gettext
 
         await self.send_message(
-            chat_id=headers.get('user_id'),
+            chat_id=envelope.headers.get('user_id'),
             text=__(_('will take part in event message')),
             parse_mode=ParseMode.MARKDOWN_V2,
         )
 
-    async def send_will_not_take_part_in_event_message(self, message: str, headers: dict):
+    @BOT_COMMANDS.register(BotCommands.SEND_USER_WILL_NOT_TAKE_PART_IN_EVENT)
+    @send_priority(SendPriority.NOTIFICATION)
+    async def send_will_not_take_part_in_event_message(self, envelope: Envelope):
         _ = self.i18n.gettext
 
         await self.send_message(
-            chat_id=headers.get('user_id'),
+            chat_id=envelope.headers.get('user_id'),
             text=__(_('will not take part in event message')),
             parse_mode=ParseMode.MARKDOWN_V2,
         )
@@ -1,35 +1,38 @@
-from collections.abc import Callable
+import asyncio
+import json
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import partial, wraps
+from typing import Awaitable, Callable, Dict, List, Optional, Set
 
+from aio_pika.abc import AbstractIncomingMessage
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from bot import setup_logger
+from bot import setup_logger, DATE_MAKER_ROUTING_KEY
 from bot.scenes.callback_data import (
     DatingMenuActionsCallbackData,
     DatingEventCallbackData,
     DatingEventActions,
     DatingMenuActions
 )
+from chathub_connectors.envelope import Envelope
+from chathub_connectors.rabbitmq_connector import RpcCallDropped
 
 LOGGER = setup_logger(__name__)
 
 
-def manage_waiting_list(func):
-    # @wraps
+def handle_reply_errors(func):
+    @wraps(func)
     async def wrapper(self, *args, **kwargs):
         chat_id = kwargs['chat_id']
         message_id = kwargs['message_id']
         try:
             result = await func(self, *args, **kwargs)
-            self.delete_from_waiting(chat_id, message_id)
         except Exception as e:
             LOGGER.error(f'Got error while processing awaited data: {e}')
             result = False
-        finally:
-            LOGGER.debug(f'Awaited command data for {chat_id}[msg {message_id}]: {result}')
-            return result
+        LOGGER.debug(f'Awaited command data for {chat_id}[msg {message_id}]: {result}')
+        return result
 
     return wrapper
 
@@ -38,17 +41,78 @@ class DataHandlerMixin:
     """
     Class for handling data from message broker.
     """
-    waiting: Dict[str, Callable] = {}
+    # datemaker calls waiting for replies, see `call_datemaker`
+    datemaker_calls: Set[asyncio.Task]
 
-    def wait_for_data(self, chat_id, message_id, handler):
-        self.waiting.update({
-            f'{chat_id}_{message_id}': handler
-        })
-
-    def delete_from_waiting(self, chat_id, message_id):
-        del self.waiting[f'{chat_id}_{message_id}']
+    async def call_datemaker(
+            self,
+            command: str,
+            headers: Dict[str, str],
+            handler: Callable[..., Awaitable[bool]],
+    ):
+        """
+        Sends a command to the datemaker and handles its reply with `handler`
+        in the background, so the update handler returns at once and does not
+        hold the lock of the chat while the datemaker works.
+
+        :param command: DateMakerCommands member or value.
+        :param headers: Command parameters, must contain chat_id and message_id
+                    of the menu the reply is shown in.
+        :param handler: Method of this class, gets chat_id, message_id and the reply data.
+        """
+        task = asyncio.create_task(self._call_datemaker(command, headers, handler))
+        self.datemaker_calls.add(task)
+        task.add_done_callback(self.datemaker_calls.discard)
 
-    @manage_waiting_list
+    async def _call_datemaker(
+            self,
+            command: str,
+            headers: Dict[str, str],
+            handler: Callable[..., Awaitable[bool]],
+    ) -> bool:
+        """
+        If the datemaker does not reply in time, the user is told the operation
+        is still processing: the command may still be done, so it is not
+        reported as failed. A reply that comes later is handled as usual.
+        """
+        _ = self.i18n.gettext
+        chat_id = headers['chat_id']
+        message_id = headers['message_id']
+        body, headers = Envelope(command, headers=headers).encode()
+        try:
+            reply = await self.rmq.call(
+                message=body,
+                routing_key=DATE_MAKER_ROUTING_KEY,
+                exchange='chathub_direct_main',
+                headers=headers,
+                on_late_reply=partial(
+                    self._handle_late_reply, handler, chat_id, message_id, self.i18n.current_locale
+                ),
+            )
+        except (asyncio.TimeoutError, RpcCallDropped) as e:
+            LOGGER.warning(f'No datemaker reply to {command} for {chat_id}: {e!r}')
+            if isinstance(e, asyncio.TimeoutError):
+                text = _('operation is still processing')
+            else:
+                text = _('operation failed')
+            await self.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+            return False
+        return await handler(chat_id=chat_id, message_id=message_id, data=json.loads(reply.body))
+
+    async def _handle_late_reply(
+            self,
+            handler: Callable[..., Awaitable[bool]],
+            chat_id: str,
+            message_id: str,
+            locale: str,
+            reply: AbstractIncomingMessage,
+    ):
+        LOGGER.info(f'Handling late datemaker reply for {chat_id}')
+        # the reply comes outside of the update, in the locale of the user
+        with self.i18n.use_locale(locale):
+            await handler(chat_id=chat_id, message_id=message_id, data=json.loads(reply.body))
+
+    @handle_reply_errors
     async def process_list_events(
             self,
             chat_id: str,
@@ -110,7 +174,7 @@ class DataHandlerMixin:
 
         return True
 
-    @manage_waiting_list
+    @handle_reply_errors
     async def get_confirmation(
             self,
             chat_id: str,
@@ -24,7 +24,17 @@ async def handle_debug(message: Message):
     await message.answer(
         "Current bot state\n"
         f"received messages: {bot.received_messages}\n"
-        f"sent messages: {bot.sent_messages}\n",
+        f"sent messages: {bot.sent_messages}\n"
+        f"postgres cache: {bot.pg.cache_stats}\n"
+        f"send queue: {bot.send_scheduler.stats}\n"
+        f"commands in flight: {bot.rmq_processor.in_flight}, "
+        f"waiting: {bot.rmq_processor.waiting}, "
+        f"last lag: {bot.rmq_metrics.last_lag:.3f}s\n"
+        f"batch commands: {bot.rmq_metrics.batches}, "
+        f"recipients: {bot.rmq_metrics.batch_recipients}, "
+        f"failed: {bot.rmq_metrics.batch_failed}, "
+        f"retried: {bot.rmq_metrics.batch_retried}, "
+        f"dropped: {bot.rmq_metrics.batch_dropped}\n",
         parse_mode=ParseMode.HTML,
     )
     bot.sent_messages += 1
@@ -0,0 +1,61 @@
+"""
+Minimal Prometheus text format helpers for the metrics served by the bot.
+"""
+from bisect import bisect_left
+from typing import List
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else bound
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class ConsumerMetrics:
+    """
+    Time RabbitMQ commands wait for their turn after they were received and
+    time they take to handle, see `OrderedConcurrentProcessor.observe`, and
+    recipients of batch commands.
+    """
+
+    def __init__(self):
+        self.lag = Histogram()
+        self.latency = Histogram()
+        self.last_lag = 0.0
+        self.batches = 0
+        self.batch_recipients = 0
+        self.batch_failed = 0
+        self.batch_retried = 0
+        self.batch_dropped = 0
+
+    def observe(self, lag: float, latency: float):
+        self.lag.observe(lag)
+        self.latency.observe(latency)
+        self.last_lag = lag
+
+    def observe_batch(self, recipients: int, failed: int, retried: int = 0, dropped: int = 0):
+        self.batches += 1
+        self.batch_recipients += recipients
+        self.batch_failed += failed
+        self.batch_retried += retried
+        self.batch_dropped += dropped
@@ -12,7 +12,7 @@ from aiogram.utils.i18n import gettext as _
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from bot.utils import escape_markdown_v2 as __
 
-from bot import setup_logger, DateMakerCommands, DATE_MAKER_ROUTING_KEY
+from bot import setup_logger, DateMakerCommands
 from bot.scenes.base import BaseSpeedDatingScene
 from bot.scenes.callback_data import (
     DatingMenuActionsCallbackData,
@@ -221,7 +221,7 @@ async def _handle_listing_events(
     - update message text to be suitable for showing a list of events
     - send request to date maker to get the list
 
-    Then bot.bot.DatingBot.process_rmq_message:
+    Then bot.data_handler.DataHandlerMixin.call_datemaker:
     - wait for response
     - update message and reply markup for selecting event
 
@@ -256,17 +256,15 @@ async def _handle_listing_events(
             parse_mode=ParseMode.MARKDOWN_V2,
             reply_markup=builder.as_markup(),
         )
-        await rmq.publish(
-            message=DateMakerCommands.LIST_EVENTS.value,
-            routing_key=DATE_MAKER_ROUTING_KEY,
-            exchange='chathub_direct_main',
+        await bot.call_datemaker(
+            DateMakerCommands.LIST_EVENTS.value,
             headers={
                 'user_id': str(query.from_user.id),
                 'chat_id': str(query.message.chat.id),
                 'message_id': str(query.message.message_id),
             },
+            handler=bot.process_list_events,
         )
-        bot.wait_for_data(query.message.chat.id, query.message.message_id, bot.process_list_events)
 
     except TelegramBadRequest as e:
         LOGGER.warning(f'Got exception while processing callback: {e}')
@@ -298,18 +296,16 @@ async def _handle_event_registration(
             parse_mode=ParseMode.HTML,
             reply_markup=builder.as_markup(),
         )
-        await rmq.publish(
-            message=DateMakerCommands.REGISTER_USER_TO_EVENT.value,
-            routing_key=DATE_MAKER_ROUTING_KEY,
-            exchange='chathub_direct_main',
+        await bot.call_datemaker(
+            DateMakerCommands.REGISTER_USER_TO_EVENT.value,
             headers={
                 'user_id': str(query.from_user.id),
                 'chat_id': str(query.message.chat.id),
                 'message_id': str(query.message.message_id),
                 'event_id': str(callback_data.event_id),
             },
+            handler=bot.get_confirmation,
         )
-        bot.wait_for_data(query.message.chat.id, query.message.message_id, bot.get_confirmation)
 
     except TelegramBadRequest as e:
         LOGGER.warning(f'Got exception while processing callback: {e}')
@@ -334,18 +330,16 @@ async def _handle_cancelling_event_registration(
 
 
 async def _cancel_registration(callback_data, bot, query, rmq):
-    await rmq.publish(
-        message=DateMakerCommands.CANCEL_REGISTRATION.value,
-        routing_key=DATE_MAKER_ROUTING_KEY,
-        exchange='chathub_direct_main',
+    await bot.call_datemaker(
+        DateMakerCommands.CANCEL_REGISTRATION.value,
         headers={
             'user_id': str(query.from_user.id),
             'chat_id': str(query.message.chat.id),
             'message_id': str(query.message.message_id),
             'event_id': str(callback_data.event_id),
         },
+        handler=bot.get_confirmation,
     )
-    bot.wait_for_data(query.message.chat.id, query.message.message_id, bot.get_confirmation)
 
 
 async def _ask_for_cancelling_confirmation(callback_data, query):
@@ -393,18 +387,16 @@ async def _confirm_registration(query, callback_data, rmq, bot):
         text=_('thanks for confirming registration for {event}').format(event=dating_event),
         parse_mode=ParseMode.HTML,
     )
-    await rmq.publish(
-        message=DateMakerCommands.CONFIRM_USER_EVENT_REGISTRATION.value,
-        routing_key=DATE_MAKER_ROUTING_KEY,
-        exchange='chathub_direct_main',
+    await bot.call_datemaker(
+        DateMakerCommands.CONFIRM_USER_EVENT_REGISTRATION.value,
         headers={
             'user_id': str(query.from_user.id),
             'chat_id': str(query.message.chat.id),
             'message_id': str(query.message.message_id),
             'event_id': str(callback_data.event_id),
         },
+        handler=bot.get_confirmation,
     )
-    bot.wait_for_data(query.message.chat.id, query.message.message_id, bot.get_confirmation)
 
 
 async def _user_ready_to_start_event(query, callback_data, pg, bot):
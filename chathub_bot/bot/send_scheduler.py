@@ -0,0 +1,324 @@
+"""
+Outbound message scheduler of the bot.
+
+Telegram allows a bot about 30 messages per second overall and about one
+message per second to the same chat, extra messages get 429 with `retry_after`.
+`SendScheduler` queues outgoing messages and sends them as fast as token
+buckets for the global and the per chat limits allow:
+
+- messages of a chat are sent one after another in the order they were queued;
+- among chats that can be sent to, the one with the most urgent message goes
+  first, so meeting invitations are not stuck behind rules broadcast to
+  everyone registered to the event;
+- a 429 pauses the chat for `retry_after` and the message is sent again.
+
+The priority of messages sent in a handler is set with `send_priority`.
+"""
+import asyncio
+import functools
+import heapq
+import time
+from collections import deque
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from bot import setup_logger
+from bot.metrics import Histogram
+
+LOGGER = setup_logger(__name__)
+
+
+class SendPriority(IntEnum):
+    # replies to users who are waiting for them
+    INTERACTIVE = 0
+    # messages the event can not go on without
+    INVITATION = 1
+    NOTIFICATION = 2
+    # the same message to everyone registered to an event
+    BROADCAST = 3
+
+
+current_send_priority: ContextVar[SendPriority] = ContextVar(
+    'current_send_priority', default=SendPriority.INTERACTIVE
+)
+
+
+def send_priority(priority: SendPriority):
+    """
+    Sets the priority of messages sent by the decorated coroutine.
+
+    Example:
+    @send_priority(SendPriority.BROADCAST)
+    async def send_pre_event_rules(self, user_id: int):
+        await self.send_message(chat_id=user_id, text='...')
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_send_priority.set(priority)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                current_send_priority.reset(token)
+        return wrapper
+    return decorator
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second, at most `capacity` of them saved up for bursts.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        """Seconds until a token can be taken."""
+        now = self.clock()
+        self._refill(now)
+        return max((1 - self.tokens) / self.rate, self.blocked_until - now, 0.0)
+
+    def take(self):
+        self._refill(self.clock())
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = self.clock() + seconds
+        self.tokens = min(self.tokens, 0)
+
+    @property
+    def full(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.capacity
+
+
+class _Send:
+    __slots__ = ('priority', 'seq', 'call', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, priority: int, seq: int, call: Callable[[], Awaitable], future: asyncio.Future,
+                 enqueued_at: float):
+        self.priority = priority
+        self.seq = seq
+        self.call = call
+        self.future = future
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+
+
+class SendScheduler:
+    """
+    Example:
+    scheduler = SendScheduler(global_rate=30, chat_rate=1, chat_burst=3)
+    scheduler.start()
+    message = await scheduler.send(chat_id, lambda: bot(SendMessage(...)), SendPriority.BROADCAST)
+    await scheduler.close()
+    """
+
+    def __init__(
+            self,
+            global_rate: float = 30,
+            chat_rate: float = 1,
+            chat_burst: float = 3,
+            max_retries: int = 3,
+            max_idle_chats: int = 10000,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param global_rate: Messages per second to all chats.
+        :param chat_rate: Messages per second to one chat.
+        :param chat_burst: Messages sent to a chat at once before `chat_rate` applies.
+        :param max_retries: Times a message is sent again after 429.
+        :param max_idle_chats: Chat buckets kept before full ones are dropped.
+        """
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+        self.clock = clock
+        # no bursts: a full second of saved up tokens would double the rate for a moment
+        self.global_bucket = TokenBucket(global_rate, 1, clock)
+        self._chat_buckets: Dict[Hashable, TokenBucket] = {}
+        self._chat_queues: Dict[Hashable, Deque[_Send]] = {}
+        # chats that have a message to send and none in flight: (priority, seq, chat)
+        self._ready: List[Tuple[int, int, Hashable]] = []
+        # chats waiting for their bucket: (time, priority, seq, chat)
+        self._delayed: List[Tuple[float, int, int, Hashable]] = []
+        # chats in one of the heaps above
+        self._scheduled = set()
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # stats
+        self.queued = 0
+        self.max_queued = 0
+        self.queued_by_priority = {priority: 0 for priority in SendPriority}
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.queue_wait = Histogram()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'in_flight': len(self._in_flight),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            **{f'queued_{priority.name.lower()}': n for priority, n in self.queued_by_priority.items()},
+        }
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10):
+        """Waits up to `timeout` seconds for queued messages to be sent."""
+        deadline = self.clock() + timeout
+        while (self.queued or self._in_flight) and self.clock() < deadline:
+            await asyncio.sleep(0.05)
+        if self.queued:
+            LOGGER.warning(f'Dropping {self.queued} queued messages on shutdown')
+        if self._task:
+            self._task.cancel()
+        for task in list(self._in_flight.values()):
+            task.cancel()
+        for queue in self._chat_queues.values():
+            for item in queue:
+                if not item.future.done():
+                    item.future.cancel()
+
+    async def send(self, chat_id: Hashable, call: Callable[[], Awaitable], priority: int = SendPriority.INTERACTIVE):
+        """
+        Queues `call`, a coroutine function sending a message to `chat_id`, and
+        returns its result once it is sent.
+        """
+        self._seq += 1
+        item = _Send(priority, self._seq, call, asyncio.get_running_loop().create_future(), self.clock())
+        queue = self._chat_queues.setdefault(chat_id, deque())
+        queue.append(item)
+        self._count(item, 1)
+        if chat_id not in self._in_flight and chat_id not in self._scheduled:
+            self._schedule_chat(chat_id)
+        return await item.future
+
+    def _count(self, item: _Send, n: int):
+        self.queued += n
+        self.queued_by_priority[SendPriority(item.priority)] += n
+        self.max_queued = max(self.max_queued, self.queued)
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, self.clock)
+        return bucket
+
+    def _schedule_chat(self, chat_id: Hashable):
+        """Puts the chat back into the ready heap if it has queued messages."""
+        queue = self._chat_queues.get(chat_id)
+        while queue and queue[0].future.done():
+            # the caller was cancelled
+            self._count(queue.popleft(), -1)
+        if not queue:
+            self._chat_queues.pop(chat_id, None)
+            if len(self._chat_buckets) > self.max_idle_chats:
+                self._drop_idle_buckets()
+            return
+        head = queue[0]
+        self._scheduled.add(chat_id)
+        delay = self._chat_bucket(chat_id).delay()
+        if delay > 0:
+            heapq.heappush(self._delayed, (self.clock() + delay, head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    def _drop_idle_buckets(self):
+        # a full bucket is the same as a new one
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._chat_queues and bucket.full:
+                del self._chat_buckets[chat_id]
+
+    async def _run(self):
+        while True:
+            now = self.clock()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self.global_bucket.delay()
+            if delay > 0:
+                # a more urgent message may be queued meanwhile
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            self._scheduled.discard(chat_id)
+            queue = self._chat_queues.get(chat_id)
+            if not queue or queue[0].future.done() or self._chat_bucket(chat_id).delay() > 0:
+                self._schedule_chat(chat_id)
+                continue
+
+            self.global_bucket.take()
+            self._chat_bucket(chat_id).take()
+            self._in_flight[chat_id] = asyncio.create_task(self._send(chat_id, queue[0]))
+
+    async def _send(self, chat_id: Hashable, item: _Send):
+        if item.attempts == 0:
+            self.queue_wait.observe(self.clock() - item.enqueued_at)
+        item.attempts += 1
+        try:
+            result = await item.call()
+        except TelegramRetryAfter as e:
+            if item.attempts > self.max_retries:
+                self._done(chat_id, item)
+                self.failed += 1
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                LOGGER.debug(f'Flood limit of chat {chat_id}, retrying in {e.retry_after}s')
+                self.retried += 1
+                self._chat_bucket(chat_id).block(e.retry_after)
+        except Exception as e:
+            self._done(chat_id, item)
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self._done(chat_id, item)
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._in_flight.pop(chat_id, None)
+            self._schedule_chat(chat_id)
+
+    def _done(self, chat_id: Hashable, item: _Send):
+        self._chat_queues[chat_id].popleft()
+        self._count(item, -1)
@@ -0,0 +1,296 @@
+"""
+Webhook server for DatingBot.
+
+Telegram posts updates to `path`, updates are put into a bounded queue and
+handled by `concurrency` tasks of the dispatcher, so Telegram gets its response
+without waiting for handlers. A full queue answers 503 and Telegram retries the
+update later. Several worker processes share the port (SO_REUSEPORT), the
+webhook is registered once by the parent process.
+
+Every worker serves its metrics in the Prometheus text format on /metrics.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from bot import FSM_STORAGE, SEND_GLOBAL_RATE, setup_logger
+from bot.metrics import Histogram
+
+LOGGER = setup_logger(__name__)
+
+
+class WebhookMetrics:
+    """
+    Counters of a worker: received, rejected (queue was full), handled and
+    failed updates, current and max queue depth, time updates wait in the
+    queue and time handlers take.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.rejected = 0
+        self.handled = 0
+        self.failed = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_progress = 0
+        self.queue_wait = Histogram()
+        self.handler_latency = Histogram()
+
+    def render(self, worker: str) -> str:
+        labels = f'worker="{worker}"'
+        lines = []
+        for name, kind, value in [
+            ('received', 'counter', self.received),
+            ('rejected', 'counter', self.rejected),
+            ('handled', 'counter', self.handled),
+            ('failed', 'counter', self.failed),
+            ('queue_depth', 'gauge', self.queue_depth),
+            ('max_queue_depth', 'gauge', self.max_queue_depth),
+            ('in_progress', 'gauge', self.in_progress),
+        ]:
+            lines.append(f'# TYPE chathub_bot_webhook_updates_{name} {kind}')
+            lines.append(f'chathub_bot_webhook_updates_{name}{{{labels}}} {value}')
+        for name, histogram in [
+            ('queue_wait_seconds', self.queue_wait),
+            ('handler_latency_seconds', self.handler_latency),
+        ]:
+            lines.append(f'# TYPE chathub_bot_webhook_{name} histogram')
+            lines.extend(histogram.render(f'chathub_bot_webhook_{name}', labels))
+        return '\n'.join(lines) + '\n'
+
+
+def render_send_metrics(scheduler, worker: str) -> str:
+    labels = f'worker="{worker}"'
+    lines = []
+    for name, value in scheduler.stats.items():
+        kind = 'counter' if name in ('sent', 'retried', 'failed') else 'gauge'
+        lines.append(f'# TYPE chathub_bot_send_{name} {kind}')
+        lines.append(f'chathub_bot_send_{name}{{{labels}}} {value}')
+    lines.append('# TYPE chathub_bot_send_queue_wait_seconds histogram')
+    lines.extend(scheduler.queue_wait.render('chathub_bot_send_queue_wait_seconds', labels))
+    return '\n'.join(lines) + '\n'
+
+
+def render_consumer_metrics(processor, metrics, worker: str) -> str:
+    labels = f'worker="{worker}"'
+    lines = []
+    for name, kind, value in [
+        ('processed', 'counter', processor.processed),
+        ('failed', 'counter', processor.failed),
+        ('in_flight', 'gauge', processor.in_flight),
+        ('max_in_flight', 'gauge', processor.max_in_flight),
+        ('waiting', 'gauge', processor.waiting),
+        ('active_chats', 'gauge', processor.active_keys),
+        ('lag_seconds', 'gauge', metrics.last_lag),
+        ('batches', 'counter', metrics.batches),
+        ('batch_recipients', 'counter', metrics.batch_recipients),
+        ('batch_failed', 'counter', metrics.batch_failed),
+        ('batch_retried', 'counter', metrics.batch_retried),
+        ('batch_dropped', 'counter', metrics.batch_dropped),
+    ]:
+        lines.append(f'# TYPE chathub_bot_commands_{name} {kind}')
+        lines.append(f'chathub_bot_commands_{name}{{{labels}}} {value}')
+    for name, histogram in [
+        ('queue_lag_seconds', metrics.lag),
+        ('handler_latency_seconds', metrics.latency),
+    ]:
+        lines.append(f'# TYPE chathub_bot_commands_{name} histogram')
+        lines.extend(histogram.render(f'chathub_bot_commands_{name}', labels))
+    return '\n'.join(lines) + '\n'
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler with a bounded queue of updates and a fixed number of
+    dispatcher tasks instead of a task per update.
+    """
+
+    def __init__(
+            self,
+            dispatcher: Dispatcher,
+            bot: Bot,
+            concurrency: int = 50,
+            max_queue_size: int = 1000,
+            secret_token: Optional[str] = None,
+            **data: Any,
+    ):
+        super().__init__(
+            dispatcher=dispatcher,
+            bot=bot,
+            handle_in_background=True,
+            secret_token=secret_token,
+            **data,
+        )
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self.metrics = WebhookMetrics()
+        self._consumers: List[asyncio.Task] = []
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        app.on_startup.append(self._start_consumers)
+        super().register(app, path, **kwargs)
+
+    async def _start_consumers(self, app: web.Application):
+        self._consumers = [
+            asyncio.create_task(self._consume()) for _ in range(self.concurrency)
+        ]
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        self.metrics.received += 1
+        try:
+            self.queue.put_nowait((time.perf_counter(), update))
+        except asyncio.QueueFull:
+            self.metrics.rejected += 1
+            LOGGER.debug(f'Webhook queue is full, rejecting update {update.get("update_id")}')
+            return web.Response(status=503, text='Queue is full')
+        self.metrics.queue_depth = self.queue.qsize()
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.queue.qsize())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _consume(self):
+        while True:
+            received_at, update = await self.queue.get()
+            started_at = time.perf_counter()
+            self.metrics.queue_depth = self.queue.qsize()
+            self.metrics.queue_wait.observe(started_at - received_at)
+            self.metrics.in_progress += 1
+            try:
+                await self._background_feed_update(bot=self.bot, update=update)
+                self.metrics.handled += 1
+            except Exception as e:
+                self.metrics.failed += 1
+                LOGGER.error(f'Failed to handle update {update.get("update_id")}: {e}')
+            finally:
+                self.metrics.in_progress -= 1
+                self.metrics.handler_latency.observe(time.perf_counter() - started_at)
+                self.queue.task_done()
+
+    async def close(self) -> None:
+        # handle updates Telegram was already answered for
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            LOGGER.warning(f'Dropping {self.queue.qsize()} queued updates on shutdown')
+        for consumer in self._consumers:
+            consumer.cancel()
+        await super().close()
+
+
+def create_app(
+        bot: Bot,
+        dispatcher: Dispatcher,
+        path: str = '/webhook',
+        secret_token: Optional[str] = None,
+        concurrency: int = 50,
+        max_queue_size: int = 1000,
+) -> web.Application:
+    app = web.Application()
+    handler = QueuedRequestHandler(
+        dispatcher,
+        bot,
+        concurrency=concurrency,
+        max_queue_size=max_queue_size,
+        secret_token=secret_token,
+    )
+    handler.register(app, path=path)
+    app['webhook_handler'] = handler
+    worker = str(os.getpid())
+
+    async def metrics(request: web.Request) -> web.Response:
+        text = handler.metrics.render(worker)
+        scheduler = getattr(bot, 'send_scheduler', None)
+        if scheduler is not None:
+            text += render_send_metrics(scheduler, worker)
+        processor = getattr(bot, 'rmq_processor', None)
+        if processor is not None:
+            text += render_consumer_metrics(processor, bot.rmq_metrics, worker)
+        return web.Response(text=text, content_type='text/plain')
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({'status': 'ok', 'queue_depth': handler.queue.qsize()})
+
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/healthz', health)
+
+    async def on_startup(app: web.Application):
+        await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher)
+
+    async def on_shutdown(app: web.Application):
+        await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher)
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def _run_worker(worker_no: int, workers: int, kwargs: Dict[str, Any]):
+    # a fresh bot with its own connections per process
+    from bot.bot import DatingBot
+
+    bot = DatingBot(
+        tg_token=kwargs.pop('tg_token'),
+        debug=kwargs.pop('debug'),
+        # the flood limit is per bot, every worker gets its share
+        send_global_rate=SEND_GLOBAL_RATE / workers,
+    )
+    LOGGER.info(f'Webhook worker {worker_no} started, pid {os.getpid()}')
+    try:
+        asyncio.run(bot.start_webhook(**kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_webhook_workers(workers: int, tg_token: str, webhook_url: str, debug: bool = False, **kwargs):
+    """
+    Registers the webhook and runs `workers` processes serving it on one port.
+
+    :param workers: Number of worker processes, more than one needs redis FSM storage.
+    :param tg_token: Telegram bot token.
+    :param webhook_url: Public URL Telegram posts updates to, including the path.
+    :param kwargs: Parameters of `DatingBot.start_webhook`.
+    """
+    from bot.bot import DatingBot
+
+    if workers > 1 and FSM_STORAGE != 'redis':
+        # updates of a chat reach any worker, each would have its own scene state
+        raise ValueError(
+            f'{workers} webhook workers need TG_BOT_FSM_STORAGE=redis, not {FSM_STORAGE}'
+        )
+    bot = DatingBot(tg_token=tg_token, debug=debug)
+    asyncio.run(bot.register_webhook(webhook_url, kwargs.get('secret_token')))
+    if workers == 1:
+        asyncio.run(bot.start_webhook(**kwargs))
+        return
+
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(
+            target=_run_worker,
+            args=(worker_no, workers, dict(kwargs, tg_token=tg_token, debug=debug)),
+            name=f'webhook-worker-{worker_no}',
+        )
+        for worker_no in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        LOGGER.info(f'Stopping {len(processes)} webhook workers')
+        for worker in processes:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.join()
+
@@ -0,0 +1,189 @@
+"""
+Fake Telegram Bot API server and a load generator for the webhook server.
+
+The fake server answers every Bot API method the bot calls: `send*` and
+`edit*` methods return a message, other methods return True. Like Telegram it
+answers 429 with `retry_after` to messages over the per chat or global flood
+limits. Calls are counted per method and served on /stats. The load generator
+posts synthetic message updates from many chats to the bot webhook and prints
+the response statuses, throughput and the worker metrics.
+
+Usage:
+    python -m tests.fake_telegram_api serve --port 8081
+    TG_BOT_API_URL=http://localhost:8081 TG_BOT_WEBHOOK_URL=http://localhost:8080/webhook TG_BOT_FSM_STORAGE=redis python -m bot --workers 2
+    python -m tests.fake_telegram_api load --webhook http://localhost:8080/webhook --updates 5000
+
+Environment variables:
+    TG_BOT_WEBHOOK_SECRET: Secret token sent with updates, if the bot expects one
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession, web
+
+from bot import setup_logger
+
+LOGGER = setup_logger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_fake_api(latency: float = 0.0, chat_limit: int = 0, global_limit: int = 0) -> web.Application:
+    """
+    :param latency: Seconds every call takes, to imitate the real API.
+    :param chat_limit: Messages a second to a chat before 429, 0 for no limit.
+    :param global_limit: Messages a second to all chats before 429, 0 for no limit.
+    """
+    calls = Counter()
+    message_ids = itertools.count(1)
+    # send times of the last second, per chat and overall
+    sent = {}
+
+    def flooded(key, limit: int) -> bool:
+        now = time.monotonic()
+        times = [t for t in sent.get(key, ()) if now - t < 1]
+        if len(times) >= limit:
+            sent[key] = times
+            return True
+        sent[key] = times + [now]
+        return False
+
+    async def handle_method(request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        calls[method] += 1
+        if latency:
+            await asyncio.sleep(latency)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif method.startswith(('send', 'edit')):
+            chat_id = int(params.get('chat_id', 0))
+            if (chat_limit and flooded(chat_id, chat_limit)) or (global_limit and flooded(None, global_limit)):
+                calls['429'] += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1},
+                })
+            result = {
+                'message_id': next(message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(calls))
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle_method)
+    app.router.add_get('/stats', stats)
+    return app
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}', 'username': f'user{chat_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'username': user['username']},
+            'from': user,
+            'text': random.choice(['/start', '/help', 'hello']),
+        },
+    }
+
+
+async def generate_load(webhook: str, updates: int, chats: int, connections: int, secret: str = None):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    statuses = Counter()
+    update_ids = iter(range(1, updates + 1))
+    latencies = []
+
+    async def post_updates(session: ClientSession):
+        for update_id in update_ids:
+            update = make_update(update_id, chat_id=random.randint(1, chats))
+            started_at = time.perf_counter()
+            try:
+                async with session.post(webhook, json=update, headers=headers) as response:
+                    statuses[response.status] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(post_updates(session) for _ in range(connections)))
+        elapsed = time.perf_counter() - started_at
+
+        latencies.sort()
+        print(f'{updates} updates in {elapsed:.2f}s, {updates / elapsed:.0f} updates/s')
+        print(f'responses: {dict(statuses)}')
+        print(
+            f'response latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, '
+            f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms'
+        )
+
+        # every request may hit another worker, so collect a few /metrics samples
+        url = urlsplit(webhook)
+        metrics = {}
+        for _ in range(connections):
+            async with session.get(f'{url.scheme}://{url.netloc}/metrics') as response:
+                text = await response.text()
+            worker = text.split('worker="', 1)[1].split('"', 1)[0]
+            metrics[worker] = text
+        for worker, text in metrics.items():
+            print(f'--- worker {worker}')
+            print('\n'.join(
+                line for line in text.splitlines()
+                if line.startswith(('chathub_bot_webhook_updates_', 'chathub_bot_send_'))
+                and '_bucket' not in line
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    serve = subparsers.add_parser('serve', help='Run the fake Bot API server')
+    serve.add_argument('--host', default='localhost')
+    serve.add_argument('--port', type=int, default=8081)
+    serve.add_argument('--latency', type=float, default=0.0, help='Seconds every call takes')
+    serve.add_argument('--chat-limit', type=int, default=3, help='Messages a second to a chat')
+    serve.add_argument('--global-limit', type=int, default=30, help='Messages a second to all chats')
+    load = subparsers.add_parser('load', help='Post synthetic updates to the webhook')
+    load.add_argument('--webhook', default='http://localhost:8080/webhook')
+    load.add_argument('--updates', type=int, default=1000)
+    load.add_argument('--chats', type=int, default=100)
+    load.add_argument('--connections', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        web.run_app(
+            create_fake_api(args.latency, args.chat_limit, args.global_limit),
+            host=args.host,
+            port=args.port,
+        )
+    else:
+        asyncio.run(generate_load(
+            args.webhook,
+            args.updates,
+            args.chats,
+            args.connections,
+            secret=os.getenv('TG_BOT_WEBHOOK_SECRET') or None,
+        ))
@@ -18,7 +18,6 @@ Environment variables:
 
 import asyncio
 from datetime import datetime
-import json
 import os
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -27,6 +26,7 @@ from aiogram.enums import ParseMode
 from bot import TG_TOKEN, BotCommands, setup_logger
 from bot.bot import DatingBot
 from bot.utils import escape_markdown_v2 as __
+from chathub_connectors.envelope import Envelope
 
 # Set up logger
 LOGGER = setup_logger(__name__)
@@ -79,30 +79,38 @@ async def send_all_locale_messages():
         )
 
         # 2. Send pre-event rules
-        await bot.send_pre_event_rules(TARGET_USER_ID)
+        await bot.send_pre_event_rules(Envelope(BotCommands.SEND_RULES, headers={"chat_id": TARGET_USER_ID}))
 
         # 3. Send meeting invitation
-        meeting_data = {BotCommands.INVITE_TO_MEETING.value: {"url": "https://example.com/meeting"}}
-        await bot.send_meeting_invitation(json.dumps(meeting_data), {"user_id": TARGET_USER_ID})
+        await bot.send_meeting_invitation(Envelope(
+            BotCommands.INVITE_TO_MEETING, {"url": "https://example.com/meeting"}, {"user_id": TARGET_USER_ID}
+        ))
 
         # 4. Send partner rating request
-        rating_data = {BotCommands.SEND_PARTNER_RATING_REQUEST.value: {"partner_id": "12345"}}
-        await bot.send_partner_rating_request(json.dumps(rating_data), {"user_id": TARGET_USER_ID, "event_id": "1"})
+        await bot.send_partner_rating_request(Envelope(
+            BotCommands.SEND_PARTNER_RATING_REQUEST, {"partner_id": "12345"}, {"user_id": TARGET_USER_ID, "event_id": "1"}
+        ))
 
         # 5. Send final dating message
-        await bot.send_final_dating_message("", {"user_id": TARGET_USER_ID})
+        await bot.send_final_dating_message(Envelope(BotCommands.SEND_FINAL_DATING_MESSAGE, headers={"user_id": TARGET_USER_ID}))
 
         # 6. Send break message
-        await bot.send_break_message("", {"user_id": TARGET_USER_ID})
+        await bot.send_break_message(Envelope(BotCommands.SEND_BREAK_MESSAGE, headers={"user_id": TARGET_USER_ID}))
 
         # 7. Send ready for event request
-        await bot.send_ready_for_event_request("", {"user_id": TARGET_USER_ID, "event_id": "1"})
+        await bot.send_ready_for_event_request(Envelope(
+            BotCommands.SEND_READY_FOR_EVENT_REQUEST, headers={"user_id": TARGET_USER_ID, "event_id": "1"}
+        ))
 
         # 8. Send will take part in event message
-        await bot.send_will_take_part_in_event_message("", {"user_id": TARGET_USER_ID})
+        await bot.send_will_take_part_in_event_message(Envelope(
+            BotCommands.SEND_USER_WILL_TAKE_PART_IN_EVENT, headers={"user_id": TARGET_USER_ID}
+        ))
 
         # 9. Send will not take part in event message
-        await bot.send_will_not_take_part_in_event_message("", {"user_id": TARGET_USER_ID})
+        await bot.send_will_not_take_part_in_event_message(Envelope(
+            BotCommands.SEND_USER_WILL_NOT_TAKE_PART_IN_EVENT, headers={"user_id": TARGET_USER_ID}
+        ))
 
         # Send a completion message
         await bot.send_message(
@@ -0,0 +1,250 @@
+"""
+Unit tests of TokenBucket and SendScheduler.
+
+The scheduler reads time from a fake clock that only moves when a test moves
+it, so what is sent at any moment does not depend on how fast the machine is.
+Steps are powers of two to keep the token arithmetic exact.
+
+Usage (from the chathub_bot directory):
+    BOT_VARIABLES_LOADED=true python -m pytest tests/test_send_scheduler.py
+"""
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from bot.send_scheduler import SendPriority, SendScheduler, TokenBucket
+
+# one token of the global bucket of the tests
+STEP = 1 / 64
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_scheduler(clock: FakeClock, **kwargs) -> SendScheduler:
+    kwargs = dict(dict(global_rate=64, chat_rate=64, chat_burst=1), **kwargs)
+    scheduler = SendScheduler(clock=clock, **kwargs)
+    scheduler.start()
+    return scheduler
+
+
+async def settle():
+    # the scheduler polls a busy global bucket every 1/64s of real time
+    await asyncio.sleep(0.05)
+
+
+async def tick(clock: FakeClock, steps: int = 1):
+    for _ in range(steps):
+        clock.now += STEP
+        await settle()
+
+
+def recorder(sent: list, name, fail_times: int = 0, retry_after: int = 1):
+    attempts = 0
+
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        if attempts <= fail_times:
+            raise TelegramRetryAfter(SendMessage(chat_id=1, text=''), 'Too Many Requests', retry_after)
+        sent.append(name)
+        return name
+    return call
+
+
+class TestTokenBucket:
+    def test_rate_and_capacity(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=4, capacity=2, clock=clock)
+        assert bucket.delay() == 0 and bucket.full
+
+        bucket.take()
+        bucket.take()
+        assert bucket.delay() == 0.25 and not bucket.full
+        clock.now = 0.125
+        assert bucket.delay() == 0.125
+        clock.now = 0.25
+        assert bucket.delay() == 0
+        # saved up tokens do not go over the capacity
+        clock.now = 10
+        bucket.take()
+        bucket.take()
+        assert bucket.delay() == 0.25
+
+    def test_block(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=4, capacity=2, clock=clock)
+        bucket.block(3)
+        # tokens saved up before the block are lost
+        assert bucket.tokens == 0
+        assert bucket.delay() == 3
+        clock.now = 2
+        assert bucket.delay() == 1
+        clock.now = 3
+        assert bucket.delay() == 0 and bucket.full
+
+
+class TestSendScheduler:
+    def test_global_rate(self):
+        clock = FakeClock()
+
+        async def run():
+            scheduler = make_scheduler(clock)
+            sent = []
+            tasks = [asyncio.create_task(scheduler.send(chat, recorder(sent, chat))) for chat in range(20)]
+            await settle()
+            # the global bucket holds a single token, no burst
+            assert len(sent) == 1
+            await tick(clock, 10)
+            assert len(sent) == 11
+            await tick(clock, 9)
+            assert sorted(await asyncio.gather(*tasks)) == list(range(20))
+            await scheduler.close()
+            return sent, scheduler
+
+        sent, scheduler = asyncio.run(run())
+
+        # chats of the same priority are sent to in the order they were queued
+        assert sent == list(range(20))
+        assert scheduler.stats['sent'] == 20 and scheduler.queued == 0
+
+    def test_chat_order(self):
+        clock = FakeClock()
+
+        async def run():
+            scheduler = make_scheduler(clock, chat_rate=16)
+            sent = []
+            in_flight = set()
+
+            def one_at_a_time(chat, no):
+                record = recorder(sent, (chat, no))
+
+                async def call():
+                    assert chat not in in_flight
+                    in_flight.add(chat)
+                    try:
+                        await asyncio.sleep(0.001)
+                        return await record()
+                    finally:
+                        in_flight.discard(chat)
+                return call
+
+            tasks = [
+                asyncio.create_task(scheduler.send(chat, one_at_a_time(chat, no)))
+                for no in range(5) for chat in 'ab'
+            ]
+            await settle()
+            # the chat rate is a quarter of the global one
+            await tick(clock, 4)
+            assert sent == [('a', 0), ('b', 0), ('a', 1)]
+            await tick(clock, 16)
+            await asyncio.gather(*tasks)
+            await scheduler.close()
+            return sent
+
+        sent = asyncio.run(run())
+
+        assert [no for chat, no in sent if chat == 'a'] == list(range(5))
+        assert [no for chat, no in sent if chat == 'b'] == list(range(5))
+
+    def test_priority(self):
+        clock = FakeClock()
+
+        async def run():
+            scheduler = make_scheduler(clock)
+            sent = []
+            # takes the only token
+            await scheduler.send('first', recorder(sent, 'first'))
+            tasks = [
+                asyncio.create_task(scheduler.send(priority.name, recorder(sent, priority), priority))
+                for priority in sorted(SendPriority, reverse=True)
+            ]
+            await settle()
+            assert sent == ['first']
+            for _ in SendPriority:
+                await tick(clock)
+            await asyncio.gather(*tasks)
+            await scheduler.close()
+            return sent
+
+        sent = asyncio.run(run())
+
+        assert sent == ['first'] + sorted(SendPriority)
+
+    def test_retry_after(self):
+        clock = FakeClock()
+
+        async def run():
+            scheduler = make_scheduler(clock)
+            sent = []
+            task = asyncio.create_task(scheduler.send('chat', recorder(sent, 'flooded', fail_times=1)))
+            later = asyncio.create_task(scheduler.send('chat', recorder(sent, 'later')))
+            other = asyncio.create_task(scheduler.send('other', recorder(sent, 'other')))
+            await tick(clock, 2)
+            # the chat is paused, other chats are not
+            assert sent == ['other'] and scheduler.retried == 1
+            await tick(clock, 30)
+            assert sent == ['other']
+            clock.now = 1 + STEP * 2
+            # the pause was scheduled with the real timeout of a second
+            await asyncio.sleep(1.1)
+            await tick(clock, 2)
+            assert await task == 'flooded'
+            await asyncio.gather(later, other)
+            await scheduler.close()
+            return sent, scheduler
+
+        sent, scheduler = asyncio.run(run())
+
+        # the retried message keeps its place before the next one of the chat
+        assert sent == ['other', 'flooded', 'later']
+        assert (scheduler.sent, scheduler.retried, scheduler.failed) == (3, 1, 0)
+
+    def test_max_retries(self):
+        clock = FakeClock()
+
+        async def run():
+            scheduler = make_scheduler(clock, max_retries=0)
+            sent = []
+            with pytest.raises(TelegramRetryAfter):
+                await scheduler.send('chat', recorder(sent, 'flooded', fail_times=1))
+            await scheduler.close()
+            return scheduler
+
+        scheduler = asyncio.run(run())
+
+        assert (scheduler.sent, scheduler.failed, scheduler.queued) == (0, 1, 0)
+
+    def test_max_retries_of_cancelled_send(self):
+        clock = FakeClock()
+
+        async def run():
+            scheduler = make_scheduler(clock, max_retries=0)
+            release = asyncio.Event()
+
+            async def flooded():
+                await release.wait()
+                raise TelegramRetryAfter(SendMessage(chat_id=1, text=''), 'Too Many Requests', 1)
+
+            caller = asyncio.create_task(scheduler.send('chat', flooded))
+            await settle()
+            in_flight = scheduler._in_flight['chat']
+            # the caller stops waiting while the message is in flight
+            caller.cancel()
+            await settle()
+            release.set()
+            await settle()
+            await scheduler.close()
+            return scheduler, in_flight
+
+        scheduler, in_flight = asyncio.run(run())
+
+        assert in_flight.exception() is None
+        assert (scheduler.failed, scheduler.queued) == (1, 0)
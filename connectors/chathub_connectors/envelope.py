@@ -0,0 +1,212 @@
+"""
+Versioned envelope of commands the services send each other.
+
+The command name and the envelope version travel in message headers next to
+the addressing headers (user_id, chat_id, ...), the body is the payload: JSON,
+or msgpack if the sender asked for it. A message is parsed once into an
+`Envelope` and dispatched through a `CommandRegistry`, a dict of handlers by
+command name.
+
+Messages without the command header, sent before the envelope existed, are
+read the old way: the body is a command name or JSON `{command: payload}`.
+
+A batch is one message with the same command for many recipients: the body is
+`{"recipients": [...], "payload": ...}` and `Envelope.expand` turns it into an
+envelope per recipient. Batches have envelope version 2, so readers of version
+1 reject them instead of handling them as a single command.
+
+Example:
+commands = CommandRegistry()
+
+class Service:
+    @commands.register('send_rules')
+    async def send_rules(self, envelope: Envelope):
+        ...
+
+    async def on_message(self, message):
+        await commands.dispatch(self, Envelope.from_message(message.body, message.headers))
+
+body, headers = Envelope('send_rules', {'round': 1}, {'user_id': 1}).encode()
+await connector.publish(body, 'routing_key', 'exchange', headers)
+"""
+import json
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Sequence, Tuple, Union
+
+from chathub_connectors import setup_logger
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depends on environment
+    msgpack = None
+
+LOGGER = setup_logger(__name__)
+
+ENVELOPE_VERSION = 1
+BATCH_ENVELOPE_VERSION = 2
+# the newest version this module reads
+MAX_ENVELOPE_VERSION = BATCH_ENVELOPE_VERSION
+
+COMMAND_HEADER = 'command'
+VERSION_HEADER = 'envelope_version'
+CONTENT_TYPE_HEADER = 'payload_type'
+# number of recipients of a batch
+BATCH_SIZE_HEADER = 'batch_size'
+ENVELOPE_HEADERS = (COMMAND_HEADER, VERSION_HEADER, CONTENT_TYPE_HEADER, BATCH_SIZE_HEADER)
+
+# headers addressing a single recipient of a batch
+RECIPIENT_HEADERS = ('user_id', 'chat_id')
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+class UnknownCommandError(EnvelopeError):
+    pass
+
+
+def _command_name(command: Union[str, Enum]) -> str:
+    return command.value if isinstance(command, Enum) else command
+
+
+class Envelope:
+    """
+    Command, its payload and the headers it was sent with, without the
+    envelope headers. `recipients` is set for batches.
+    """
+    __slots__ = ('command', 'payload', 'headers', 'version', 'recipients')
+
+    def __init__(
+            self,
+            command: Union[str, Enum],
+            payload: Any = None,
+            headers: Optional[Dict[str, Any]] = None,
+            version: Optional[int] = None,
+            recipients: Optional[Sequence[Any]] = None,
+    ):
+        self.command = _command_name(command)
+        self.payload = payload
+        self.headers = headers or {}
+        self.recipients = list(recipients) if recipients is not None else None
+        if version is None:
+            version = ENVELOPE_VERSION if recipients is None else BATCH_ENVELOPE_VERSION
+        self.version = version
+
+    def __repr__(self):
+        batch = f' recipients={len(self.recipients)}' if self.is_batch else ''
+        return f'<Envelope {self.command} v{self.version}{batch} headers={self.headers}>'
+
+    @property
+    def is_batch(self) -> bool:
+        return self.recipients is not None
+
+    def expand(self, recipient_headers: Sequence[str] = RECIPIENT_HEADERS) -> Iterator['Envelope']:
+        """
+        Envelopes of the batch recipients, every one with the batch headers and
+        `recipient_headers` set to the recipient. A single envelope yields itself.
+        """
+        if not self.is_batch:
+            yield self
+            return
+        for recipient in self.recipients:
+            headers = dict(self.headers)
+            headers.update((name, recipient) for name in recipient_headers)
+            yield Envelope(self.command, self.payload, headers, ENVELOPE_VERSION)
+
+    def encode(self, content_type: str = JSON) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        :return: Message body and headers.
+        """
+        content = self.payload
+        if self.is_batch:
+            content = {'recipients': self.recipients, 'payload': self.payload}
+        if content_type == MSGPACK:
+            if msgpack is None:
+                raise EnvelopeError('msgpack payloads need the msgpack package')
+            body = msgpack.packb(content, use_bin_type=True)
+        elif content_type == JSON:
+            body = json.dumps(content).encode()
+        else:
+            raise EnvelopeError(f'Unknown payload type {content_type}')
+        headers = {
+            **self.headers,
+            COMMAND_HEADER: self.command,
+            VERSION_HEADER: self.version,
+            CONTENT_TYPE_HEADER: content_type,
+        }
+        if self.is_batch:
+            headers[BATCH_SIZE_HEADER] = len(self.recipients)
+        return body, headers
+
+    @classmethod
+    def from_message(cls, body: bytes, headers: Optional[Dict[str, Any]] = None) -> 'Envelope':
+        headers = dict(headers or {})
+        command = headers.pop(COMMAND_HEADER, None)
+        if command is None:
+            return cls._from_legacy_message(body, headers)
+
+        version = int(headers.pop(VERSION_HEADER, ENVELOPE_VERSION))
+        if version > MAX_ENVELOPE_VERSION:
+            raise EnvelopeError(f'Envelope version {version} of {command} is not supported')
+        content_type = headers.pop(CONTENT_TYPE_HEADER, JSON)
+        is_batch = headers.pop(BATCH_SIZE_HEADER, None) is not None
+        if not body:
+            payload = None
+        elif content_type == MSGPACK:
+            if msgpack is None:
+                raise EnvelopeError('msgpack payloads need the msgpack package')
+            payload = msgpack.unpackb(body, raw=False)
+        else:
+            payload = json.loads(body)
+        if not is_batch:
+            return cls(command, payload, headers, version)
+        if not isinstance(payload, dict) or 'recipients' not in payload:
+            raise EnvelopeError(f'Batch of {command} has no recipients')
+        return cls(command, payload.get('payload'), headers, version, payload['recipients'])
+
+    @classmethod
+    def _from_legacy_message(cls, body: bytes, headers: Dict[str, Any]) -> 'Envelope':
+        text = body.decode('utf-8').strip()
+        if text.startswith('{'):
+            data = json.loads(text)
+            if len(data) != 1:
+                raise EnvelopeError(f'Cannot find the command in message {text[:100]}')
+            command, payload = next(iter(data.items()))
+            return cls(command, payload, headers, version=0)
+        return cls(text, None, headers, version=0)
+
+
+class CommandRegistry:
+    """
+    Handlers by command name. Handlers are methods: `dispatch` calls them with
+    the object handling the message, the envelope and the extra arguments.
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, Callable[..., Awaitable]] = {}
+
+    def __contains__(self, command: Union[str, Enum]) -> bool:
+        return _command_name(command) in self.handlers
+
+    def register(self, *commands: Union[str, Enum]):
+        def decorator(handler):
+            for command in commands:
+                name = _command_name(command)
+                if name in self.handlers:
+                    raise ValueError(f'Command {name} is already handled by {self.handlers[name]}')
+                self.handlers[name] = handler
+            return handler
+        return decorator
+
+    def get(self, command: Union[str, Enum]) -> Callable[..., Awaitable]:
+        try:
+            return self.handlers[_command_name(command)]
+        except KeyError:
+            raise UnknownCommandError(f'Cannot process command {str(command)[:100]}') from None
+
+    async def dispatch(self, owner: Any, envelope: Envelope, *args, **kwargs):
+        return await self.get(envelope.command)(owner, envelope, *args, **kwargs)
@@ -0,0 +1,181 @@
+"""
+In-process read-through cache in front of AsyncPgConnector.
+
+Interactive services (the bot) read the same user profile on every menu step.
+`CachedPgConnector` serves such reads from memory for `ttl` seconds and drops
+cached rows on writes made through it. Writes made by other services become
+visible when the entry expires.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from chathub_connectors import setup_logger
+from chathub_connectors.postgres_connector import AsyncPgConnector
+from chathub_connectors.postgres_statements import EventRow, UserRow
+
+LOGGER = setup_logger(__name__)
+
+
+class AsyncTTLCache:
+    """
+    LRU cache with entries expiring after `ttl` seconds.
+
+    Concurrent misses of the same key share one load, the callers waiting for
+    it are counted as coalesced. A load that was running while its key got
+    invalidated is returned to its callers but not cached, callers coming after
+    the invalidation start a new load. None is not cached
+    either: a missing row may be created by another service at any moment.
+    """
+
+    def __init__(
+            self,
+            max_size: int = 1000,
+            ttl: float = 60,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+        }
+
+    async def get_or_load(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        if key in self._loading:
+            # another caller is loading the key right now
+            self.coalesced += 1
+            return await asyncio.shield(self._loading[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await load()
+        except BaseException as e:
+            future.set_exception(e)
+            # the exception is delivered to the waiting callers only
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            # the load was not invalidated
+            if value is not None and self._loading.get(key) is future:
+                self._set(key, value)
+            return value
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+        # callers already waiting get the old value, later ones load again
+        self._loading.pop(key, None)
+
+    def clear(self):
+        for key in list(self._entries) + list(self._loading):
+            self.invalidate(key)
+
+    def _set(self, key: Hashable, value: Any):
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class CachedPgConnector(AsyncPgConnector):
+    """
+    AsyncPgConnector with users and single events cached in memory.
+
+    Example:
+    pg = CachedPgConnector(host='localhost', db='chathub', users_ttl=60)
+    await pg.connect()
+    user = await pg.get_user(1)  # reads postgres
+    user = await pg.get_user(1)  # served from memory
+    await pg.update_user(1, city='Moscow')  # drops the cached user
+    """
+
+    def __init__(
+            self,
+            *args,
+            users_ttl: float = 60,
+            events_ttl: float = 30,
+            max_size: int = 10000,
+            **kwargs,
+    ):
+        """
+        :param users_ttl: Seconds a user profile is served from memory.
+        :param events_ttl: Seconds an event is served from memory. Registrations
+                    are made by datemaker, so events are cached for a shorter time.
+        :param max_size: Max cached users and events, each.
+        Other parameters are the same as in AsyncPgConnector.
+        """
+        super().__init__(*args, **kwargs)
+        self.users_cache = AsyncTTLCache(max_size=max_size, ttl=users_ttl)
+        self.events_cache = AsyncTTLCache(max_size=max_size, ttl=events_ttl)
+
+    @property
+    def cache_stats(self) -> dict:
+        return {
+            'users': self.users_cache.stats,
+            'events': self.events_cache.stats,
+        }
+
+    async def get_user(self, user_id: int) -> Optional[UserRow]:
+        return await self.users_cache.get_or_load(
+            user_id, lambda: super(CachedPgConnector, self).get_user(user_id)
+        )
+
+    async def get_dating_event(self, event_id: int, timezone='UTC') -> Optional[EventRow]:
+        return await self.events_cache.get_or_load(
+            (event_id, str(timezone)),
+            lambda: super(CachedPgConnector, self).get_dating_event(event_id, timezone),
+        )
+
+    async def add_user(self, user_id: int, *args, **kwargs):
+        try:
+            await super().add_user(user_id, *args, **kwargs)
+        finally:
+            # the user may be being loaded right now
+            self.users_cache.invalidate(user_id)
+
+    async def update_user(self, user_id: int, *args, **kwargs):
+        try:
+            await super().update_user(user_id, *args, **kwargs)
+        finally:
+            self.users_cache.invalidate(user_id)
+
+    async def set_event_state(self, event_id: int, state_id: int):
+        try:
+            await super().set_event_state(event_id, state_id)
+        finally:
+            # entries are keyed by event and timezone
+            self.events_cache.clear()
@@ -1,7 +1,7 @@
 import asyncio
 from asyncio import AbstractEventLoop
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Callable, Dict
 
 import asyncpg
 import psycopg2
@@ -10,6 +10,12 @@ from psycopg2 import Error
 from psycopg2.extras import RealDictCursor, RealDictRow
 
 from chathub_connectors import setup_logger
+from chathub_connectors.postgres_statements import (
+    STATEMENTS,
+    EventRow,
+    RegistrationRow,
+    UserRow,
+)
 
 LOGGER = setup_logger(__name__)
 LOGGER.warning(f'Logger {LOGGER} is active')
@@ -26,7 +32,8 @@ class OptionalQueryParamIterator:
     def __next__(self):
         if self.current > self.max:
             raise StopIteration
-        return self.current
+        self.current += 1
+        return self.current - 1
 
 
 class AsyncPgConnector:
@@ -45,6 +52,10 @@ class AsyncPgConnector:
         self._password = password
         self.pool: Optional[asyncpg.pool.Pool] = None
         self.loop: Optional[AbstractEventLoop] = None
+        # LISTEN/NOTIFY needs a connection that stays out of the pool
+        self._listen_connection: Optional[asyncpg.Connection] = None
+        self._listeners: Dict[str, List[Callable[[str], None]]] = {}
+        self.listen_reconnect_delay = 5
         LOGGER.info('Async PG connector initialized')
 
     async def connect(self, custom_loop: asyncio.AbstractEventLoop = None):
@@ -61,21 +72,57 @@ class AsyncPgConnector:
             user=self._username,
             password=self._password,
             timeout=10,
-            loop=self.loop
+            loop=self.loop,
+            # statements prepared by their first run are kept for the connection lifetime
+            max_cached_statement_lifetime=0,
         )
         LOGGER.info(f'PG connected to {self._host}:{self._port}/{self._db}')
 
-    async def get_user(self, user_id: int) -> Optional[Record]:
+    async def _run_statement(self, name: str, method: str, *args):
+        """
+        Runs a statement of `postgres_statements.STATEMENTS`, prepared on the
+        pool connection by its first run.
+
+        :param method: Connection method: fetch, fetchrow, fetchval or execute.
+        """
+        async with self.pool.acquire() as conn:
+            return await getattr(conn, method)(STATEMENTS[name], *args)
+
+    async def get_user(self, user_id: int) -> Optional[UserRow]:
         """
         :param user_id: ID of the user to fetch.
         :return: The user data fetched from the database.
         """
-        request_query = 'SELECT * FROM users WHERE id = $1;'
-        async with self.pool.acquire() as conn:
-            data = await conn.fetchrow(request_query, user_id)
+        record = await self._run_statement('get_user', 'fetchrow', user_id)
+        data = UserRow.from_record(record) if record else None
         LOGGER.debug(f'User found: {data}')
         return data
 
+    async def get_users(self, user_ids: List[int]) -> List[Record]:
+        """
+        Bulk version of `get_user` for matchmaking: one round trip and only
+        the profile columns matchmaking uses.
+
+        :param user_ids: IDs of the users to fetch.
+        :return: Found users, in no particular order.
+        """
+        data = await self._run_statement('get_users', 'fetch', list(user_ids))
+        LOGGER.debug(f'Found {len(data)} of {len(user_ids)} requested users')
+        return data
+
+    async def get_confirmed_event_users(self, event_id: int) -> List[Record]:
+        """
+        Users who confirmed registration for the event, joined with their
+        registration data, in the shape matchmaking consumes.
+
+        :param event_id: ID of the event.
+        :return: Records with user_id, birthday, sex, city, rating, manual_score,
+                 registered_on_dttm and confirmed_on_dttm.
+        """
+        data = await self._run_statement('get_confirmed_event_users', 'fetch', event_id)
+        LOGGER.debug(f'Found {len(data)} confirmed users for event#{event_id}')
+        return data
+
     async def add_user(
         self,
         user_id: int,
@@ -256,9 +303,7 @@ class AsyncPgConnector:
         :param owner_id: ID of the owner to fetch images for.
         :return: A list of images belonging to the specified owner.
         """
-        request_query = 'SELECT * FROM images WHERE owner = $1 ORDER BY upload_dttm DESC;'
-        async with self.pool.acquire() as conn:
-            data = await conn.fetch(request_query, owner_id)
+        data = await self._run_statement('get_images_by_owner', 'fetch', owner_id)
         LOGGER.debug(f'Found {len(data)} images for owner {owner_id}')
         return data
 
@@ -269,7 +314,7 @@ class AsyncPgConnector:
             limit: int = 10,
             timezone='UTC',
             event_id: int = None,
-    ) -> List[Record]:
+    ) -> List[EventRow]:
         """
         List Dating Events
 
@@ -286,54 +331,144 @@ class AsyncPgConnector:
         param = OptionalQueryParamIterator()
         user_id = user.get("id") if user else None
         only_finished = 'AND start_dttm > NOW()' if not include_finished else ''
-        for_user = f'WHERE user_id = ${next(param)}' if user else ''
+        for_user = f'AND r.user_id = ${next(param)}' if user else ''
         specific_event = f'AND e.id = ${next(param)}' if event_id else ''
         limit = f'LIMIT {limit}'
+        # registrations are looked up per listed event instead of joining all of them
         request_query = f"""
-            SELECT DISTINCT 
+            SELECT
                 e.id,
                 e.start_dttm at time zone '{timezone}' as start_dttm,
-                CASE WHEN r.user_id IS NOT NULL THEN TRUE ELSE FALSE END AS registered,
+                EXISTS (
+                    SELECT 1
+                    FROM public.dating_registrations AS r
+                    WHERE r.event_id = e.id
+                        {for_user}
+                ) AS registered,
                 users_limit
             FROM public.dating_events as e
-            LEFT JOIN (
-                SELECT *
-                FROM public.dating_registrations
-                {for_user}
-            ) AS r ON e.id = r.event_id
             WHERE 1=1
                 {only_finished}
                 {specific_event}
-            ORDER BY start_dttm ASC
+            ORDER BY e.start_dttm ASC
             {limit}
             ;
         """
         async with self.pool.acquire() as conn:
-            data = await conn.fetch(request_query, *(
+            data = EventRow.from_records(await conn.fetch(request_query, *(
                 param for param in (
                     user_id,
                     event_id
             ) if param is not None
-            ))
+            )))
         LOGGER.debug(f'Found {len(data)} dating events')
         return data
 
+    async def get_dating_event(self, event_id: int, timezone='UTC') -> Optional[EventRow]:
+        """
+        Single event by ID, finished or not.
+
+        :param event_id: ID of the event.
+        :param timezone: Timezone to display time in.
+        :return: The event or None if there is no such event.
+        """
+        events = await self.get_dating_events(
+            include_finished=True, limit=1, timezone=timezone, event_id=event_id
+        )
+        return events[0] if events else None
+
+    async def get_scheduled_events(self, timezone='UTC') -> List[EventRow]:
+        """
+        All upcoming events which still wait for a service transition:
+        registration confirmation (not started) or the event start (ready).
+
+        :param timezone: Timezone to display time in.
+        :return: Events with id, start_dttm and state_name.
+        """
+        data = EventRow.from_records(
+            await self._run_statement('get_scheduled_events', 'fetch', str(timezone))
+        )
+        LOGGER.debug(f'Found {len(data)} scheduled dating events')
+        return data
+
+    async def listen(self, channel: str, callback: Callable[[str], None]):
+        """
+        Subscribe to NOTIFY messages of a channel. Notifications are received on
+        a dedicated connection, which is re-opened with all subscriptions if
+        it gets lost. Notifications sent while it is lost are not delivered.
+        A channel can have many subscribers.
+
+        :param channel: Channel name.
+        :param callback: Called with notification payload.
+        """
+        callbacks = self._listeners.setdefault(channel, [])
+        callbacks.append(callback)
+        if self._listen_connection is None or self._listen_connection.is_closed():
+            await self._open_listen_connection()
+        elif len(callbacks) == 1:
+            await self._add_listener(channel)
+
+    async def unlisten(self, channel: str, callback: Callable[[str], None]):
+        """
+        Remove a subscription added with `listen`.
+        """
+        callbacks = self._listeners.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks and self._listeners.pop(channel, None) is not None:
+            if self._listen_connection and not self._listen_connection.is_closed():
+                await self._listen_connection.remove_listener(channel, self._notify_listeners)
+            LOGGER.info(f'Stopped listening to PG channel {channel}')
+
+    async def _open_listen_connection(self):
+        self._listen_connection = await asyncpg.connect(
+            host=self._host,
+            port=self._port,
+            database=self._db,
+            user=self._username,
+            password=self._password,
+            timeout=10,
+        )
+        self._listen_connection.add_termination_listener(self._on_listen_connection_lost)
+        for channel in self._listeners:
+            await self._add_listener(channel)
+
+    async def _add_listener(self, channel: str):
+        await self._listen_connection.add_listener(channel, self._notify_listeners)
+        LOGGER.info(f'Listening to PG channel {channel}')
+
+    def _notify_listeners(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str):
+        for callback in list(self._listeners.get(channel, [])):
+            try:
+                callback(payload)
+            except Exception as e:
+                LOGGER.error(f'Failed to handle notification on {channel} ({payload}): {e}')
+
+    def _on_listen_connection_lost(self, connection: asyncpg.Connection):
+        LOGGER.warning('PG listening connection lost, reconnecting')
+        (self.loop or asyncio.get_event_loop()).create_task(self._reconnect_listen_connection())
+
+    async def _reconnect_listen_connection(self):
+        while True:
+            await asyncio.sleep(self.listen_reconnect_delay)
+            try:
+                await self._open_listen_connection()
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                LOGGER.warning(f'Failed to reconnect PG listening connection: {e}')
+
     async def get_event_registrations(
             self,
             event_id: int
-    ) -> List[Record]:
+    ) -> List[RegistrationRow]:
         """
         List Event Registrations.
         :param event_id:
         :return:
         """
-        request_query = """
-            SELECT user_id, registered_on_dttm, confirmed_on_dttm, confirmation_event_sent
-            FROM public.dating_registrations
-            WHERE event_id = $1;
-        """
-        async with self.pool.acquire() as conn:
-            data = await conn.fetch(request_query, event_id)
+        data = RegistrationRow.from_records(
+            await self._run_statement('get_event_registrations', 'fetch', event_id)
+        )
         LOGGER.debug(f'Found {len(data)} event registrations')
         return data
 
@@ -342,13 +477,7 @@ class AsyncPgConnector:
             event_id: int,
             user_ids: list
     ):
-        request_query = """
-            UPDATE public.dating_registrations
-            SET confirmation_event_sent = TRUE
-            WHERE user_id = ANY($1) AND event_id = $2;
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(request_query, user_ids, event_id)
+        await self._run_statement('save_event_confirmation_sent', 'execute', user_ids, event_id)
         LOGGER.debug(f'Event confirmation sending saved for event#{event_id} for users {user_ids}')
 
     async def get_event_participants(
@@ -368,6 +497,7 @@ class AsyncPgConnector:
                 JOIN event_group_participants AS p
                     ON e.id = p.event_id
                     AND e.users_limit = p.participants
+                WHERE e.id = $1
             ),
             uids AS (
                 SELECT user_1_id, user_2_id
@@ -393,65 +523,90 @@ class AsyncPgConnector:
             self,
             user: Record,
             event_id: int
-    ):
+    ) -> bool:
         """
         Method for adding new member to event.
-        Remember to check if user already registered!
+        Does nothing if the user is already registered.
 
         :param user:
         :param event_id:
-        :return:
+        :return: True if the user was registered by this call.
         """
-        request_query = """
-            INSERT INTO public.dating_registrations (user_id, event_id)
-            VALUES ($1, $2);
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                request_query, user.get('id'), event_id
-            )
-        LOGGER.debug(f'User {user.get("id")} registered for event {event_id}')
+        registered = await self._run_statement(
+            'register_for_event', 'fetchval', user.get('id'), event_id
+        )
+        LOGGER.debug(
+            f'User {user.get("id")} registered for event {event_id}: {registered is not None}'
+        )
+        return registered is not None
 
-    async def confirm_registration(self, user: Record, event_id: int):
+    async def confirm_registration(self, user: Record, event_id: int) -> bool:
         """
         Method for registration confirmation.
+        Confirmation time of an already confirmed registration is kept.
 
         :param user:
         :param event_id:
-        :return:
+        :return: True if the user is registered for the event.
         """
-        request_query = """
-            UPDATE public.dating_registrations
-            SET confirmed_on_dttm = NOW()
-            WHERE user_id = $1 AND event_id = $2;
+        confirmed = await self._run_statement(
+            'confirm_registration', 'fetchval', user.get('id'), event_id
+        )
+        LOGGER.debug(
+            f'User {user.get("id")} confirmed registration for event {event_id}: '
+            f'{confirmed is not None}'
+        )
+        return confirmed is not None
+
+    async def cancel_registration(self, user: Record, event_id: int) -> bool:
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                request_query, user.get('id'), event_id
-            )
-        LOGGER.debug(f'User {user.get("id")} confirmed registration for event {event_id}')
+        Method for registration cancellation.
 
-    async def set_event_state(self, event_id: int, state_id: int):
-        request_query = """
-            UPDATE public.dating_events
-            SET state_id = $2
-            WHERE id = $1;
+        :param user:
+        :param event_id:
+        :return: True if the user was registered for the event.
         """
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                request_query, event_id, state_id
-            )
+        cancelled = await self._run_statement(
+            'cancel_registration', 'fetchval', user.get('id'), event_id
+        )
+        LOGGER.debug(
+            f'User {user.get("id")} cancelled registration for event {event_id}: '
+            f'{cancelled is not None}'
+        )
+        return cancelled is not None
+
+    async def get_event_registrations_for_user(self, user: Record) -> List[Record]:
+        data = await self._run_statement(
+            'get_event_registrations_for_user', 'fetch', user.get('id')
+        )
+        LOGGER.debug(f'Found {len(data)} event registrations for user {user.get("id")}')
+        return data
+
+    async def set_event_state(self, event_id: int, state_id: int):
+        await self._run_statement('set_event_state', 'execute', event_id, state_id)
         LOGGER.debug(f'Event state for event {event_id} set to {state_id}')
 
-    async def put_event_data(self, data):
-        request_query = """
-            INSERT INTO public.dating_event_groups 
-            (event_id, group_no, turn_no, user_1_id, user_2_id)
-            VALUES ($1, $2, $3, $4, $5);
+    async def put_event_data(self, data) -> int:
         """
+        Writes pairs of event groups with COPY in a single transaction,
+        so either all groups of the event are stored or none.
+
+        :param data: Iterable of (event_id, group_no, turn_no, user_1_id, user_2_id).
+        :return: Number of inserted rows.
+        """
+        records = list(data)
         async with self.pool.acquire() as conn:
-            await conn.executemany(request_query, data)
-        LOGGER.debug(f'Inserted event groups')
+            async with conn.transaction():
+                status = await conn.copy_records_to_table(
+                    'dating_event_groups',
+                    schema_name='public',
+                    columns=['event_id', 'group_no', 'turn_no', 'user_1_id', 'user_2_id'],
+                    records=records,
+                )
+        # status is a command tag, e.g. "COPY 42"
+        inserted = int(status.split()[-1])
+        LOGGER.debug(f'Inserted {inserted} event groups rows')
+        return inserted
 
     async def get_event_data(self, event_id: int):
         request_query = """
@@ -467,6 +622,7 @@ class AsyncPgConnector:
                 JOIN event_group_participants AS p
                     ON e.id = p.event_id
                     AND e.users_limit = p.participants
+                WHERE e.id = $1
             )
             SELECT deg.group_no, turn_no, user_1_id, user_2_id
             FROM public.dating_event_groups AS deg
@@ -480,69 +636,60 @@ class AsyncPgConnector:
         return data
 
     async def set_user_ready_to_start(self, user_id: int, event_id: int):
-        request_query = """
-            UPDATE public.dating_registrations
-            SET is_ready = TRUE
-            WHERE user_id = $1 AND event_id = $2;
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                request_query, user_id, event_id
-            )
+        await self._run_statement('set_user_ready_to_start', 'execute', user_id, event_id)
         LOGGER.debug(f'User {user_id} set to ready for event {event_id}')
 
     async def are_all_event_users_ready(self, event_id: int):
-        request_query = """
-            select sum(case when is_ready then 1 else 0 end)/count(*) = 1.0 as all_ready
-            from dating_registrations
-            where event_id = $1;
-        """
-        async with self.pool.acquire() as conn:
-            data = await conn.fetchrow(request_query, event_id)
+        data = await self._run_statement('are_all_event_users_ready', 'fetchrow', event_id)
         LOGGER.debug(f'Are all event users ready for event#{event_id}: {data.get("all_ready")}')
         return data.get('all_ready')
 
     async def save_user_like(self, source_user_id: int, target_user_id: int, event_id: int):
-        request_query = """
-            INSERT INTO public.likes (source_user_id, target_user_id, event_id)
-            VALUES ($1, $2, $3);
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(request_query, source_user_id, target_user_id, event_id)
+        await self._run_statement(
+            'save_user_like', 'execute', source_user_id, target_user_id, event_id
+        )
         LOGGER.debug(f'User {source_user_id} likes user {target_user_id} in event {event_id}')
 
     async def save_user_dislike(self, source_user_id: int, target_user_id: int, event_id: int):
-        request_query = """
-            INSERT INTO public.dislikes (source_user_id, target_user_id, event_id)
-            VALUES ($1, $2, $3);
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(request_query, source_user_id, target_user_id, event_id)
+        await self._run_statement(
+            'save_user_dislike', 'execute', source_user_id, target_user_id, event_id
+        )
         LOGGER.debug(f'User {source_user_id} dislikes user {target_user_id} in event {event_id}')
 
     async def save_user_report(self, source_user_id: int, target_user_id: int, event_id: int):
-        request_query = """
-            INSERT INTO public.reports (source_user_id, target_user_id, event_id)
-            VALUES ($1, $2, $3);
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(request_query, source_user_id, target_user_id, event_id)
+        await self._run_statement(
+            'save_user_report', 'execute', source_user_id, target_user_id, event_id
+        )
         LOGGER.debug(f'User {source_user_id} reports user {target_user_id} in event {event_id}')
 
+    async def compute_event_matches(self, event_id: int) -> int:
+        """
+        Writes mutual likes of the event into `event_matches`, so participants'
+        matches are read by index instead of joining likes for every user.
+        Safe to run again, already saved matches are kept.
+
+        :param event_id: ID of the finished event.
+        :return: Number of new matches, every pair is counted for both users.
+        """
+        inserted = await self._run_statement('compute_event_matches', 'fetchval', event_id)
+        LOGGER.debug(f'Saved {inserted} matches for event#{event_id}')
+        return inserted
+
     async def get_user_matches(self, user_id: int, event_id: int):
-        request_query = """
-            SELECT user_1_id, user_2_id, username, name
-            FROM public.matches
-            INNER JOIN users ON users.id = matches.user_2_id
-            WHERE user_1_id = $1 AND event_id = $2;
         """
-        async with self.pool.acquire() as conn:
-            data = await conn.fetch(request_query, user_id, event_id)
+        Matches of the user saved by `compute_event_matches`.
+        """
+        data = await self._run_statement('get_user_matches', 'fetch', user_id, event_id)
         LOGGER.debug(f'Fetched {len(data)} user matches for user {user_id} in event {event_id}')
         return data
 
     def __del__(self):
         loop = self.loop or asyncio.new_event_loop()
+        if self._listen_connection and not self._listen_connection.is_closed():
+            self._listen_connection.remove_termination_listener(
+                self._on_listen_connection_lost
+            )
+            self._listen_connection.terminate()
         if self.pool:
             try:
                 close_task = loop.create_task(self.pool.terminate())
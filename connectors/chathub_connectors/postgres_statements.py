@@ -0,0 +1,236 @@
+"""
+Prepared statements and row types of AsyncPgConnector.
+
+Statements of `STATEMENTS` have a static text, so asyncpg prepares every one of
+them the first time it runs on a connection and keeps it in the statement
+cache of the connection for the connection lifetime: hot calls skip parsing
+and planning, and a service only prepares the statements it runs. Statements
+whose text depends on arguments (e.g. `get_dating_events`) stay out of the
+registry, asyncpg caches their variants by text.
+
+Rows of users, events and registrations come back as `__slots__` objects which
+keep the read API of asyncpg records: `row['id']`, `row.get('id')`, `dict(row)`.
+"""
+from typing import Any, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+from chathub_connectors import setup_logger
+
+LOGGER = setup_logger(__name__)
+
+
+class Row:
+    """
+    Base row type: fields are `__slots__`, filled by name from a record.
+    Columns the statement does not select are None, extra ones are ignored.
+    """
+    __slots__ = ()
+    # rows are mutable like dicts
+    __hash__ = None
+
+    def __init__(self, **fields):
+        unknown = fields.keys() - set(self.__slots__)
+        if unknown:
+            raise TypeError(f'{type(self).__name__} has no fields {sorted(unknown)}')
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_record(cls, record: Mapping[str, Any]) -> 'Row':
+        """
+        :param record: asyncpg record or any mapping of column names.
+        """
+        row = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(row, name, record.get(name))
+        return row
+
+    @classmethod
+    def from_records(cls, records: Sequence[Mapping[str, Any]]) -> list:
+        return [cls.from_record(record) for record in records]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self.__slots__:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+    def values(self) -> List[Any]:
+        return [getattr(self, name) for name in self.__slots__]
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return list(zip(self.__slots__, self.values()))
+
+    def __iter__(self) -> Iterator[Any]:
+        # like asyncpg records, iteration goes over values
+        return iter(self.values())
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __repr__(self) -> str:
+        fields = ' '.join(f'{name}={value!r}' for name, value in self.items())
+        return f'<{type(self).__name__} {fields}>'
+
+
+class UserRow(Row):
+    __slots__ = (
+        'id',
+        'username',
+        'password_hash',
+        'bio',
+        'birthday',
+        'sex',
+        'name',
+        'city',
+        'rating',
+        'manual_score',
+    )
+
+
+class EventRow(Row):
+    __slots__ = ('id', 'start_dttm', 'state_name', 'registered', 'users_limit')
+
+
+class RegistrationRow(Row):
+    __slots__ = ('user_id', 'registered_on_dttm', 'confirmed_on_dttm', 'confirmation_event_sent')
+
+
+USER_COLUMNS = ', '.join(UserRow.__slots__)
+
+STATEMENTS: Dict[str, str] = {
+    'get_user': f"""
+        SELECT {USER_COLUMNS}
+        FROM public.users
+        WHERE id = $1;
+    """,
+    'get_users': """
+        SELECT id, birthday, sex, city, rating, manual_score
+        FROM public.users
+        WHERE id = ANY($1);
+    """,
+    'get_confirmed_event_users': """
+        SELECT
+            u.id AS user_id,
+            u.birthday,
+            u.sex,
+            u.city,
+            u.rating,
+            u.manual_score,
+            r.registered_on_dttm,
+            r.confirmed_on_dttm
+        FROM public.dating_registrations AS r
+        JOIN public.users AS u ON u.id = r.user_id
+        WHERE r.event_id = $1
+            AND r.confirmed_on_dttm IS NOT NULL;
+    """,
+    'get_images_by_owner': """
+        SELECT *
+        FROM public.images
+        WHERE owner = $1
+        ORDER BY upload_dttm DESC;
+    """,
+    'get_scheduled_events': """
+        SELECT
+            e.id,
+            e.start_dttm AT TIME ZONE $1 AS start_dttm,
+            s.state_name,
+            NULL::BOOL AS registered,
+            e.users_limit
+        FROM public.dating_events AS e
+        JOIN public.event_states AS s ON e.state_id = s.id
+        WHERE e.start_dttm > NOW()
+            AND s.state_name IN ('NOT_STARTED', 'READY')
+        ORDER BY e.start_dttm ASC;
+    """,
+    'get_event_registrations': """
+        SELECT user_id, registered_on_dttm, confirmed_on_dttm, confirmation_event_sent
+        FROM public.dating_registrations
+        WHERE event_id = $1;
+    """,
+    'save_event_confirmation_sent': """
+        UPDATE public.dating_registrations
+        SET confirmation_event_sent = TRUE
+        WHERE user_id = ANY($1) AND event_id = $2;
+    """,
+    'register_for_event': """
+        INSERT INTO public.dating_registrations (user_id, event_id)
+        VALUES ($1, $2)
+        ON CONFLICT (event_id, user_id) DO NOTHING
+        RETURNING user_id;
+    """,
+    'confirm_registration': """
+        UPDATE public.dating_registrations
+        SET confirmed_on_dttm = COALESCE(confirmed_on_dttm, NOW())
+        WHERE user_id = $1 AND event_id = $2
+        RETURNING user_id;
+    """,
+    'cancel_registration': """
+        DELETE FROM public.dating_registrations
+        WHERE user_id = $1 AND event_id = $2
+        RETURNING user_id;
+    """,
+    'get_event_registrations_for_user': """
+        SELECT DISTINCT event_id
+        FROM public.dating_registrations
+        WHERE user_id = $1;
+    """,
+    'set_event_state': """
+        UPDATE public.dating_events
+        SET state_id = $2
+        WHERE id = $1;
+    """,
+    'set_user_ready_to_start': """
+        UPDATE public.dating_registrations
+        SET is_ready = TRUE
+        WHERE user_id = $1 AND event_id = $2;
+    """,
+    'are_all_event_users_ready': """
+        SELECT sum(CASE WHEN is_ready THEN 1 ELSE 0 END) / count(*) = 1.0 AS all_ready
+        FROM public.dating_registrations
+        WHERE event_id = $1;
+    """,
+    'save_user_like': """
+        INSERT INTO public.likes (source_user_id, target_user_id, event_id)
+        VALUES ($1, $2, $3);
+    """,
+    'save_user_dislike': """
+        INSERT INTO public.dislikes (source_user_id, target_user_id, event_id)
+        VALUES ($1, $2, $3);
+    """,
+    'save_user_report': """
+        INSERT INTO public.reports (source_user_id, target_user_id, event_id)
+        VALUES ($1, $2, $3);
+    """,
+    'compute_event_matches': """
+        WITH inserted AS (
+            INSERT INTO public.event_matches (event_id, user_1_id, user_2_id)
+            SELECT DISTINCT t1.event_id, t1.source_user_id, t2.source_user_id
+            FROM public.likes AS t1
+            JOIN public.likes AS t2
+                ON t2.event_id = t1.event_id
+                AND t2.source_user_id = t1.target_user_id
+                AND t2.target_user_id = t1.source_user_id
+            WHERE t1.event_id = $1
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        )
+        SELECT count(*) FROM inserted;
+    """,
+    'get_user_matches': """
+        SELECT m.user_1_id, m.user_2_id, u.username, u.name
+        FROM public.event_matches AS m
+        JOIN public.users AS u ON u.id = m.user_2_id
+        WHERE m.event_id = $2 AND m.user_1_id = $1;
+    """,
+}
+
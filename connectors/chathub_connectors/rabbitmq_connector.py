@@ -1,10 +1,14 @@
 import asyncio
+import functools
 import logging
-from typing import Optional, Callable
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Callable, Dict, Iterable, List, Tuple, Hashable, Awaitable, Union
 
 import aio_pika
 from aio_pika.abc import AbstractRobustChannel, AbstractRobustConnection, AbstractExchange, \
-    HeadersType
+    HeadersType, AbstractIncomingMessage, AbstractQueue
 from pika import PlainCredentials, ConnectionParameters
 from pika.adapters.asyncio_connection import AsyncioConnection
 from pika.spec import BasicProperties
@@ -19,6 +23,13 @@ class ConnectionFailedException(Exception):
     pass
 
 
+class RpcCallDropped(Exception):
+    """
+    The call was dropped from the pending calls, because too many calls
+    were waiting for replies.
+    """
+
+
 class RabbitMQConnector:
     """
     This class provides a connector to the RabbitMQ server for asynchronous messaging.
@@ -189,7 +200,153 @@ class RabbitMQConnector:
         LOGGER.debug(f'Processed message by default method: {body.decode()}')
 
 
+# text or already encoded, e.g. by chathub_connectors.envelope.Envelope
+Body = Union[str, bytes]
+# message body, routing key, exchange and headers of a published message
+PublishedMessage = Tuple[Body, str, str, Optional[HeadersType]]
+
+
+def _body(message: Body) -> bytes:
+    return message if isinstance(message, bytes) else message.encode()
+
+
+class OrderedConcurrentProcessor:
+    """
+    Consumer callback that processes messages concurrently, at most `concurrency`
+    at once, while messages with the same key (e.g. user id) are processed one
+    after another in the order they were received.
+
+    The wrapped callback acks or rejects messages itself, so the channel prefetch
+    should be at least `concurrency`, otherwise the broker never delivers enough
+    messages to fill it.
+
+    Example:
+    processor = OrderedConcurrentProcessor(
+        process_message,
+        key=lambda message: message.headers.get('user_id'),
+        concurrency=20,
+    )
+    await connector.listen_queue('queue', processor, prefetch_count=40)
+    """
+
+    def __init__(
+            self,
+            callback: Callable[[AbstractIncomingMessage], Awaitable],
+            key: Callable[[AbstractIncomingMessage], Hashable],
+            concurrency: int = 10,
+            observe: Optional[Callable[[float, float], None]] = None,
+    ):
+        """
+        :param observe: Called for every processed message with the seconds it
+                    waited since it was received and the seconds it took to process.
+        """
+        self.callback = callback
+        self.key = key
+        self.concurrency = concurrency
+        self.observe = observe
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # the last received message task of every key
+        self._tails: Dict[Hashable, asyncio.Task] = {}
+        # stats
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.received = 0
+
+    @property
+    def waiting(self) -> int:
+        """
+        Messages received and not processed yet, including ones in flight.
+        """
+        return self.received - self.processed - self.failed
+
+    @property
+    def active_keys(self) -> int:
+        return len(self._tails)
+
+    async def __call__(self, message: AbstractIncomingMessage):
+        key = self.key(message)
+        previous = self._tails.get(key)
+        task = asyncio.ensure_future(self._process(message, previous, time.monotonic()))
+        self._tails[key] = task
+        task.add_done_callback(lambda done: self._release_key(key, done))
+        self.received += 1
+
+    async def join(self):
+        """
+        Wait until all received messages are processed.
+        """
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+    async def _process(
+            self,
+            message: AbstractIncomingMessage,
+            previous: Optional[asyncio.Task],
+            received_at: float,
+    ):
+        if previous is not None:
+            # wait for the previous message of the key, whatever its result is
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            started_at = time.monotonic()
+            try:
+                await self.callback(message)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                LOGGER.error(f'Failed to process message {message.body[:100]}: {e}')
+            finally:
+                self.in_flight -= 1
+                if self.observe:
+                    self.observe(started_at - received_at, time.monotonic() - started_at)
+
+    def _release_key(self, key: Hashable, task: asyncio.Task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+
 class AIORabbitMQConnector:
+    """
+    Asynchronous RabbitMQ connector.
+
+    Messages are consumed on `channel` and published over a small pool of
+    separate channels, so publishing bursts do not compete with the consumer.
+    Exchange objects are cached per publishing channel, so a publish does not
+    need an extra broker round trip to look the exchange up.
+
+    Pool channels publish without waiting for the broker. Messages that must
+    not be lost are published with `confirm=True`: they go through a channel
+    with publisher confirms, the confirmation of every delivery tag is tracked
+    in background and awaited in batches with `wait_for_confirms`.
+
+    Example:
+    connector = AIORabbitMQConnector(host='localhost', virtual_host='chathub')
+    await connector.connect()
+    await connector.publish('message', 'some_key', 'exchange_name')
+    await connector.publish_many(
+        [('message 1', {'user_id': 1}), ('message 2', {'user_id': 2})],
+        'some_key',
+        'exchange_name',
+    )
+    # critical messages
+    await connector.publish('message', 'some_key', 'exchange_name', confirm=True)
+    print(connector.outstanding_confirms)
+    failed = await connector.wait_for_confirms()
+
+    Requests that need an answer are sent with `call`. The request carries a
+    `correlation_id` and the name of the exclusive reply queue of the connector
+    in `reply_to`, the serving side answers with `reply`:
+    # client
+    reply = await connector.call('list_events', 'datemaker', 'exchange_name', timeout=10)
+    events = json.loads(reply.body)
+    # server
+    await connector.reply('[]', message.reply_to, message.correlation_id)
+    """
+
     def __init__(
             self,
             host: str = 'localhost',
@@ -201,7 +358,24 @@ class AIORabbitMQConnector:
             password: Optional[str] = None,
             caller_service: str = 'standalone',
             loglevel: Optional[int] = logging.DEBUG,
+            publish_channels: int = 4,
+            publish_concurrency: int = 100,
+            max_unconfirmed: int = 1000,
+            rpc_timeout: float = 30,
+            max_pending_calls: int = 10000,
+            late_reply_ttl: float = 300,
     ):
+        """
+        :param publish_channels: Number of channels in the publishing pool.
+        :param publish_concurrency: Default max of in-flight publishes in `publish_many`.
+        :param max_unconfirmed: When this many confirmed publishes are outstanding,
+                    `publish` and `publish_many` wait for confirms before sending more.
+        :param rpc_timeout: Default seconds `call` waits for a reply.
+        :param max_pending_calls: When this many calls wait for replies, the oldest
+                    one is dropped with `RpcCallDropped`.
+        :param late_reply_ttl: Seconds a reply to a timed out call is still handed
+                    to its `on_late_reply` handler.
+        """
         LOGGER.setLevel(loglevel)
         self.host = host
         self.port = port
@@ -212,7 +386,37 @@ class AIORabbitMQConnector:
         self.routing_key = routing_key
         self.connection: AbstractRobustConnection | None = None
         self.tag = f'python-aio-rmq-connector-{caller_service}'
+        # consuming channel and the queues consumed from it
         self.channel: AbstractRobustChannel | None = None
+        self._consumers: Dict[str, Tuple[AbstractQueue, str]] = {}
+        self.publish_channels_count = publish_channels
+        self.publish_concurrency = publish_concurrency
+        self.publish_channels: List[AbstractRobustChannel] = []
+        self._next_publish_channel = 0
+        self._exchanges: Dict[Tuple[int, str], AbstractExchange] = {}
+        # publisher confirms
+        self.confirm_channel: AbstractRobustChannel | None = None
+        self.max_unconfirmed = max_unconfirmed
+        self._unconfirmed: Dict[asyncio.Future, PublishedMessage] = {}
+        self._failed_confirms: List[Tuple[PublishedMessage, BaseException]] = []
+        self.confirmed_messages = 0
+        self.failed_messages = 0
+        # rpc
+        self.rpc_timeout = rpc_timeout
+        self.max_pending_calls = max_pending_calls
+        self.reply_queue: Optional[str] = None
+        self._reply_queue_lock = asyncio.Lock()
+        self._pending_calls: OrderedDict[str, asyncio.Future] = OrderedDict()
+        # timed out calls whose late replies are still handled: deadline and handler
+        self.late_reply_ttl = late_reply_ttl
+        self._late_reply_handlers: OrderedDict[
+            str, Tuple[float, Callable[[AbstractIncomingMessage], Awaitable]]
+        ] = OrderedDict()
+        self.rpc_calls = 0
+        self.rpc_timeouts = 0
+        self.rpc_dropped = 0
+        self.rpc_late_replies = 0
+        self.rpc_late_replies_handled = 0
 
     async def connect(self, custom_loop: Optional[asyncio.AbstractEventLoop] = None):
         self.connection = await aio_pika.connect_robust(
@@ -229,26 +433,345 @@ class AIORabbitMQConnector:
         await self.channel.set_qos(prefetch_count=10)
         LOGGER.debug(f'RabbitMQ channel {self.channel} opened')
 
-    async def listen_queue(self, queue_name: str, callback: Callable):
+        self.publish_channels = [
+            await self.connection.channel(publisher_confirms=False)
+            for _ in range(self.publish_channels_count)
+        ]
+        LOGGER.debug(f'RabbitMQ publishing pool of {len(self.publish_channels)} channels opened')
+        self.confirm_channel = await self.connection.channel(publisher_confirms=True)
+        LOGGER.debug(f'RabbitMQ confirm channel {self.confirm_channel} opened')
+
+    async def listen_queue(
+            self,
+            queue_name: str,
+            callback: Callable,
+            prefetch_count: Optional[int] = None,
+    ):
+        """
+        :param prefetch_count: Max of unacked messages delivered to the consuming
+                    channel, e.g. to feed a `OrderedConcurrentProcessor`.
+        """
+        if prefetch_count:
+            await self.channel.set_qos(prefetch_count=prefetch_count)
         queue = await self.channel.get_queue(queue_name)
         LOGGER.info(f'Listening for queue {queue_name}...')
-        await queue.consume(callback=callback, consumer_tag=self.tag)
+        consumer_tag = await queue.consume(callback=callback, consumer_tag=self.tag)
+        self._consumers[queue_name] = (queue, consumer_tag)
+
+    async def stop_listening(self, queue_name: str):
+        """
+        Cancel the consumer of the queue, so no more messages are delivered to
+        its callback. Messages already delivered stay unacked until the callback
+        handles them; unacked ones are redelivered when the channel closes.
+        """
+        consumer = self._consumers.pop(queue_name, None)
+        if consumer is None:
+            return
+        queue, consumer_tag = consumer
+        await queue.cancel(consumer_tag)
+        LOGGER.info(f'Stopped listening for queue {queue_name}')
 
     async def publish(
             self,
-            message: str,
+            message: Body,
             routing_key: str,
             exchange: str,
-            headers: Optional[HeadersType] = None
+            headers: Optional[HeadersType] = None,
+            confirm: bool = False,
     ):
-        exchange: AbstractExchange = await self.channel.get_exchange(exchange)
+        """
+        :param confirm: Publish with publisher confirms. The call does not wait for
+                    the confirm, see `wait_for_confirms`.
+        """
+        if confirm:
+            self._publish_with_confirm(message, routing_key, exchange, headers, record_failure=True)
+            # failures stay recorded for the next `wait_for_confirms`
+            await self._wait_for_capacity()
+            return
+
+        channel = self._get_publish_channel()
+        exchange: AbstractExchange = await self._get_exchange(channel, exchange)
         await exchange.publish(
             routing_key=routing_key,
             message=aio_pika.Message(
-                body=message.encode(),
+                body=_body(message),
                 headers=headers,
             ),
         )
         LOGGER.debug(
             f'Message "{message[:100]}..." (RK {routing_key}) published to exchange {exchange}'
         )
+
+    async def publish_many(
+            self,
+            messages: Iterable[Tuple[Body, Optional[HeadersType]]],
+            routing_key: str,
+            exchange: str,
+            concurrency: Optional[int] = None,
+            confirm: bool = False,
+    ) -> List[Optional[BaseException]]:
+        """
+        Publish a batch of messages with the same routing key. Publishes are
+        pipelined over the publishing pool with at most `concurrency` in flight.
+
+        :param messages: Pairs of message body and headers.
+        :param routing_key: Routing key for all messages.
+        :param exchange: Exchange name for all messages.
+        :param concurrency: Max of in-flight publishes, connector default if not set.
+        :param confirm: Publish with publisher confirms and wait for the confirms
+                    of the whole batch. Then an error is also returned for
+                    messages the broker did not acknowledge. These errors are
+                    not recorded for `wait_for_confirms`.
+        :return: For every message, in order: None if published or the raised error.
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.publish_concurrency)
+
+        async def publish_one(message: Body, headers: Optional[HeadersType]):
+            async with semaphore:
+                await self.publish(message, routing_key, exchange, headers)
+
+        if confirm:
+            futures = []
+            for message, headers in messages:
+                await self._wait_for_capacity()
+                futures.append(
+                    self._publish_with_confirm(message, routing_key, exchange, headers, semaphore=semaphore)
+                )
+            if futures:
+                await asyncio.wait(futures)
+            results = [
+                future.exception() if not future.cancelled() else asyncio.CancelledError()
+                for future in futures
+            ]
+        else:
+            results = await asyncio.gather(
+                *[publish_one(message, headers) for message, headers in messages],
+                return_exceptions=True,
+            )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            LOGGER.warning(
+                f'Failed to publish {len(errors)} of {len(results)} messages '
+                f'(RK {routing_key}), first error: {errors[0]}'
+            )
+        return [result if isinstance(result, BaseException) else None for result in results]
+
+    async def call(
+            self,
+            message: Body,
+            routing_key: str,
+            exchange: str,
+            headers: Optional[HeadersType] = None,
+            timeout: Optional[float] = None,
+            on_late_reply: Optional[Callable[[AbstractIncomingMessage], Awaitable]] = None,
+    ) -> AbstractIncomingMessage:
+        """
+        Publish a request and wait for its reply.
+
+        :param timeout: Max seconds to wait for the reply, connector default if not set.
+        :param on_late_reply: Handles the reply if it comes after the timeout, within
+                    `late_reply_ttl` seconds. Without it a late reply is dropped.
+        :return: The reply message.
+        :raises asyncio.TimeoutError: No reply came in time.
+        :raises RpcCallDropped: Too many calls were waiting for replies.
+        """
+        if self.reply_queue is None:
+            await self._declare_reply_queue()
+
+        correlation_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending_calls[correlation_id] = future
+        self.rpc_calls += 1
+        while len(self._pending_calls) > self.max_pending_calls:
+            _, dropped = self._pending_calls.popitem(last=False)
+            self.rpc_dropped += 1
+            if not dropped.done():
+                dropped.set_exception(RpcCallDropped(
+                    f'{self.max_pending_calls} calls are waiting for replies'
+                ))
+
+        try:
+            channel = self._get_publish_channel()
+            exchange_object = await self._get_exchange(channel, exchange)
+            await exchange_object.publish(
+                routing_key=routing_key,
+                message=aio_pika.Message(
+                    body=_body(message),
+                    headers=headers,
+                    correlation_id=correlation_id,
+                    reply_to=self.reply_queue,
+                ),
+            )
+            LOGGER.debug(f'Call "{message[:100]}" (RK {routing_key}) sent, id {correlation_id}')
+            return await asyncio.wait_for(future, timeout or self.rpc_timeout)
+        except asyncio.TimeoutError:
+            self.rpc_timeouts += 1
+            LOGGER.warning(f'No reply to call "{message[:100]}" (RK {routing_key})')
+            if on_late_reply is not None:
+                self._late_reply_handlers[correlation_id] = (
+                    asyncio.get_running_loop().time() + self.late_reply_ttl, on_late_reply
+                )
+                while len(self._late_reply_handlers) > self.max_pending_calls:
+                    self._late_reply_handlers.popitem(last=False)
+            raise
+        finally:
+            self._pending_calls.pop(correlation_id, None)
+
+    async def reply(
+            self,
+            message: Body,
+            reply_to: str,
+            correlation_id: Optional[str],
+            headers: Optional[HeadersType] = None,
+    ):
+        """
+        Answer a request sent with `call`, `reply_to` and `correlation_id` are
+        taken from the request.
+        """
+        channel = self._get_publish_channel()
+        await channel.default_exchange.publish(
+            routing_key=reply_to,
+            message=aio_pika.Message(
+                body=_body(message),
+                headers=headers,
+                correlation_id=correlation_id,
+            ),
+        )
+        LOGGER.debug(f'Reply "{message[:100]}..." to {reply_to} published, id {correlation_id}')
+
+    @property
+    def pending_calls(self) -> int:
+        return len(self._pending_calls)
+
+    async def _declare_reply_queue(self):
+        async with self._reply_queue_lock:
+            if self.reply_queue is not None:
+                return
+            # exclusive to the connection: every process gets replies to its own calls only
+            queue = await self.channel.declare_queue(
+                name=f'{self.tag}.replies.{uuid.uuid4().hex}',
+                exclusive=True,
+                auto_delete=True,
+            )
+            await queue.consume(callback=self._on_reply, no_ack=True)
+            self.reply_queue = queue.name
+            LOGGER.info(f'Listening for replies on {self.reply_queue}')
+
+    async def _on_reply(self, message: AbstractIncomingMessage):
+        future = self._pending_calls.pop(message.correlation_id, None)
+        if future is None or future.done():
+            # the call timed out or was dropped
+            self.rpc_late_replies += 1
+            deadline, handler = self._late_reply_handlers.pop(message.correlation_id, (0, None))
+            if handler is None or deadline < asyncio.get_running_loop().time():
+                LOGGER.debug(f'Dropping reply {message.body[:100]} to call {message.correlation_id}')
+                return
+            self.rpc_late_replies_handled += 1
+            try:
+                await handler(message)
+            except Exception as e:
+                LOGGER.error(f'Failed to handle late reply to call {message.correlation_id}: {e}')
+            return
+        future.set_result(message)
+
+    @property
+    def outstanding_confirms(self) -> int:
+        """
+        Number of messages published with confirm and not confirmed yet.
+        """
+        return len(self._unconfirmed)
+
+    async def wait_for_confirms(
+            self,
+            timeout: Optional[float] = None,
+    ) -> List[Tuple[PublishedMessage, BaseException]]:
+        """
+        Wait for confirms of all outstanding messages.
+
+        :param timeout: Max seconds to wait. Messages that are still not confirmed
+                    stay outstanding.
+        :return: Messages that failed since the previous call (nacked, returned or
+                 lost with the channel) with their errors, so they can be re-sent.
+        """
+        pending = list(self._unconfirmed)
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+        failed, self._failed_confirms = self._failed_confirms, []
+        if failed:
+            LOGGER.warning(f'{len(failed)} published messages were not confirmed')
+        return failed
+
+    def _publish_with_confirm(
+            self,
+            message: Body,
+            routing_key: str,
+            exchange: str,
+            headers: Optional[HeadersType] = None,
+            semaphore: Optional[asyncio.Semaphore] = None,
+            record_failure: bool = False,
+    ) -> asyncio.Future:
+        """
+        Start publishing on the confirm channel. The returned future is done when
+        the broker confirms the message delivery tag.
+
+        :param record_failure: Keep the message for `wait_for_confirms` if it is
+                    not confirmed, for callers that do not await the future.
+        """
+        async def publish_and_confirm():
+            if semaphore:
+                async with semaphore:
+                    return await send()
+            return await send()
+
+        async def send():
+            channel = self.confirm_channel or self._get_publish_channel()
+            exchange_object = await self._get_exchange(channel, exchange)
+            return await exchange_object.publish(
+                routing_key=routing_key,
+                message=aio_pika.Message(
+                    body=_body(message),
+                    headers=headers,
+                ),
+            )
+
+        future = asyncio.ensure_future(publish_and_confirm())
+        self._unconfirmed[future] = (message, routing_key, exchange, headers)
+        future.add_done_callback(functools.partial(self._on_confirm, record_failure=record_failure))
+        return future
+
+    def _on_confirm(self, future: asyncio.Future, record_failure: bool = False):
+        published_message = self._unconfirmed.pop(future)
+        error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        if error is None:
+            self.confirmed_messages += 1
+        else:
+            self.failed_messages += 1
+            if record_failure:
+                self._failed_confirms.append((published_message, error))
+            LOGGER.debug(f'Message (RK {published_message[1]}) was not confirmed: {error}')
+
+    async def _wait_for_capacity(self):
+        """
+        Wait until fewer than `max_unconfirmed` messages are outstanding.
+        Failed confirms are left for their callers.
+        """
+        if self.outstanding_confirms >= self.max_unconfirmed:
+            LOGGER.debug(f'{self.outstanding_confirms} messages unconfirmed, waiting')
+        while self.outstanding_confirms >= self.max_unconfirmed:
+            await asyncio.wait(list(self._unconfirmed), return_when=asyncio.FIRST_COMPLETED)
+
+    def _get_publish_channel(self) -> AbstractRobustChannel:
+        # round robin over the pool, consuming channel if the pool is not opened
+        if not self.publish_channels:
+            return self.channel
+        index = self._next_publish_channel % len(self.publish_channels)
+        self._next_publish_channel = index + 1
+        return self.publish_channels[index]
+
+    async def _get_exchange(self, channel: AbstractRobustChannel, name: str) -> AbstractExchange:
+        key = (id(channel), name)
+        exchange = self._exchanges.get(key)
+        if exchange is None:
+            exchange = await channel.get_exchange(name)
+            self._exchanges[key] = exchange
+        return exchange
@@ -2,6 +2,7 @@ import logging
 from typing import Optional
 
 import redis
+import redis.asyncio
 
 from chathub_connectors import setup_logger
 
@@ -27,6 +28,15 @@ class RedisConnector:
             password=password,
             decode_responses=True,
         )
+        # for asyncio services, connects on the first command
+        self.async_client = redis.asyncio.Redis(
+            host=host,
+            port=port,
+            db=db,
+            username=username,
+            password=password,
+            decode_responses=True,
+        )
         LOGGER.setLevel(log_level)
         LOGGER.info('Redis connector initialized')
 
@@ -35,5 +45,8 @@ class RedisConnector:
         self.client.set(f'matchmaker:queue:{index}', username)
         LOGGER.debug(f'User {username} added to MM queue as {index}')
 
+    async def aclose(self):
+        await self.async_client.aclose()
+
     def __del__(self):
         self.client.close()
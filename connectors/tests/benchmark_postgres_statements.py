@@ -0,0 +1,129 @@
+"""
+Benchmark for the prepared statements and rows of AsyncPgConnector.
+
+Runs hot connector queries against the synthetic database of the query plan
+suite with:
+    - plain SQL without statement cache: parsed and planned on every call
+    - plain SQL with asyncpg statement cache, where every statement is
+      prepared by the first call on each connection and kept for its lifetime
+    - the connector itself: statements of the registry and `__slots__` rows
+and the memory taken by fetched rows as asyncpg records and as row objects.
+
+Usage (from the connectors directory):
+    CHATHUB_TEST_POSTGRES_DSN=postgresql://postgres@localhost:5432/postgres \
+    python -m tests.benchmark_postgres_statements --calls 5000
+"""
+import argparse
+import asyncio
+import sys
+import time
+from urllib.parse import urlparse
+
+import asyncpg
+
+from chathub_connectors.postgres_connector import AsyncPgConnector
+from chathub_connectors.postgres_statements import STATEMENTS, RegistrationRow, UserRow
+from tests.test_query_plans import DATABASE, POSTGRES_DSN, create_database, drop_database
+
+CALLS = {
+    'get_user': ('fetchrow', lambda i: (i % 1000 + 1,)),
+    'get_event_registrations': ('fetch', lambda i: (i % 100 + 1,)),
+    'set_user_ready_to_start': ('execute', lambda i: (i % 1000 + 1, 1)),
+    'save_user_like': ('execute', lambda i: (i % 1000 + 1, i % 1000 + 2, 1)),
+}
+
+
+async def time_calls(run, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        await run(i)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+async def raw_sql(pool, name):
+    method, args = CALLS[name]
+
+    async def run(i):
+        async with pool.acquire() as conn:
+            return await getattr(conn, method)(STATEMENTS[name], *args(i))
+    return run
+
+
+async def connector(pg, name):
+    method, args = CALLS[name]
+    return lambda i: getattr(pg, name)(*args(i))
+
+
+def rows_memory(rows) -> int:
+    # column values are shared by records and row objects, only containers differ
+    return sum(sys.getsizeof(row) for row in rows)
+
+
+async def run_benchmark(calls: int):
+    pools = {
+        'no statement cache': await asyncpg.create_pool(
+            POSTGRES_DSN, database=DATABASE, min_size=1, max_size=1, statement_cache_size=0,
+        ),
+        'statement cache': await asyncpg.create_pool(
+            POSTGRES_DSN, database=DATABASE, min_size=1, max_size=1,
+            max_cached_statement_lifetime=0,
+        ),
+        'connector': await asyncpg.create_pool(
+            POSTGRES_DSN, database=DATABASE, min_size=1, max_size=1,
+            max_cached_statement_lifetime=0,
+        ),
+    }
+    url = urlparse(POSTGRES_DSN)
+    pg = AsyncPgConnector(
+        host=url.hostname or 'localhost',
+        port=url.port or 5432,
+        db=DATABASE,
+        username=url.username,
+        password=url.password,
+    )
+    pg.pool = pools['connector']
+    variants = {
+        'no statement cache': lambda name: raw_sql(pools['no statement cache'], name),
+        'statement cache': lambda name: raw_sql(pools['statement cache'], name),
+        'connector': lambda name: connector(pg, name),
+    }
+
+    print(f'{"query":>24} ' + ' '.join(f'{variant + ", us":>22}' for variant in variants))
+    for name in CALLS:
+        timings = []
+        for make_run in variants.values():
+            run = await make_run(name)
+            await time_calls(run, min(calls, 100))  # warm up
+            timings.append(await time_calls(run, calls))
+        print(f'{name:>24} ' + ' '.join(f'{timing:22.1f}' for timing in timings))
+
+    async with pools['statement cache'].acquire() as conn:
+        users = await conn.fetch('SELECT * FROM public.users ORDER BY id LIMIT 10000;')
+        registrations = await conn.fetch(
+            STATEMENTS['get_event_registrations'].replace('= $1', '< 250')
+        )
+    print(f'\n{"rows":>24} {"records, KiB":>22} {"row objects, KiB":>22}')
+    for name, records, row_type in [
+        ('users', users, UserRow),
+        ('registrations', registrations, RegistrationRow),
+    ]:
+        as_records = rows_memory(records)
+        as_rows = rows_memory(row_type.from_records(records))
+        print(f'{f"{len(records)} {name}":>24} {as_records / 1024:22.1f} {as_rows / 1024:22.1f}')
+
+    for pool in pools.values():
+        await pool.close()
+    pg.pool = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepared statements benchmark.')
+    parser.add_argument('--calls', type=int, default=2000, help='Calls of every query')
+    args = parser.parse_args()
+    if not POSTGRES_DSN:
+        parser.error('CHATHUB_TEST_POSTGRES_DSN is not set')
+    asyncio.run(create_database())
+    try:
+        asyncio.run(run_benchmark(args.calls))
+    finally:
+        asyncio.run(drop_database())
@@ -0,0 +1,400 @@
+import asyncio
+from unittest.mock import MagicMock, AsyncMock
+
+import pytest
+
+from chathub_connectors.rabbitmq_connector import (
+    AIORabbitMQConnector,
+    OrderedConcurrentProcessor,
+    RpcCallDropped,
+)
+
+
+def make_channel():
+    exchange = MagicMock()
+    exchange.publish = AsyncMock()
+    channel = MagicMock()
+    channel.get_exchange = AsyncMock(return_value=exchange)
+    return channel, exchange
+
+
+class TestAIORabbitMQConnector:
+    def make_connector(self, channels=2):
+        connector = AIORabbitMQConnector(publish_channels=channels, loglevel=20)
+        connector.channel, _ = make_channel()
+        pool = [make_channel() for _ in range(channels)]
+        connector.publish_channels = [channel for channel, _ in pool]
+        return connector, pool
+
+    def test_exchange_cached_per_channel(self):
+        connector, pool = self.make_connector(channels=2)
+
+        async def publish():
+            for _ in range(6):
+                await connector.publish('message', 'rk', 'exchange', headers={'user_id': 1})
+
+        asyncio.run(publish())
+
+        for channel, exchange in pool:
+            channel.get_exchange.assert_awaited_once_with('exchange')
+            assert exchange.publish.await_count == 3
+        connector.channel.get_exchange.assert_not_awaited()
+
+    def test_publish_many_reports_errors_in_order(self):
+        connector, _ = self.make_connector()
+
+        async def publish(message, routing_key, exchange, headers=None):
+            await asyncio.sleep(0)
+            if headers['user_id'] % 2:
+                raise ConnectionError(message)
+
+        connector.publish = publish
+        messages = [(f'message {uid}', {'user_id': uid}) for uid in range(6)]
+
+        results = asyncio.run(connector.publish_many(messages, 'rk', 'exchange'))
+
+        assert [result is None for result in results] == [True, False] * 3
+        assert str(results[1]) == 'message 1'
+
+    def test_publish_many_concurrency(self):
+        connector, _ = self.make_connector()
+        in_flight = []
+        counter = {'now': 0}
+
+        async def publish(message, routing_key, exchange, headers=None):
+            counter['now'] += 1
+            in_flight.append(counter['now'])
+            await asyncio.sleep(0.001)
+            counter['now'] -= 1
+
+        connector.publish = publish
+
+        asyncio.run(connector.publish_many(
+            [('message', None)] * 50, 'rk', 'exchange', concurrency=5
+        ))
+
+        assert max(in_flight) == 5
+
+    def test_stop_listening_cancels_consumer(self):
+        connector, _ = self.make_connector()
+        queue = MagicMock()
+        queue.consume = AsyncMock(return_value='ctag')
+        queue.cancel = AsyncMock()
+        connector.channel.get_queue = AsyncMock(return_value=queue)
+        connector.channel.set_qos = AsyncMock()
+        callback = AsyncMock()
+
+        async def run():
+            await connector.listen_queue('commands', callback, prefetch_count=4)
+            await connector.stop_listening('commands')
+            # stopping twice is a no-op
+            await connector.stop_listening('commands')
+
+        asyncio.run(run())
+
+        queue.consume.assert_awaited_once_with(callback=callback, consumer_tag=connector.tag)
+        queue.cancel.assert_awaited_once_with('ctag')
+
+    def make_confirm_connector(self, nack_once=()):
+        connector, pool = self.make_connector()
+        connector.confirm_channel, exchange = make_channel()
+        nacked = set()
+
+        async def publish(routing_key, message):
+            await asyncio.sleep(0.001)
+            user_id = message.headers['user_id']
+            if user_id in nack_once and user_id not in nacked:
+                nacked.add(user_id)
+                raise ConnectionError(f'nack {user_id}')
+
+        exchange.publish = AsyncMock(side_effect=publish)
+        return connector, pool, exchange
+
+    def test_confirm_publish_tracked_in_background(self):
+        connector, pool, confirm_exchange = self.make_confirm_connector(nack_once={2})
+
+        async def publish():
+            for uid in range(4):
+                await connector.publish('message', 'rk', 'exchange', {'user_id': uid}, confirm=True)
+            outstanding = connector.outstanding_confirms
+            failed = await connector.wait_for_confirms()
+            return outstanding, failed
+
+        outstanding, failed = asyncio.run(publish())
+
+        assert outstanding == 4
+        assert connector.outstanding_confirms == 0
+        assert confirm_exchange.publish.await_count == 4
+        for _, exchange in pool:
+            exchange.publish.assert_not_awaited()
+        assert [(message[3], str(error)) for message, error in failed] == [
+            ({'user_id': 2}, 'nack 2')
+        ]
+        assert (connector.confirmed_messages, connector.failed_messages) == (3, 1)
+
+    def test_confirm_backpressure(self):
+        connector, _, _ = self.make_confirm_connector()
+        connector.max_unconfirmed = 3
+        outstanding = []
+
+        async def publish():
+            for uid in range(10):
+                await connector.publish('message', 'rk', 'exchange', {'user_id': uid}, confirm=True)
+                outstanding.append(connector.outstanding_confirms)
+            await connector.wait_for_confirms()
+
+        asyncio.run(publish())
+
+        assert max(outstanding) < 3
+        assert connector.confirmed_messages == 10
+
+    def test_backpressure_keeps_failures(self):
+        connector, _, _ = self.make_confirm_connector(nack_once={0, 5})
+        connector.max_unconfirmed = 2
+
+        async def publish():
+            for uid in range(8):
+                await connector.publish('message', 'rk', 'exchange', {'user_id': uid}, confirm=True)
+            return await connector.wait_for_confirms()
+
+        failed = asyncio.run(publish())
+
+        assert sorted(message[3]['user_id'] for message, _ in failed) == [0, 5]
+
+    def test_publish_many_with_confirm(self):
+        connector, _, _ = self.make_confirm_connector(nack_once={1, 4})
+        messages = [(f'message {uid}', {'user_id': uid}) for uid in range(6)]
+
+        async def publish():
+            results = await connector.publish_many(messages, 'rk', 'exchange', confirm=True)
+            return results, await connector.wait_for_confirms()
+
+        results, failed = asyncio.run(publish())
+
+        assert [result is None for result in results] == [True, False, True, True, False, True]
+        assert connector.outstanding_confirms == 0
+        # the errors were returned to the caller, they are not reported again
+        assert failed == []
+
+    def test_publish_many_confirm_backpressure(self):
+        connector, _, confirm_exchange = self.make_confirm_connector()
+        connector.max_unconfirmed = 3
+        outstanding = []
+
+        async def publish(routing_key, message):
+            outstanding.append(connector.outstanding_confirms)
+            await asyncio.sleep(0.001)
+
+        confirm_exchange.publish = AsyncMock(side_effect=publish)
+        messages = [('message', {'user_id': uid}) for uid in range(10)]
+
+        results = asyncio.run(connector.publish_many(messages, 'rk', 'exchange', confirm=True))
+
+        assert results == [None] * 10
+        assert max(outstanding) <= 3
+
+
+class FakeReply:
+    def __init__(self, body, correlation_id):
+        self.body = body
+        self.correlation_id = correlation_id
+
+
+class TestRpc:
+    def make_connector(self, reply_delays=None, **kwargs):
+        """
+        :param reply_delays: Seconds the server takes to reply to every request
+                    body, no reply if missing.
+        """
+        connector = AIORabbitMQConnector(publish_channels=1, loglevel=20, **kwargs)
+        connector.channel, _ = make_channel()
+        reply_queue = MagicMock()
+        reply_queue.name = 'replies'
+        reply_queue.consume = AsyncMock()
+        connector.channel.declare_queue = AsyncMock(return_value=reply_queue)
+        channel, exchange = make_channel()
+        connector.publish_channels = [channel]
+
+        async def serve(routing_key, message):
+            delay = (reply_delays or {}).get(message.body)
+            if delay is not None:
+                asyncio.get_running_loop().call_later(
+                    delay,
+                    lambda: asyncio.ensure_future(connector._on_reply(
+                        FakeReply(message.body.upper(), message.correlation_id)
+                    )),
+                )
+
+        exchange.publish = AsyncMock(side_effect=serve)
+        return connector, exchange
+
+    def test_replies_matched_by_correlation_id(self):
+        # the second request is answered first
+        connector, exchange = self.make_connector({b'first': 0.02, b'second': 0.01})
+
+        async def run():
+            return await asyncio.gather(
+                connector.call('first', 'rk', 'exchange'),
+                connector.call('second', 'rk', 'exchange'),
+            )
+
+        replies = asyncio.run(run())
+
+        assert [reply.body for reply in replies] == [b'FIRST', b'SECOND']
+        connector.channel.declare_queue.assert_awaited_once()
+        requests = [call.kwargs['message'] for call in exchange.publish.await_args_list]
+        assert {request.reply_to for request in requests} == {'replies'}
+        assert len({request.correlation_id for request in requests}) == 2
+        assert connector.pending_calls == 0
+
+    def test_timeout_and_late_reply(self):
+        connector, _ = self.make_connector({b'slow': 0.05})
+
+        async def run():
+            with pytest.raises(asyncio.TimeoutError):
+                await connector.call('slow', 'rk', 'exchange', timeout=0.01)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+
+        assert connector.pending_calls == 0
+        assert (connector.rpc_timeouts, connector.rpc_late_replies) == (1, 1)
+
+    def test_late_reply_handler(self):
+        connector, _ = self.make_connector({b'slow': 0.05, b'expired': 0.05}, late_reply_ttl=0.1)
+        late = []
+
+        async def on_late_reply(message):
+            late.append(message.body)
+
+        async def run():
+            for body in ('slow', 'expired'):
+                if body == 'expired':
+                    connector.late_reply_ttl = 0.001
+                with pytest.raises(asyncio.TimeoutError):
+                    await connector.call(body, 'rk', 'exchange', timeout=0.03, on_late_reply=on_late_reply)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+
+        # the second reply comes after the handler expired
+        assert late == [b'SLOW']
+        assert (connector.rpc_late_replies, connector.rpc_late_replies_handled) == (2, 1)
+
+    def test_oldest_call_dropped(self):
+        connector, _ = self.make_connector(
+            {b'answered': 0.01}, max_pending_calls=2, rpc_timeout=0.05
+        )
+
+        async def run():
+            return await asyncio.gather(
+                connector.call('unanswered', 'rk', 'exchange'),
+                connector.call('unanswered', 'rk', 'exchange'),
+                connector.call('answered', 'rk', 'exchange'),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(run())
+
+        assert isinstance(results[0], RpcCallDropped)
+        assert isinstance(results[1], asyncio.TimeoutError)
+        assert results[2].body == b'ANSWERED'
+        assert (connector.rpc_dropped, connector.pending_calls) == (1, 0)
+
+
+class FakeIncomingMessage:
+    def __init__(self, user_id, number):
+        self.headers = {'user_id': user_id}
+        self.body = f'message {number}'.encode()
+        self.number = number
+
+
+class TestOrderedConcurrentProcessor:
+    def test_concurrent_with_per_key_order(self):
+        processed = []
+
+        async def callback(message):
+            # earlier messages of a user take longer
+            await asyncio.sleep(0.01 * (5 - message.number % 5))
+            processed.append((message.headers['user_id'], message.number))
+
+        processor = OrderedConcurrentProcessor(
+            callback, key=lambda message: message.headers['user_id'], concurrency=4
+        )
+
+        async def consume():
+            for number in range(20):
+                await processor(FakeIncomingMessage(number % 4, number))
+            await processor.join()
+
+        asyncio.run(consume())
+
+        assert processor.max_in_flight == 4
+        assert processor.processed == 20
+        for user_id in range(4):
+            numbers = [number for uid, number in processed if uid == user_id]
+            assert numbers == sorted(numbers)
+        assert processor.active_keys == 0
+
+    def test_concurrency_limit_across_keys(self):
+        async def callback(message):
+            await asyncio.sleep(0.005)
+
+        processor = OrderedConcurrentProcessor(
+            callback, key=lambda message: message.number, concurrency=3
+        )
+
+        async def consume():
+            for number in range(12):
+                await processor(FakeIncomingMessage(1, number))
+            waiting = processor.waiting
+            await processor.join()
+            return waiting
+
+        assert asyncio.run(consume()) == 12
+        assert processor.max_in_flight == 3
+        assert processor.waiting == 0
+
+    def test_failure_does_not_block_key(self):
+        processed = []
+
+        async def callback(message):
+            if message.number == 0:
+                raise ValueError('bad message')
+            processed.append(message.number)
+
+        processor = OrderedConcurrentProcessor(callback, key=lambda message: 1)
+
+        async def consume():
+            for number in range(3):
+                await processor(FakeIncomingMessage(1, number))
+            await processor.join()
+
+        asyncio.run(consume())
+
+        assert processed == [1, 2]
+        assert (processor.processed, processor.failed) == (2, 1)
+
+    def test_observe_lag_and_latency(self):
+        observed = []
+
+        async def callback(message):
+            await asyncio.sleep(0.01)
+
+        processor = OrderedConcurrentProcessor(
+            callback,
+            key=lambda message: message.headers['user_id'],
+            observe=lambda lag, latency: observed.append((lag, latency)),
+        )
+
+        async def consume():
+            for number in range(2):
+                await processor(FakeIncomingMessage(1, number))
+            await processor.join()
+
+        asyncio.run(consume())
+
+        (first_lag, first_latency), (second_lag, _) = observed
+        assert first_lag < 0.01 <= first_latency
+        # the second message waited for the first one of the same user
+        assert second_lag >= 0.01
@@ -0,0 +1,135 @@
+import asyncio
+import json
+from enum import Enum
+
+import pytest
+
+from chathub_connectors.envelope import (
+    BATCH_ENVELOPE_VERSION,
+    BATCH_SIZE_HEADER,
+    COMMAND_HEADER,
+    CommandRegistry,
+    Envelope,
+    EnvelopeError,
+    MAX_ENVELOPE_VERSION,
+    MSGPACK,
+    UnknownCommandError,
+    VERSION_HEADER,
+)
+
+
+class Commands(Enum):
+    SEND_RULES = 'send_rules'
+    INVITE_TO_MEETING = 'invite_to_meeting'
+
+
+class TestEnvelope:
+    def test_round_trip(self):
+        body, headers = Envelope(
+            Commands.INVITE_TO_MEETING, {'url': 'https://meet'}, {'user_id': 1}
+        ).encode()
+
+        assert json.loads(body) == {'url': 'https://meet'}
+        assert headers[COMMAND_HEADER] == 'invite_to_meeting'
+        assert headers[VERSION_HEADER] == 1
+
+        envelope = Envelope.from_message(body, headers)
+
+        assert envelope.command == 'invite_to_meeting'
+        assert envelope.payload == {'url': 'https://meet'}
+        assert envelope.headers == {'user_id': 1}
+        assert envelope.version == 1
+
+    def test_msgpack_round_trip(self):
+        pytest.importorskip('msgpack')
+        body, headers = Envelope('send_rules', {'round': 1}).encode(content_type=MSGPACK)
+
+        assert Envelope.from_message(body, headers).payload == {'round': 1}
+
+    def test_legacy_command_name(self):
+        envelope = Envelope.from_message(b'register_event', {'user_id': 5, 'event_id': 1})
+
+        assert (envelope.command, envelope.payload, envelope.version) == ('register_event', None, 0)
+        assert envelope.headers == {'user_id': 5, 'event_id': 1}
+
+    def test_legacy_json(self):
+        envelope = Envelope.from_message(
+            json.dumps({'invite_to_meeting': {'url': 'https://meet'}}).encode(), {'user_id': 1}
+        )
+
+        assert (envelope.command, envelope.payload) == ('invite_to_meeting', {'url': 'https://meet'})
+
+    def test_batch_round_trip(self):
+        body, headers = Envelope(
+            Commands.SEND_RULES, {'round': 1}, {'event_id': 7}, recipients=[1, 2, 3]
+        ).encode()
+
+        assert headers[VERSION_HEADER] == BATCH_ENVELOPE_VERSION
+        assert headers[BATCH_SIZE_HEADER] == 3
+
+        envelope = Envelope.from_message(body, headers)
+
+        assert envelope.is_batch
+        assert envelope.recipients == [1, 2, 3]
+        assert envelope.headers == {'event_id': 7}
+        assert [(e.headers, e.payload, e.is_batch) for e in envelope.expand()] == [
+            ({'event_id': 7, 'user_id': uid, 'chat_id': uid}, {'round': 1}, False)
+            for uid in [1, 2, 3]
+        ]
+
+    def test_single_expands_to_itself(self):
+        envelope = Envelope('send_rules', headers={'user_id': 1})
+
+        assert list(envelope.expand()) == [envelope]
+
+    def test_batch_without_recipients(self):
+        body, headers = Envelope('send_rules', {'round': 1}).encode()
+        headers[BATCH_SIZE_HEADER] = 1
+
+        with pytest.raises(EnvelopeError):
+            Envelope.from_message(body, headers)
+
+    def test_newer_version_rejected(self):
+        body, headers = Envelope('send_rules', version=MAX_ENVELOPE_VERSION + 1).encode()
+
+        with pytest.raises(EnvelopeError):
+            Envelope.from_message(body, headers)
+
+
+class Handler:
+    commands = CommandRegistry()
+
+    def __init__(self):
+        self.handled = []
+
+    @commands.register(Commands.SEND_RULES)
+    async def send_rules(self, envelope, user_id):
+        self.handled.append((envelope.command, user_id))
+        return True
+
+    @commands.register(Commands.INVITE_TO_MEETING, 'invite')
+    async def invite(self, envelope, user_id):
+        self.handled.append((envelope.payload['url'], user_id))
+        return True
+
+
+class TestCommandRegistry:
+    def test_dispatch(self):
+        handler = Handler()
+
+        async def run():
+            await Handler.commands.dispatch(handler, Envelope(Commands.SEND_RULES), 1)
+            await Handler.commands.dispatch(handler, Envelope('invite', {'url': 'u'}), 2)
+
+        asyncio.run(run())
+
+        assert handler.handled == [('send_rules', 1), ('u', 2)]
+        assert Commands.INVITE_TO_MEETING in Handler.commands
+
+    def test_unknown_command(self):
+        with pytest.raises(UnknownCommandError):
+            asyncio.run(Handler.commands.dispatch(Handler(), Envelope('dance'), 1))
+
+    def test_duplicate_registration(self):
+        with pytest.raises(ValueError):
+            Handler.commands.register(Commands.SEND_RULES)(lambda self, envelope: None)
@@ -0,0 +1,209 @@
+import asyncio
+
+import pytest
+
+from chathub_connectors.postgres_cache import AsyncTTLCache, CachedPgConnector
+from chathub_connectors.postgres_connector import AsyncPgConnector
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Loader:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+
+    def __call__(self, value):
+        async def load():
+            self.calls += 1
+            await asyncio.sleep(self.delay)
+            return value
+        return load
+
+
+class TestAsyncTTLCache:
+    def test_hits_and_misses(self):
+        cache = AsyncTTLCache()
+        load = Loader()
+
+        async def run():
+            return [await cache.get_or_load('user', load(1)) for _ in range(3)]
+
+        assert asyncio.run(run()) == [1, 1, 1]
+        assert load.calls == 1
+        assert cache.stats == {'size': 1, 'hits': 2, 'misses': 1, 'coalesced': 0, 'evictions': 0}
+
+    def test_expiration(self):
+        clock = FakeClock()
+        cache = AsyncTTLCache(ttl=10, clock=clock)
+        load = Loader()
+
+        async def run():
+            await cache.get_or_load('user', load(1))
+            clock.now = 9.9
+            await cache.get_or_load('user', load(2))
+            clock.now = 10
+            return await cache.get_or_load('user', load(3))
+
+        assert asyncio.run(run()) == 3
+        assert load.calls == 2
+
+    def test_least_recently_used_evicted(self):
+        cache = AsyncTTLCache(max_size=2)
+        load = Loader()
+
+        async def run():
+            await cache.get_or_load(1, load(1))
+            await cache.get_or_load(2, load(2))
+            await cache.get_or_load(1, load(1))
+            await cache.get_or_load(3, load(3))
+            # 2 is the least recently used one
+            await cache.get_or_load(1, load(1))
+            await cache.get_or_load(2, load(2))
+
+        asyncio.run(run())
+
+        assert load.calls == 4
+        assert cache.evictions == 2
+        assert len(cache) == 2
+
+    def test_concurrent_misses_share_load(self):
+        cache = AsyncTTLCache()
+        load = Loader(delay=0.01)
+
+        async def run():
+            return await asyncio.gather(*(cache.get_or_load('user', load(1)) for _ in range(5)))
+
+        assert asyncio.run(run()) == [1] * 5
+        assert load.calls == 1
+        assert (cache.hits, cache.misses, cache.coalesced) == (0, 1, 4)
+
+    def test_none_not_cached(self):
+        cache = AsyncTTLCache()
+        load = Loader()
+
+        async def run():
+            return [await cache.get_or_load('user', load(None)) for _ in range(2)]
+
+        assert asyncio.run(run()) == [None, None]
+        assert load.calls == 2
+        assert len(cache) == 0
+
+    def test_invalidated_during_load_not_cached(self):
+        cache = AsyncTTLCache()
+        load = Loader(delay=0.01)
+
+        async def run():
+            task = asyncio.ensure_future(cache.get_or_load('user', load('stale')))
+            await asyncio.sleep(0)
+            cache.invalidate('user')
+            stale = await task
+            return stale, await cache.get_or_load('user', load('fresh'))
+
+        assert asyncio.run(run()) == ('stale', 'fresh')
+        assert load.calls == 2
+
+    def test_load_after_invalidation_not_joined(self):
+        cache = AsyncTTLCache()
+        load = Loader(delay=0.05)
+
+        async def run():
+            slow = asyncio.ensure_future(cache.get_or_load('user', load('stale')))
+            await asyncio.sleep(0.01)
+            # the user was updated while the old profile was being read
+            cache.invalidate('user')
+            fresh = await cache.get_or_load('user', Loader()('fresh'))
+            return await slow, fresh, await cache.get_or_load('user', load('cached'))
+
+        assert asyncio.run(run()) == ('stale', 'fresh', 'fresh')
+        assert cache.coalesced == 0
+
+    def test_failed_load_not_cached(self):
+        cache = AsyncTTLCache()
+
+        async def fail():
+            raise ConnectionError('pg is down')
+
+        async def run():
+            with pytest.raises(ConnectionError):
+                await cache.get_or_load('user', fail)
+            return await cache.get_or_load('user', Loader()(1))
+
+        assert asyncio.run(run()) == 1
+        assert len(cache) == 1
+
+
+@pytest.fixture
+def pg(monkeypatch):
+    users = {}
+    reads = []
+
+    async def get_user(self, user_id):
+        reads.append(('user', user_id))
+        return users.get(user_id)
+
+    async def add_user(self, user_id, username, **kwargs):
+        users[user_id] = {'id': user_id, 'username': username}
+
+    async def update_user(self, user_id, username=None, **kwargs):
+        users[user_id] = {**users[user_id], 'username': username}
+
+    async def get_dating_event(self, event_id, timezone='UTC'):
+        reads.append(('event', event_id))
+        return {'id': event_id}
+
+    async def set_event_state(self, event_id, state_id):
+        ...
+
+    for method in (get_user, add_user, update_user, get_dating_event, set_event_state):
+        monkeypatch.setattr(AsyncPgConnector, method.__name__, method)
+    connector = CachedPgConnector()
+    connector.reads = reads
+    return connector
+
+
+class TestCachedPgConnector:
+    def test_user_writes_invalidate_cache(self, pg):
+        async def run():
+            missing = await pg.get_user(1)
+            await pg.add_user(user_id=1, username='anna')
+            added = await pg.get_user(1)
+            await pg.get_user(1)
+            await pg.update_user(user_id=1, username='anna_k')
+            return missing, added, await pg.get_user(1)
+
+        missing, added, updated = asyncio.run(run())
+
+        assert missing is None
+        assert added['username'] == 'anna'
+        assert updated['username'] == 'anna_k'
+        assert pg.reads == [('user', 1)] * 3
+        assert pg.cache_stats['users']['hits'] == 1
+
+    def test_missing_user_not_cached(self, pg):
+        async def run():
+            await pg.get_user(1)
+            # added by another service
+            await AsyncPgConnector.add_user(pg, 1, 'anna')
+            return await pg.get_user(1)
+
+        assert asyncio.run(run())['username'] == 'anna'
+
+    def test_event_state_change_invalidates_events(self, pg):
+        async def run():
+            await pg.get_dating_event(5)
+            await pg.get_dating_event(5)
+            await pg.get_dating_event(5, timezone='Europe/Moscow')
+            await pg.set_event_state(5, 2)
+            await pg.get_dating_event(5)
+
+        asyncio.run(run())
+
+        assert pg.reads == [('event', 5)] * 3
+        assert pg.cache_stats['events']['hits'] == 1
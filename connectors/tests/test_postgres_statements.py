@@ -0,0 +1,87 @@
+import pickle
+from datetime import date
+
+import pytest
+
+from chathub_connectors.postgres_statements import (
+    STATEMENTS,
+    EventRow,
+    RegistrationRow,
+    UserRow,
+)
+
+
+def make_user(**values):
+    user = dict.fromkeys(UserRow.__slots__)
+    user.update(id=1, username='user1', birthday=date(1990, 1, 2), sex='f', city='city1')
+    user.update(values)
+    return UserRow(**user)
+
+
+class TestRows:
+    def test_record_api(self):
+        user = make_user(name='Anna')
+
+        assert user['name'] == 'Anna'
+        assert user.get('city') == 'city1'
+        assert user.get('unknown', 'default') == 'default'
+        assert dict(user)['birthday'] == date(1990, 1, 2)
+        assert list(user.keys()) == list(UserRow.__slots__)
+        assert len(user) == len(UserRow.__slots__)
+        assert list(user)[:2] == [1, 'user1']
+        with pytest.raises(KeyError):
+            user['unknown']
+
+    def test_no_instance_dict(self):
+        user = make_user()
+
+        assert not hasattr(user, '__dict__')
+        with pytest.raises(AttributeError):
+            user.unknown = 1
+
+    def test_equality(self):
+        assert make_user() == make_user()
+        assert make_user() != make_user(id=2)
+        assert EventRow(id=1, users_limit=20) != RegistrationRow(user_id=1)
+
+    def test_not_hashable(self):
+        with pytest.raises(TypeError):
+            hash(make_user())
+
+    def test_unknown_field(self):
+        with pytest.raises(TypeError):
+            UserRow(id=1, unknown=2)
+
+    def test_from_records(self):
+        # rows are filled by column name, whatever order the statement selects them in
+        registrations = RegistrationRow.from_records([
+            {'confirmation_event_sent': False, 'user_id': 1, 'extra': 'ignored'},
+            {'user_id': 2, 'confirmed_on_dttm': None, 'confirmation_event_sent': True},
+        ])
+
+        assert [r.user_id for r in registrations] == [1, 2]
+        assert registrations[0].confirmation_event_sent is False
+        assert registrations[1]['confirmation_event_sent'] is True
+        # columns the statement does not select
+        assert registrations[0].registered_on_dttm is None
+
+    def test_repr(self):
+        assert repr(EventRow(id=7, state_name='READY', users_limit=20)) == (
+            '<EventRow id=7 start_dttm=None state_name=\'READY\' registered=None users_limit=20>'
+        )
+
+    def test_pickle(self):
+        user = make_user()
+
+        assert pickle.loads(pickle.dumps(user)) == user
+
+
+class TestStatements:
+    def test_get_user_selects_row_columns(self):
+        assert ', '.join(UserRow.__slots__) in STATEMENTS['get_user']
+
+    @pytest.mark.parametrize('name', list(STATEMENTS))
+    def test_statements_are_static(self, name):
+        # statements are cached once per connection by text, so they can't depend on arguments
+        assert '{' not in STATEMENTS[name]
+        assert '$1' in STATEMENTS[name]
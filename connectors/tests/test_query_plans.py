@@ -0,0 +1,294 @@
+"""
+Query plan regression suite for AsyncPgConnector.
+
+Creates a throwaway database on a local Postgres, applies db/migrations, loads
+synthetic data and checks with EXPLAIN that every connector query reads the
+dating tables through indexes. Skipped unless a server is configured:
+
+    CHATHUB_TEST_POSTGRES_DSN=postgresql://postgres@localhost:5432/postgres \
+    QUERY_PLAN_TEST_USERS=20000 \
+    python -m pytest tests/test_query_plans.py
+
+The DSN user must be able to create databases and roles. The data size can only
+be raised above MIN_USERS: on smaller tables a sequential scan is the cheaper
+plan and the planner rightly picks it.
+"""
+import asyncio
+import json
+import os
+import re
+from contextlib import asynccontextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+
+import asyncpg
+import pytest
+
+from chathub_connectors.postgres_connector import AsyncPgConnector
+from chathub_connectors.postgres_statements import STATEMENTS
+
+POSTGRES_DSN = os.getenv('CHATHUB_TEST_POSTGRES_DSN')
+MIN_USERS = 10000
+USERS = max(int(os.getenv('QUERY_PLAN_TEST_USERS', MIN_USERS)), MIN_USERS)
+MIGRATIONS_DIR = Path(__file__).parents[2] / 'db' / 'migrations'
+DATABASE = f'chathub_query_plans_{os.getpid()}'
+# tables that grow with users and events, small lookup tables may be scanned
+CHECKED_TABLES = {
+    'users',
+    'images',
+    'dating_events',
+    'dating_registrations',
+    'dating_event_groups',
+    'likes',
+    'dislikes',
+    'event_matches',
+}
+ROLES = ['service_datemaker', 'service_bot', 'developer']
+
+pytestmark = pytest.mark.skipif(
+    not POSTGRES_DSN, reason='CHATHUB_TEST_POSTGRES_DSN is not set'
+)
+
+
+def migrations_up():
+    for path in sorted(MIGRATIONS_DIR.glob('*.sql')):
+        up = path.read_text().split('-- migrate:down')[0]
+        yield path.name, up.replace('-- migrate:up', '', 1)
+
+
+async def load_synthetic_data(conn: asyncpg.Connection, users: int):
+    """
+    `users` users, an event per 20 users (a year of past events and a month of
+    upcoming ones) with 40 registrations, 5 turns of 10 pairs in 2 groups,
+    2 images per user, 3 likes and dislikes per registration and matches of
+    all events but the first one.
+    """
+    events = max(users // 20, 10)
+    await conn.execute("""
+        INSERT INTO public.users (id, username, birthday, sex, city, rating, manual_score)
+        SELECT
+            i,
+            'user' || i,
+            DATE '1990-01-01' + (i % 7000),
+            CASE WHEN i % 2 = 0 THEN 'm' ELSE 'f' END,
+            'city' || (i % 20),
+            random() * 10,
+            2
+        FROM generate_series(1, $1::INT) AS i;
+    """, users)
+    await conn.execute("""
+        INSERT INTO public.dating_events (id, start_dttm, users_limit, state_id)
+        SELECT
+            i,
+            NOW() - INTERVAL '365 days' + (i * INTERVAL '395 days' / $1::INT),
+            20,
+            CASE WHEN i * 395 / $1::INT < 365 THEN 4 ELSE i % 3 END
+        FROM generate_series(1, $1::INT) AS i;
+    """, events)
+    await conn.execute("""
+        INSERT INTO public.dating_registrations
+            (user_id, event_id, confirmed_on_dttm, confirmation_event_sent, is_ready)
+        SELECT
+            (e * 37 + k) % $1::INT + 1,
+            e,
+            CASE WHEN k % 3 > 0 THEN NOW() END,
+            TRUE,
+            k % 2 = 0
+        FROM generate_series(1, $2::INT) AS e, generate_series(0, 39) AS k;
+    """, users, events)
+    await conn.execute("""
+        INSERT INTO public.dating_event_groups
+            (event_id, group_no, pair_no, turn_no, user_1_id, user_2_id)
+        SELECT
+            e,
+            g,
+            p,
+            t,
+            (e * 37 + g * 20 + p) % $1::INT + 1,
+            (e * 37 + g * 20 + 10 + (p + t) % 10) % $1::INT + 1
+        FROM generate_series(1, $2::INT) AS e,
+            generate_series(0, 1) AS g,
+            generate_series(0, 9) AS p,
+            generate_series(0, 4) AS t;
+    """, users, events)
+    await conn.execute("""
+        INSERT INTO public.images (owner, s3_bucket, s3_path, upload_dttm)
+        SELECT i % $1::INT + 1, 'bucket', 'path/' || i, NOW() - i * INTERVAL '1 minute'
+        FROM generate_series(0, 2 * $1::INT - 1) AS i;
+    """, users)
+    for table in ('likes', 'dislikes'):
+        await conn.execute(f"""
+            INSERT INTO public.{table} (source_user_id, target_user_id, event_id)
+            SELECT user_1_id, user_2_id, event_id
+            FROM public.dating_event_groups
+            WHERE turn_no < 3;
+            INSERT INTO public.{table} (source_user_id, target_user_id, event_id)
+            SELECT user_2_id, user_1_id, event_id
+            FROM public.dating_event_groups
+            WHERE turn_no < 3 AND (user_1_id + turn_no) % 2 = 0;
+        """)
+    await conn.execute("""
+        INSERT INTO public.event_matches (event_id, user_1_id, user_2_id)
+        SELECT DISTINCT event_id, user_1_id, user_2_id
+        FROM public.matches
+        WHERE event_id > 1;
+    """)
+    await conn.execute('ANALYZE;')
+
+
+async def create_database():
+    conn = await asyncpg.connect(POSTGRES_DSN)
+    try:
+        for role in ROLES:
+            await conn.execute(f"""
+                DO $$ BEGIN
+                    CREATE ROLE {role};
+                EXCEPTION WHEN duplicate_object THEN NULL;
+                END $$;
+            """)
+        await conn.execute(f'DROP DATABASE IF EXISTS {DATABASE};')
+        await conn.execute(f'CREATE DATABASE {DATABASE};')
+    finally:
+        await conn.close()
+
+    conn = await asyncpg.connect(POSTGRES_DSN, database=DATABASE)
+    try:
+        for name, migration in migrations_up():
+            try:
+                await conn.execute(migration)
+            except asyncpg.PostgresError as e:
+                raise RuntimeError(f'Migration {name} failed: {e}') from e
+        await load_synthetic_data(conn, USERS)
+    finally:
+        await conn.close()
+
+
+async def drop_database():
+    conn = await asyncpg.connect(POSTGRES_DSN)
+    try:
+        await conn.execute(f'DROP DATABASE IF EXISTS {DATABASE} WITH (FORCE);')
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(scope='module')
+def database():
+    asyncio.run(create_database())
+    yield DATABASE
+    asyncio.run(drop_database())
+
+
+class ExplainingConnection:
+    """
+    Connection proxy that explains every query before running it.
+    """
+
+    def __init__(self, conn: asyncpg.Connection, plans: list):
+        self._conn = conn
+        self._plans = plans
+
+    async def _explain(self, query: str, args):
+        plan = await self._conn.fetchval(f'EXPLAIN (FORMAT JSON) {query}', *args)
+        self._plans.append((query, json.loads(plan)[0]['Plan']))
+
+    async def fetch(self, query, *args):
+        await self._explain(query, args)
+        return await self._conn.fetch(query, *args)
+
+    async def fetchrow(self, query, *args):
+        await self._explain(query, args)
+        return await self._conn.fetchrow(query, *args)
+
+    async def fetchval(self, query, *args):
+        await self._explain(query, args)
+        return await self._conn.fetchval(query, *args)
+
+    async def execute(self, query, *args):
+        await self._explain(query, args)
+        return await self._conn.execute(query, *args)
+
+
+class ExplainingPool:
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+        self.plans = []
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self._pool.acquire() as conn:
+            yield ExplainingConnection(conn, self.plans)
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def sequential_scans(plan: dict):
+    return [
+        node['Relation Name'] for node in plan_nodes(plan)
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in CHECKED_TABLES
+    ]
+
+
+USER = {'id': 1}
+UPCOMING_EVENT = max(USERS // 20, 10)
+QUERIES = {
+    'get_user': lambda pg: pg.get_user(1),
+    'get_users': lambda pg: pg.get_users([1, 2, 3]),
+    'get_confirmed_event_users': lambda pg: pg.get_confirmed_event_users(1),
+    'get_images_by_owner': lambda pg: pg.get_images_by_owner(1),
+    'update_user': lambda pg: pg.update_user(1, city='city1'),
+    'get_dating_events': lambda pg: pg.get_dating_events(),
+    'get_dating_events_for_user': lambda pg: pg.get_dating_events(user=USER),
+    'get_dating_event': lambda pg: pg.get_dating_events(event_id=1, include_finished=True),
+    'get_scheduled_events': lambda pg: pg.get_scheduled_events(),
+    'get_event_registrations': lambda pg: pg.get_event_registrations(1),
+    'save_event_confirmation_sent':
+        lambda pg: pg.save_event_confirmation_sent(event_id=1, user_ids=[38, 39]),
+    'get_event_participants': lambda pg: pg.get_event_participants(1),
+    'register_for_event': lambda pg: pg.register_for_event(USER, UPCOMING_EVENT),
+    'confirm_registration': lambda pg: pg.confirm_registration(USER, UPCOMING_EVENT),
+    'cancel_registration': lambda pg: pg.cancel_registration(USER, UPCOMING_EVENT),
+    'get_event_registrations_for_user': lambda pg: pg.get_event_registrations_for_user(USER),
+    'set_event_state': lambda pg: pg.set_event_state(UPCOMING_EVENT, 1),
+    'get_event_data': lambda pg: pg.get_event_data(1),
+    'set_user_ready_to_start': lambda pg: pg.set_user_ready_to_start(38, 1),
+    'are_all_event_users_ready': lambda pg: pg.are_all_event_users_ready(1),
+    'compute_event_matches': lambda pg: pg.compute_event_matches(1),
+    'get_user_matches': lambda pg: pg.get_user_matches(38, 1),
+}
+
+
+async def explain_queries(name: str):
+    url = urlparse(POSTGRES_DSN)
+    connector = AsyncPgConnector(
+        host=url.hostname or 'localhost',
+        port=url.port or 5432,
+        db=DATABASE,
+        username=url.username,
+        password=url.password,
+    )
+    pool = await asyncpg.create_pool(POSTGRES_DSN, database=DATABASE, min_size=1, max_size=1)
+    explaining_pool = ExplainingPool(pool)
+    connector.pool = explaining_pool
+    try:
+        await QUERIES[name](connector)
+    finally:
+        connector.pool = None
+        await pool.close()
+    return explaining_pool.plans
+
+
+@pytest.mark.parametrize('name', list(QUERIES))
+def test_query_uses_indexes(database, name):
+    plans = asyncio.run(explain_queries(name))
+
+    assert plans, f'{name} did not run any query'
+    for query, plan in plans:
+        scans = sequential_scans(plan)
+        query = re.sub(r'\s+', ' ', query).strip()
+        assert not scans, (
+            f'{name} scans {scans} sequentially:\n{query}\n{json.dumps(plan, indent=2)}'
+        )
@@ -83,7 +83,7 @@ if BOT_VARIABLES_LOADED.lower() == 'false':
     module_logger.info(f'Environment variables loaded: {BOT_VARIABLES_LOADED}')
 
 DEBUG = os.getenv('DEBUG', 'false')
-# all parameters from RabbitMQConnector (0.0.3)
+# all parameters from AIORabbitMQConnector
 MESSAGE_BROKER_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
 MESSAGE_BROKER_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
 MESSAGE_BROKER_VIRTUAL_HOST = os.getenv('RABBITMQ_VIRTUAL_HOST', '/')
@@ -94,6 +94,13 @@ MESSAGE_BROKER_PASSWORD = os.getenv('DATEMAKER_RABBITMQ_PASSWORD', 'guest')
 # all parameters from GoogleMeetApiController
 MEET_CREDS_FILE = os.getenv('MEET_CREDS_FILE')
 MEET_TOKEN_FILE = os.getenv('MEET_TOKEN_FILE')
+# meet spaces created at once, idle spaces kept for next rounds, calls of an event per space
+MEET_SPACE_CREATE_CONCURRENCY = int(os.getenv('MEET_SPACE_CREATE_CONCURRENCY', '10'))
+MEET_SPACE_POOL_MAX_IDLE = int(os.getenv('MEET_SPACE_POOL_MAX_IDLE', '200'))
+MEET_SPACE_MAX_USES = int(os.getenv('MEET_SPACE_MAX_USES', '10'))
+# calls ended at once at the end of a round and seconds to wait for every one
+MEET_END_CALL_CONCURRENCY = int(os.getenv('MEET_END_CALL_CONCURRENCY', '20'))
+MEET_END_CALL_TIMEOUT = float(os.getenv('MEET_END_CALL_TIMEOUT', '10'))
 # all parameters for AsyncPgConnector
 POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
 POSTGRES_PORT = int(os.getenv('POSTGRES_PORT', '5432'))
@@ -101,5 +108,20 @@ POSTGRES_DB = os.getenv('POSTGRES_DB', '')
 POSTGRES_USER = os.getenv('DATEMAKER_POSTGRES_USER', '')
 POSTGRES_PASSWORD = os.getenv('DATEMAKER_POSTGRES_PASSWORD', '')
 
+# matchmaking
+MATCHMAKING_ASSIGNMENT_SOLVER = os.getenv('MATCHMAKING_ASSIGNMENT_SOLVER', 'optimal')
+MATCHMAKING_WORKERS = int(os.getenv('MATCHMAKING_WORKERS', '2'))
+
+# max concurrent publishes when notifying all event participants
+FAN_OUT_CONCURRENCY = int(os.getenv('FAN_OUT_CONCURRENCY', '50'))
+# max recipients of one batch bot command message, 0 for a message per recipient
+# (bots older than the batch envelope reject batches)
+BOT_BATCH_SIZE = int(os.getenv('BOT_BATCH_SIZE', '1000'))
+# max of incoming commands (register, confirm, list...) processed at once
+COMMAND_CONCURRENCY = int(os.getenv('COMMAND_CONCURRENCY', '20'))
+
 TG_BOT_ROUTING_KEY = 'tg_bot_dev' if DEBUG.lower() == 'true' else 'tg_bot_prod'
 RABBITMQ_EXCHANGE = 'chathub_direct_main'
+# postgres NOTIFY channels, see db migrations notify_dating_*_changes
+DATING_EVENTS_CHANGED_CHANNEL = 'dating_events_changed'
+DATING_REGISTRATIONS_CHANGED_CHANNEL = 'dating_registrations_changed'
@@ -35,7 +35,7 @@ if __name__ == "__main__":
         # all parameters from GoogleMeetApiController
         meet_creds_file=MEET_CREDS_FILE,
         meet_token_file=MEET_TOKEN_FILE,
-        # all parameters from RabbitMQConnector (0.0.3)
+        # all parameters from AIORabbitMQConnector
         message_broker_host=MESSAGE_BROKER_HOST,
         message_broker_port=MESSAGE_BROKER_PORT,
         message_broker_virtual_host=MESSAGE_BROKER_VIRTUAL_HOST,
@@ -0,0 +1,136 @@
+"""
+Assignment stage of the matchmaking pipeline.
+
+Given a (target x additive) compatibility matrix, a solver picks at most one
+additive partner for every target user. Solvers are interchangeable, the agent
+gets one by name with `get_assignment_solver`.
+"""
+import abc
+import time
+from typing import Dict, Type
+
+import numpy as np
+
+from datemaker import setup_logger
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # pragma: no cover - depends on environment
+    linear_sum_assignment = None
+
+LOGGER = setup_logger(__name__)
+
+
+class AssignmentResult:
+    """
+    Pairs chosen by a solver: `rows[i]` (target position in the matrix) is matched
+    with `columns[i]` (additive position in the matrix).
+    """
+
+    def __init__(
+            self,
+            rows: np.ndarray,
+            columns: np.ndarray,
+            total_score: float,
+            wall_time: float,
+            solver: str,
+    ):
+        self.rows = rows
+        self.columns = columns
+        self.total_score = total_score
+        self.wall_time = wall_time
+        self.solver = solver
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return (
+            f'AssignmentResult(solver={self.solver}, pairs={len(self)}, '
+            f'total_score={self.total_score}, wall_time={self.wall_time:.3f}s)'
+        )
+
+
+class AssignmentSolver(abc.ABC):
+    name: str = ''
+
+    def assign(self, scores: np.ndarray, priority: np.ndarray) -> AssignmentResult:
+        """
+        Run the solver and measure it.
+
+        :param scores: Compatibility matrix, rows are target users, columns are additive.
+        :param priority: Row positions ordered from the most to the least prioritized
+                    target user. Solvers that do not depend on order ignore it.
+        :return: Chosen pairs with their total matrix score and solver wall time.
+        """
+        start = time.perf_counter()
+        if scores.size:
+            rows, columns = self._solve(scores, priority)
+        else:
+            rows, columns = np.empty(0, dtype=int), np.empty(0, dtype=int)
+        wall_time = time.perf_counter() - start
+        return AssignmentResult(
+            rows=rows,
+            columns=columns,
+            total_score=scores[rows, columns].sum().item() if len(rows) else 0,
+            wall_time=wall_time,
+            solver=self.name,
+        )
+
+    @abc.abstractmethod
+    def _solve(self, scores: np.ndarray, priority: np.ndarray):
+        ...
+
+
+class GreedyAssignmentSolver(AssignmentSolver):
+    """
+    Walks target users in priority order, each one takes the best free partner.
+    """
+    name = 'greedy'
+
+    def _solve(self, scores: np.ndarray, priority: np.ndarray):
+        taken = np.zeros(scores.shape[1], dtype=bool)
+        rows, columns = [], []
+        for row in priority:
+            if taken.all():
+                # all potential matches are taken, the rest stays without a pair
+                break
+            column = int(np.argmax(np.where(taken, -np.inf, scores[row])))
+            taken[column] = True
+            rows.append(row)
+            columns.append(column)
+        order = np.argsort(rows)
+        return np.asarray(rows, dtype=int)[order], np.asarray(columns, dtype=int)[order]
+
+
+class OptimalAssignmentSolver(AssignmentSolver):
+    """
+    Maximizes the total compatibility over all pairs (rectangular linear sum
+    assignment, scipy uses a Jonker-Volgenant variant of the Hungarian method).
+    """
+    name = 'optimal'
+
+    def _solve(self, scores: np.ndarray, priority: np.ndarray):
+        return linear_sum_assignment(scores, maximize=True)
+
+
+ASSIGNMENT_SOLVERS: Dict[str, Type[AssignmentSolver]] = {
+    GreedyAssignmentSolver.name: GreedyAssignmentSolver,
+    OptimalAssignmentSolver.name: OptimalAssignmentSolver,
+}
+
+
+def get_assignment_solver(name: str) -> AssignmentSolver:
+    """
+    :param name: One of `ASSIGNMENT_SOLVERS` keys.
+    :return: Solver instance. Falls back to the greedy solver when the optimal one
+             is requested but scipy is not installed.
+    """
+    if name not in ASSIGNMENT_SOLVERS:
+        raise ValueError(
+            f'Unknown assignment solver {name}, possible values: {list(ASSIGNMENT_SOLVERS)}'
+        )
+    if name == OptimalAssignmentSolver.name and linear_sum_assignment is None:
+        LOGGER.warning('scipy is not installed, falling back to greedy assignment')
+        name = GreedyAssignmentSolver.name
+    return ASSIGNMENT_SOLVERS[name]()
@@ -1,12 +1,11 @@
 import asyncio
-import json
 import time
 from asyncio import sleep, AbstractEventLoop
 from datetime import datetime, timedelta
+from typing import Dict, List
 
 import pandas as pd
-from google.api_core.exceptions import FailedPrecondition
-from grpc.aio import AioRpcError
+from google.apps.meet_v2 import Space
 from tzlocal import get_localzone
 
 from chathub_connectors.postgres_connector import AsyncPgConnector
@@ -16,12 +15,12 @@ from datemaker import (
     EventStateIDs,
     BotCommands,
     DEBUG,
-    TG_BOT_ROUTING_KEY,
-    RABBITMQ_EXCHANGE,
 )
+from .fan_out import BotCommandFanOut, BotCommandMessage, bot_batch_messages, bot_command_message
 from .finite_state_machine import FiniteStateMachine, State
 from .intelligent_agent import IntelligentAgent
 from .meet_api_controller import GoogleMeetApiController
+from .space_pool import MeetSpacePool
 
 LOGGER = setup_logger(__name__)
 
@@ -32,6 +31,9 @@ class DateRunner:
     """
 
     send_rules_offset = timedelta(minutes=5)  # await asyncio.sleep(300) below
+    # time after the final message to rate the partners of the last round,
+    # matches are computed when it closes
+    rating_window = timedelta(seconds=1) if DEBUG.lower() == 'true' else timedelta(minutes=5)
 
     def __init__(
             self,
@@ -42,7 +44,12 @@ class DateRunner:
             rabbitmq_controller: AIORabbitMQConnector,
             custom_event_loop: AbstractEventLoop = None,
             debug: bool = False,
+            space_pool: MeetSpacePool = None,
     ):
+        """
+        :param space_pool: Pool of meet spaces shared by events, the runner
+                    gets its own one by default.
+        """
         self.event_id = event_id
         self.start_time = start_time
         self.meet_api = meet_api_controller
@@ -53,10 +60,18 @@ class DateRunner:
         # data created in RegistrationConfirmationRunner
         self.event_data: pd.DataFrame | None = None
         self.user_ids_in_event = list
-        self.meeting_spaces = []
+        self.space_pool = space_pool or MeetSpacePool(meet_api_controller)
+        # spaces of every running round, shared by the state machines of all groups
+        self.round_spaces: Dict[int, asyncio.Future] = {}
+        # the final of the event, run once for the state machines of all groups
+        self._final: asyncio.Future | None = None
+        # seconds from the end of a round until calls are stopped and the break message is sent
+        self.last_break_transition = 0.0
+        self.max_break_transition = 0.0
         self.state_start_time = None
         self.is_ready_to_start = False  # flag when state machine is ready to start rounds
         self.participants = None
+        self.fan_out = BotCommandFanOut(rabbitmq_controller)
         loop = custom_event_loop or asyncio.get_event_loop()
         self.intelligence_agent = IntelligentAgent(loop, postgres_controller, debug=self.debug)
         LOGGER.info(
@@ -96,17 +111,10 @@ class DateRunner:
         self.participants = await self.postgres.get_event_participants(self.event_id)
 
     async def trigger_bot_to_send_rules(self):
-        for user in self.participants:
-            await self.rabbitmq.publish(
-                message=BotCommands.SEND_RULES.value,
-                routing_key=TG_BOT_ROUTING_KEY,
-                exchange=RABBITMQ_EXCHANGE,
-                headers={
-                    'user_id': user.get('user_id'),
-                    'chat_id': user.get('user_id'),
-                    'event_id': self.event_id,
-                }
-            )
+        await self.fan_out.publish(
+            self._bot_batch(BotCommands.SEND_RULES, [user.get('user_id') for user in self.participants]),
+            name=BotCommands.SEND_RULES.value,
+        )
         LOGGER.debug(f'Sent rules to {len(self.participants)} users')
 
     async def get_event_prepared_data(self):
@@ -195,10 +203,16 @@ class DateRunner:
     async def run_dating_round(self, round_num: int):
         LOGGER.info(f'State machine is running dating round #{round_num}')
         round_pairs = self.event_data.loc[self.event_data.turn_no == round_num]
-        for i, row in round_pairs.iterrows():
-            assert round_pairs.shape[0] <= len(self.meeting_spaces)
-            await self.invite_to_meet_room(row, i)
-            await self.send_partner_profiles(row)
+        spaces = await self.get_round_spaces(round_num, round_pairs.shape[0])
+        invites, profiles = [], []
+        for space, (_, row) in zip(spaces, round_pairs.iterrows()):
+            invites.extend(self.invite_to_meet_room(row, space))
+            profiles.extend(self.send_partner_profiles(row))
+        # a lost invite means a lost date, invites wait for broker confirms
+        await asyncio.gather(
+            self.fan_out.publish(invites, name=f'round #{round_num} invites', confirm=True),
+            self.fan_out.publish(profiles, name=f'round #{round_num} profiles'),
+        )
 
     async def run_dating_break(self, round_num: int):
         """
@@ -214,26 +228,68 @@ class DateRunner:
         :type round_num: int
         """
         LOGGER.info('State machine is in dating break')
-        await self.stop_active_spaces()
+        start = time.perf_counter()
+        # calls end and users learn about the break at the same time
+        stopped, _ = await asyncio.gather(
+            self.stop_active_spaces(round_num),
+            self.fan_out.publish(
+                self._bot_batch(BotCommands.SEND_BREAK_MESSAGE, self.user_ids_in_event),
+                name=BotCommands.SEND_BREAK_MESSAGE.value,
+            ),
+        )
+        self.last_break_transition = time.perf_counter() - start
+        self.max_break_transition = max(self.max_break_transition, self.last_break_transition)
+        LOGGER.info(
+            f'Break of round #{round_num} of event#{self.event_id} started in '
+            f'{self.last_break_transition:.3f}s: {stopped} calls stopped, '
+            f'break message sent to {len(self.user_ids_in_event)} users'
+        )
         round_pairs = self.event_data.loc[self.event_data.turn_no == round_num]
 
-        for user_id in self.user_ids_in_event:
-            await self.send_break_message(user_id)
-        LOGGER.debug(f'Sent break message to {len(self.user_ids_in_event)} users')
-
+        commands = []
         for _, row in round_pairs.iterrows():
-            await self.ask_to_rate_partner(row)
+            commands.extend(self.ask_to_rate_partner(row))
             # implement later
-            # await self.ask_to_verify_partner_profile(row)
+            # commands.extend(self.ask_to_verify_partner_profile(row))
+        await self.fan_out.publish(
+            commands,
+            name=BotCommands.SEND_PARTNER_RATING_REQUEST.value,
+            confirm=True,
+        )
 
     async def run_dating_final(self):
+        """
+        Finishes the event once, the state machines of all groups wait for it.
+        """
         LOGGER.info('State machine is finishing dating event')
-        for uid in self.user_ids_in_event:
-            await self.send_final_event_message(uid)
+        if self._final is None:
+            self._final = asyncio.ensure_future(self._finish_event())
+        await self._final
+
+    async def _finish_event(self):
+        for round_num in list(self.round_spaces):
+            await self.stop_active_spaces(round_num)
+        # participants know the links of the spaces, other events get new ones
+        dropped = self.space_pool.drain(self.event_id)
+        LOGGER.debug(f'Dropped {dropped} meet spaces of event#{self.event_id}')
+        LOGGER.info(
+            f'Meet space pool after event#{self.event_id}: {self.space_pool.stats}, '
+            f'longest break transition {self.max_break_transition:.3f}s'
+        )
+        await self.fan_out.publish(
+            self._bot_batch(BotCommands.SEND_FINAL_DATING_MESSAGE, self.user_ids_in_event),
+            name=BotCommands.SEND_FINAL_DATING_MESSAGE.value,
+        )
         LOGGER.debug(f'Sent final message to {len(self.user_ids_in_event)} users')
 
-        for uid in self.user_ids_in_event:
-            await self.send_matches_message(uid)
+        # ratings of the last round come after its break
+        await sleep(self.rating_window.total_seconds())
+        # matches are computed once, the bot reads them for every participant
+        await self.postgres.compute_event_matches(self.event_id)
+        await self.fan_out.publish(
+            self._bot_batch(BotCommands.SEND_MATCH_MESSAGE, self.user_ids_in_event),
+            name=BotCommands.SEND_MATCH_MESSAGE.value,
+        )
 
         self.running = False
         await self.set_event_state(EventStateIDs.FINISHED)
@@ -250,21 +306,44 @@ class DateRunner:
 
     async def create_spaces_for_event(self):
         """
-        Create N spaces where N is the pair count in every round
+        Pre-warm the space pool for the round with the most pairs: rounds of
+        all groups run at the same time and their spaces are reused in the next
+        round.
         """
-        for i in range(self.event_data.shape[0]):
-            self.meeting_spaces.append(await self.meet_api.create_public_space())
+        pairs = int(self.event_data.groupby('turn_no').size().max()) if len(self.event_data) else 0
+        await self.space_pool.prewarm(pairs)
+        LOGGER.debug(
+            f'Meet space pool is ready for {pairs} pairs of event#{self.event_id}: '
+            f'{self.space_pool.stats}'
+        )
 
-        LOGGER.debug(f'Created {len(self.meeting_spaces)} meeting spaces for event#{self.event_id}')
+    async def get_round_spaces(self, round_num: int, pairs: int) -> List[Space]:
+        """
+        Spaces of the round pairs, taken from the pool once for all groups.
+        """
+        if round_num not in self.round_spaces:
+            self.round_spaces[round_num] = asyncio.ensure_future(self.space_pool.acquire_many(pairs, self.event_id))
+        return await self.round_spaces[round_num]
 
-    async def stop_active_spaces(self):
-        for space in self.meeting_spaces:
-            try:
-                await self.meet_api.end_active_call(space)
-            except (AioRpcError, FailedPrecondition):
-                LOGGER.warning('In some meetings were no participants...')
+    async def stop_active_spaces(self, round_num: int) -> int:
+        """
+        End the calls of the round concurrently and put its spaces back to the
+        pool. Spaces of other rounds are not touched.
+        :return: Number of spaces of the round.
+        """
+        spaces = self.round_spaces.pop(round_num, None)
+        if spaces is None:
+            # stopped by the state machine of another group
+            return 0
+        try:
+            spaces = await spaces
+        except Exception as e:
+            LOGGER.warning(f'Round #{round_num} of event#{self.event_id} had no spaces: {e}')
+            return 0
+        await self.space_pool.release_many(spaces, self.event_id)
 
-        LOGGER.debug(f'Stopped all active meetings for event#{self.event_id}')
+        LOGGER.debug(f'Stopped {len(spaces)} active meetings of round #{round_num} of event#{self.event_id}')
+        return len(spaces)
 
     async def check_all_users_are_ready(self, send_requests: bool = False):
         """
@@ -273,11 +352,10 @@ class DateRunner:
         :return: True if all users are ready, false otherwise.
         """
         if send_requests:
-            for uid in self.user_ids_in_event:
-                await self.trigger_bot_command(
-                    command=BotCommands.SEND_READY_FOR_EVENT_REQUEST,
-                    user_id=uid,
-                )
+            await self.fan_out.publish(
+                self._bot_batch(BotCommands.SEND_READY_FOR_EVENT_REQUEST, self.user_ids_in_event),
+                name=BotCommands.SEND_READY_FOR_EVENT_REQUEST.value,
+            )
             LOGGER.debug(f'Sent ready for event requests to {len(self.user_ids_in_event)} users')
         are_all_ready = await self.postgres.are_all_event_users_ready(self.event_id)
         LOGGER.debug(f'All users are ready from DB: {are_all_ready}, debug: {DEBUG}')
@@ -292,99 +370,67 @@ class DateRunner:
         LOGGER.debug(f'Found event#{self.event_id} start time: {start_time}')
         return start_time
 
-    async def invite_to_meet_room(self, row: pd.Series, room_number: int):
+    def invite_to_meet_room(self, row: pd.Series, space: Space) -> List[BotCommandMessage]:
         """
         Invite users to their new meet rooms
         :param row: DF row containing user_1_id and user_2_id and some additional data
-        :param room_number:
+        :param space: Meet space of the pair.
         """
-        await self.trigger_bot_command(
-            command=BotCommands.INVITE_TO_MEETING,
-            user_id=int(row.user_1_id),
-            data={
-                'url': self.meeting_spaces[room_number].meeting_uri
-            },
-        )
-        await self.trigger_bot_command(
-            command=BotCommands.INVITE_TO_MEETING,
-            user_id=int(row.user_2_id),
-            data={
-                'url': self.meeting_spaces[room_number].meeting_uri
-            },
-        )
+        data = {'url': space.meeting_uri}
+        return [
+            self._bot_command(BotCommands.INVITE_TO_MEETING, int(row.user_1_id), data),
+            self._bot_command(BotCommands.INVITE_TO_MEETING, int(row.user_2_id), data),
+        ]
 
-    async def send_partner_profiles(self, row: pd.Series):
+    def send_partner_profiles(self, row: pd.Series) -> List[BotCommandMessage]:
         """
         Send dating round partner's profiles to each other.
         :param row: DF row containing user_1_id and user_2_id and some additional data
         :return:
         """
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_PARTNER_PROFILE,
-            user_id=0,
-            data={
-                'partners': [int(row.user_1_id), int(row.user_2_id)]
-            },
-        )
-
-    async def ask_to_rate_partner(self, row: pd.Series):
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_PARTNER_RATING_REQUEST,
-            user_id=int(row.user_1_id),
-            data={
-                'partner_id': int(row.user_2_id)
-            },
-        )
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_PARTNER_RATING_REQUEST,
-            user_id=int(row.user_2_id),
-            data={
-                'partner_id': int(row.user_1_id)
-            },
-        )
-
-    async def ask_to_verify_partner_profile(self, row: pd.Series):
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_PARTNER_PROFILE_VERIFICATION_REQUEST,
-            user_id=int(row.user_1_id),
-            data={
-                'partner_id': int(row.user_2_id)
-            },
-        )
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_PARTNER_PROFILE_VERIFICATION_REQUEST,
-            user_id=int(row.user_2_id),
-            data={
-                'partner_id': int(row.user_1_id)
-            },
-        )
-
-    async def send_break_message(self, user_id: int):
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_BREAK_MESSAGE,
-            user_id=user_id,
-        )
-
-    async def send_final_event_message(self, user_id: int):
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_FINAL_DATING_MESSAGE,
-            user_id=user_id,
-        )
-
-    async def send_matches_message(self, user_id: int):
-        await self.trigger_bot_command(
-            command=BotCommands.SEND_MATCH_MESSAGE,
-            user_id=user_id,
-        )
-
-    async def trigger_bot_command(self, command: BotCommands, user_id: int, data: dict = None):
-        await self.rabbitmq.publish(
-            message=json.dumps({command.value: data}),
-            routing_key=TG_BOT_ROUTING_KEY,
-            exchange=RABBITMQ_EXCHANGE,
-            headers={
-                'user_id': user_id,
-                'chat_id': user_id,
-                'event_id': self.event_id,
-            }
-        )
+        return [
+            self._bot_command(
+                BotCommands.SEND_PARTNER_PROFILE,
+                user_id=0,
+                data={'partners': [int(row.user_1_id), int(row.user_2_id)]},
+            ),
+        ]
+
+    def ask_to_rate_partner(self, row: pd.Series) -> List[BotCommandMessage]:
+        return [
+            self._bot_command(
+                BotCommands.SEND_PARTNER_RATING_REQUEST,
+                int(row.user_1_id),
+                {'partner_id': int(row.user_2_id)},
+            ),
+            self._bot_command(
+                BotCommands.SEND_PARTNER_RATING_REQUEST,
+                int(row.user_2_id),
+                {'partner_id': int(row.user_1_id)},
+            ),
+        ]
+
+    def ask_to_verify_partner_profile(self, row: pd.Series) -> List[BotCommandMessage]:
+        return [
+            self._bot_command(
+                BotCommands.SEND_PARTNER_PROFILE_VERIFICATION_REQUEST,
+                int(row.user_1_id),
+                {'partner_id': int(row.user_2_id)},
+            ),
+            self._bot_command(
+                BotCommands.SEND_PARTNER_PROFILE_VERIFICATION_REQUEST,
+                int(row.user_2_id),
+                {'partner_id': int(row.user_1_id)},
+            ),
+        ]
+
+    def _bot_command(
+            self,
+            command: BotCommands,
+            user_id: int,
+            data: dict = None,
+    ) -> BotCommandMessage:
+        return bot_command_message(command, user_id, self.event_id, data)
+
+    def _bot_batch(self, command: BotCommands, user_ids: List[int]) -> List[BotCommandMessage]:
+        return bot_batch_messages(command, list(user_ids), self.event_id)
@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from asyncpg import Record
+
+from datemaker import setup_logger
+
+LOGGER = setup_logger(__name__)
+
+# deadline, event id, state name
+ScheduledTransition = Tuple[datetime, int, str]
+
+
+class EventScheduler:
+    """
+    Starts event runners exactly at the time of the next event transition.
+
+    Upcoming events are kept in a heap keyed by their transition time: start time
+    minus the offset of the current event state (e.g. rules are sent 5 minutes
+    before the start). The scheduler sleeps until the earliest deadline and is woken
+    up earlier by `notify`, then events are reloaded from the database. A full
+    reload also happens every `resync_interval` in case a notification was lost.
+
+    There is at most one runner per event id: a due event whose previous runner is
+    still active is skipped, events are reloaded when any runner finishes. A runner
+    that failed or left the event in the same state is not restarted before
+    `retry_delay` passes, the next state of the event is due at its own time.
+    A failed reload is retried after `retry_delay` too.
+    """
+
+    def __init__(
+            self,
+            load_events: Callable[[], Awaitable[List[Record]]],
+            start_runner: Callable[[dict], Awaitable],
+            transition_offsets: Dict[str, timedelta],
+            resync_interval: float = 600,
+            retry_delay: timedelta = timedelta(minutes=1),
+            now: Callable[[], datetime] = datetime.now,
+    ):
+        """
+        :param load_events: Returns upcoming events with id, start_dttm and state_name.
+        :param start_runner: Returns awaitable running the transition of a due event,
+                    gets a dict with event id, start_dttm and state_name.
+        :param transition_offsets: How long before the start time an event in the
+                    state is due. Events in other states are ignored.
+        :param resync_interval: Max seconds between two reloads of events.
+        :param retry_delay: Delay before a runner of the same event is started again.
+        :param now: Current time, in the same timezone as events start time.
+        """
+        self.load_events = load_events
+        self.start_runner = start_runner
+        self.transition_offsets = transition_offsets
+        self.resync_interval = resync_interval
+        self.retry_delay = retry_delay
+        self.now = now
+        self.runners: Dict[int, asyncio.Task] = {}
+        self._retry_after: Dict[Tuple[int, str], datetime] = {}
+        self._heap: List[ScheduledTransition] = []
+        self._wake_up = asyncio.Event()
+        self._reload_requested = True
+
+    @property
+    def next_deadline(self) -> datetime | None:
+        return self._heap[0][0] if self._heap else None
+
+    def notify(self, payload: str = ''):
+        """
+        Wake the scheduler up to reload events, e.g. when `dating_events` changed.
+        """
+        LOGGER.debug(f'Events reload requested ({payload})')
+        self._reload_requested = True
+        self._wake_up.set()
+
+    async def run(self):
+        while True:
+            reload_failed = False
+            if self._reload_requested:
+                self._reload_requested = False
+                try:
+                    await self.reload()
+                except Exception as e:
+                    # events scheduled before are still started
+                    LOGGER.error(f'Failed to reload events, retrying in {self.retry_delay}: {e}')
+                    reload_failed = True
+            self.start_due_runners()
+            self._wake_up.clear()
+            timeout = self._seconds_to_sleep()
+            if reload_failed:
+                timeout = min(timeout, self.retry_delay.total_seconds())
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), timeout)
+            except asyncio.TimeoutError:
+                if reload_failed or not self._heap or self.next_deadline > self.now():
+                    # nothing was due, it is the periodic resync
+                    self._reload_requested = True
+
+    async def reload(self):
+        events = await self.load_events()
+        now = self.now()
+        self._retry_after = {
+            transition: retry_after
+            for transition, retry_after in self._retry_after.items()
+            if retry_after > now
+        }
+        heap = []
+        for event in events:
+            offset = self.transition_offsets.get(event.get('state_name'))
+            if offset is None:
+                continue
+            deadline = max(
+                event.get('start_dttm') - offset,
+                self._retry_after.get((event.get('id'), event.get('state_name')), datetime.min),
+            )
+            heap.append((deadline, event.get('id'), event.get('state_name')))
+        heapq.heapify(heap)
+        self._heap = heap
+        LOGGER.debug(
+            f'Scheduled {len(heap)} event transitions, next one at {self.next_deadline}'
+        )
+
+    def start_due_runners(self):
+        now = self.now()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, event_id, state_name = heapq.heappop(self._heap)
+            if event_id in self.runners:
+                LOGGER.debug(f'Runner for event#{event_id} is already active, skipping')
+                continue
+            LOGGER.info(
+                f'Starting {state_name} runner for event#{event_id}, '
+                f'{(now - deadline).total_seconds():.1f}s after its deadline'
+            )
+            task = asyncio.ensure_future(self.start_runner({
+                'id': event_id,
+                'start_dttm': deadline + self.transition_offsets[state_name],
+                'state_name': state_name,
+            }))
+            self.runners[event_id] = task
+            task.add_done_callback(
+                lambda done, eid=event_id, state=state_name: self._on_runner_done(eid, state, done)
+            )
+
+    def _on_runner_done(self, event_id: int, state_name: str, task: asyncio.Task):
+        self.runners.pop(event_id, None)
+        if not task.cancelled() and task.exception():
+            LOGGER.error(f'Runner for event#{event_id} failed: {task.exception()}')
+        # only delays the event if it is still in the state that was just run
+        self._retry_after[(event_id, state_name)] = self.now() + self.retry_delay
+        # the runner has moved the event to its next state
+        self.notify(f'runner for event#{event_id} finished')
+
+    def _seconds_to_sleep(self) -> float:
+        if not self._heap:
+            return self.resync_interval
+        until_deadline = (self.next_deadline - self.now()).total_seconds()
+        return max(0.0, min(until_deadline, self.resync_interval))
@@ -0,0 +1,151 @@
+import time
+from typing import List, Tuple, Optional
+
+from chathub_connectors.envelope import Envelope
+from chathub_connectors.rabbitmq_connector import AIORabbitMQConnector
+from datemaker import (
+    setup_logger,
+    BotCommands,
+    TG_BOT_ROUTING_KEY,
+    RABBITMQ_EXCHANGE,
+    FAN_OUT_CONCURRENCY,
+    BOT_BATCH_SIZE,
+)
+
+LOGGER = setup_logger(__name__)
+
+# message body and headers of a single bot command
+BotCommandMessage = Tuple[bytes, dict]
+
+
+def bot_command_message(
+        command: BotCommands,
+        user_id: int,
+        event_id: int,
+        data: Optional[dict] = None,
+) -> BotCommandMessage:
+    """
+    Build a bot command addressed to a user.
+    """
+    return Envelope(
+        command,
+        data,
+        {
+            'user_id': user_id,
+            'chat_id': user_id,
+            'event_id': event_id,
+        },
+    ).encode()
+
+
+def bot_batch_messages(
+        command: BotCommands,
+        user_ids: List[int],
+        event_id: int,
+        data: Optional[dict] = None,
+        batch_size: int = BOT_BATCH_SIZE,
+) -> List[BotCommandMessage]:
+    """
+    Build the same bot command for many users: a message per `batch_size`
+    users instead of a message per user. The bot handles the command for every
+    recipient of the batch. With `batch_size` 0 every user gets a single
+    command, which bots that do not read batches yet understand.
+    """
+    if batch_size <= 0:
+        return [bot_command_message(command, user_id, event_id, data) for user_id in user_ids]
+    return [
+        Envelope(
+            command,
+            data,
+            {'event_id': event_id},
+            recipients=user_ids[i:i + batch_size],
+        ).encode()
+        for i in range(0, len(user_ids), batch_size)
+    ]
+
+
+class BotCommandFanOut:
+    """
+    Publishes batches of bot commands concurrently over the connector's
+    publishing pool, with at most `concurrency` publishes in flight, and keeps
+    latency stats of the batches. Batches that must be delivered are published
+    with broker confirms and unconfirmed messages are re-sent.
+    """
+
+    def __init__(
+            self,
+            rabbitmq_controller: AIORabbitMQConnector,
+            concurrency: int = FAN_OUT_CONCURRENCY,
+            confirm_retries: int = 1,
+    ):
+        self.rabbitmq = rabbitmq_controller
+        self.concurrency = concurrency
+        self.confirm_retries = confirm_retries
+        # stats
+        self.batches = 0
+        self.published = 0
+        self.failed = 0
+        self.retried = 0
+        self.last_batch_size = 0
+        self.last_batch_latency = 0.0
+        self.max_batch_latency = 0.0
+
+    async def publish(
+            self,
+            messages: List[BotCommandMessage],
+            name: str = 'bot',
+            confirm: bool = False,
+    ) -> int:
+        """
+        Publish all messages of a batch. Failed publishes are logged and counted,
+        they do not stop the rest of the batch.
+        :param messages: Batch of (body, headers).
+        :param name: Batch name for logs.
+        :param confirm: Wait for broker confirms of the batch and re-send
+                    messages which were not confirmed up to `confirm_retries` times.
+        :return: Number of published messages.
+        """
+        if not messages:
+            return 0
+
+        start = time.perf_counter()
+        results = await self._publish_many(messages, confirm)
+        retries = self.confirm_retries if confirm else 0
+        while retries and any(result is not None for result in results):
+            retries -= 1
+            failed = [i for i, result in enumerate(results) if result is not None]
+            LOGGER.warning(f'Re-sending {len(failed)} unconfirmed {name} commands')
+            retried = await self._publish_many([messages[i] for i in failed], confirm)
+            for i, result in zip(failed, retried):
+                results[i] = result
+            self.retried += len(failed)
+        latency = time.perf_counter() - start
+
+        errors = [result for result in results if result is not None]
+        for error in errors[:3]:
+            LOGGER.error(f'Failed to publish {name} command: {error}')
+        published = len(messages) - len(errors)
+
+        self.batches += 1
+        self.published += published
+        self.failed += len(errors)
+        self.last_batch_size = len(messages)
+        self.last_batch_latency = latency
+        self.max_batch_latency = max(self.max_batch_latency, latency)
+        LOGGER.debug(
+            f'Published {published}/{len(messages)} {name} commands in {latency:.3f}s'
+        )
+        return published
+
+    async def _publish_many(
+            self,
+            messages: List[BotCommandMessage],
+            confirm: bool,
+    ) -> List[Optional[BaseException]]:
+        return await self.rabbitmq.publish_many(
+            messages,
+            routing_key=TG_BOT_ROUTING_KEY,
+            exchange=RABBITMQ_EXCHANGE,
+            concurrency=self.concurrency,
+            confirm=confirm,
+        )
@@ -1,38 +1,73 @@
 import asyncio
+import itertools
+import multiprocessing
 import os
 from asyncio import AbstractEventLoop
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Tuple, Generator
+from typing import List, Tuple, Generator, Optional, Dict
 
+import numpy as np
 import pandas as pd
 
 from chathub_connectors.postgres_connector import AsyncPgConnector
 from datemaker import (
     setup_logger,
     DEFAULT_EVENT_IDEAL_USERS,
+    MATCHMAKING_ASSIGNMENT_SOLVER,
+    MATCHMAKING_WORKERS,
     POSTGRES_HOST,
     POSTGRES_PORT,
     POSTGRES_DB,
     POSTGRES_USER,
     POSTGRES_PASSWORD,
 )
+from .assignment import get_assignment_solver, AssignmentResult
 
 LOGGER = setup_logger(__name__)
 
 
+# columns of the users dataframe used by the matchmaking pipeline
+MATCHMAKING_COLUMNS = [
+    'user_id',
+    'birthday',
+    'sex',
+    'city',
+    'rating',
+    'manual_score',
+    'registered_on_dttm',
+]
+
+
 class IntelligentAgent:
     """
     MVP class for matchmaker. Will be moved to a separate service.
     """
+    # shared by all agents of the service, created on first clustering
+    _executor: Optional[ProcessPoolExecutor] = None
 
     def __init__(
             self,
             custom_event_loop: AbstractEventLoop = None,
             postgres_connector=None,
-            debug: bool = False
+            debug: bool = False,
+            assignment_solver: str = MATCHMAKING_ASSIGNMENT_SOLVER,
+            offline: bool = False,
     ):
-        self.loop = custom_event_loop or asyncio.get_event_loop()
+        """
+        :param offline: Create an agent without event loop and DB connector.
+                    It can only run pure matchmaking steps, e.g. inside a worker process.
+        """
         self.debug = debug
+        self.assignment_solver = get_assignment_solver(assignment_solver)
+        self.last_assignment: Optional[AssignmentResult] = None
+
+        if offline:
+            self.loop = None
+            self.postgres_connector = None
+            return
+
+        self.loop = custom_event_loop or asyncio.get_event_loop()
 
         if not postgres_connector:
             self.postgres_connector = AsyncPgConnector(
@@ -49,7 +84,28 @@ class IntelligentAgent:
         else:
             self.postgres_connector = postgres_connector
 
-    def cluster_users_for_event(
+    @classmethod
+    def get_executor(cls) -> ProcessPoolExecutor:
+        """
+        Process pool for matchmaking. Workers are spawned, not forked, so they do not
+        inherit the service's event loop, connections and gRPC threads.
+        """
+        if cls._executor is None:
+            cls._executor = ProcessPoolExecutor(
+                max_workers=MATCHMAKING_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            LOGGER.debug(f'Matchmaking process pool created: {MATCHMAKING_WORKERS} workers')
+        return cls._executor
+
+    @classmethod
+    def shutdown_executor(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=False, cancel_futures=True)
+            cls._executor = None
+            LOGGER.debug('Matchmaking process pool shut down')
+
+    async def cluster_users_for_event(
             self,
             users: pd.DataFrame,
             event_id: int,
@@ -58,10 +114,36 @@ class IntelligentAgent:
         """
         For a given list of users need to cluster them in groups for
         the best experience.
+        The pipeline runs in the matchmaking process pool, so the event loop keeps
+        serving running events meanwhile.
         :param users: Dataframe with users and their features.
         :param event_id: ID of the event.
         :param users_limit: Maximum number of users per group.
-        :return: Dataframe with user IDs and groups.
+        :return: Number of pairs saved for the event.
+        """
+        loop = asyncio.get_running_loop()
+        groups = await loop.run_in_executor(
+            self.get_executor(),
+            generate_event_groups_in_worker,
+            self.to_columns(users),
+            event_id,
+            users_limit,
+            self.debug,
+            self.assignment_solver.name,
+        )
+        # put the final dataframe into dating_event_groups
+        LOGGER.debug(f'Putting {len(groups)} groups of event#{event_id} into bd')
+        return await self.put_event_data_into_bd(event_id, groups)
+
+    def generate_event_groups(
+            self,
+            users: pd.DataFrame,
+            event_id: int,
+            users_limit: int = DEFAULT_EVENT_IDEAL_USERS
+    ) -> List[List[Tuple[int, int, int]]]:
+        """
+        Matchmaking pipeline without side effects.
+        :return: Groups, each group is a list of (turn, user_1_id, user_2_id) pairs.
         """
         # Store event_id as an instance variable for use in _calculate_matchmaking_embedding
         self._current_event_id = event_id
@@ -73,14 +155,15 @@ class IntelligentAgent:
         # target_users = self._split_by_rating(target_users)  # rating not implemented
         embedding_data = self._calculate_matchmaking_embedding(target_users, additive_users)
         groups = self._split_into_groups(target_users, embedding_data, users_limit)
-        # put the final dataframe into dating_event_groups
-        for group_num, group in enumerate(groups):
-            LOGGER.debug(f'Putting group {group_num} into bd. Group size: {len(group)}')
-            self.put_event_data_into_bd(
-                event_id,
-                group_num,
-                self._generate_pairs(group)
-            )
+        return [list(self._generate_pairs(group)) for group in groups]
+
+    @staticmethod
+    def to_columns(users: pd.DataFrame) -> Dict[str, np.ndarray]:
+        """
+        Compact columnar form of users dataframe to pass into a worker process:
+        only the columns matchmaking needs, as plain arrays.
+        """
+        return {column: users[column].to_numpy() for column in MATCHMAKING_COLUMNS}
 
     @staticmethod
     def prepare_data(users: pd.DataFrame) -> pd.DataFrame:
@@ -210,33 +293,25 @@ class IntelligentAgent:
         :return:
         """
         LOGGER.debug('Calculating matchmaking embedding')
-        embedding: pd.DataFrame = target[['user_id']].copy(deep=True)
-        for additive_user in additive.user_id.values:
-            embedding[str(additive_user)] = 0
-            for target_user in target.user_id.values:
-                # scoring age
-                age_diff = abs(
-                    target.loc[target.user_id == target_user].age.values[0] -
-                    additive.loc[additive.user_id == additive_user].age.values[0]
-                )
-                score = 2 + 2 - age_diff
-
-                # scoring city
-                same_city = (
-                    target.loc[target.user_id == target_user].city.values[0] ==
-                    additive.loc[additive.user_id == additive_user].city.values[0]
-                )
-                score += 2 if same_city else 0
-
-                # including manual tune
-                manual_diff = abs(
-                    target.loc[target.user_id == target_user].manual_score.values[0] -
-                    additive.loc[additive.user_id == additive_user].manual_score.values[0]
-                )
-                score += 6 - 2 * manual_diff
-
-                # assigning score
-                embedding.loc[embedding.user_id == target_user, str(additive_user)] = score
+        scores = self._calculate_scores(
+            target_age=target.age.to_numpy(),
+            additive_age=additive.age.to_numpy(),
+            target_city=target.city.to_numpy(),
+            additive_city=additive.city.to_numpy(),
+            target_manual_score=target.manual_score.to_numpy(),
+            additive_manual_score=additive.manual_score.to_numpy(),
+        )
+        embedding: pd.DataFrame = pd.concat(
+            [
+                target[['user_id']],
+                pd.DataFrame(
+                    scores,
+                    index=target.index,
+                    columns=[str(x) for x in additive.user_id.values],
+                ),
+            ],
+            axis=1,
+        )
 
         embedding['match'] = embedding[
             [str(x) for x in additive.user_id.values.tolist()]
@@ -247,6 +322,28 @@ class IntelligentAgent:
 
         return embedding
 
+    @staticmethod
+    def _calculate_scores(
+            target_age: np.ndarray,
+            additive_age: np.ndarray,
+            target_city: np.ndarray,
+            additive_city: np.ndarray,
+            target_manual_score: np.ndarray,
+            additive_manual_score: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Score every target-additive pair at once.
+        Target features are broadcast as a column and additive features as a row,
+        so the result is a (target x additive) matrix.
+        See `_calculate_matchmaking_embedding` for the scoring rules.
+        """
+        age_score = 2 + 2 - np.abs(target_age[:, None] - additive_age[None, :])
+        city_score = np.where(target_city[:, None] == additive_city[None, :], 2, 0)
+        manual_score = 6 - 2 * np.abs(
+            target_manual_score[:, None] - additive_manual_score[None, :]
+        )
+        return age_score + city_score + manual_score
+
     def _split_into_groups(
             self,
             target_users: pd.DataFrame,
@@ -258,42 +355,41 @@ class IntelligentAgent:
 
         1. Order target by rating, age, registration date.
         2. Select the best possible pair for each target user (every additive used once)
+           with the agent's assignment solver, see `datemaker.assignment`.
         3. Split into groups.
 
         :param target_users:
         :param match_scoring_matrix:
         :return:
         """
-        sorted_user_ids = target_users.sort_values(
-            by=['rating', 'registered_on_dttm'],
-            ascending=False
-        ).user_id.tolist()
-        target_users['match'] = -1
-
-        # Keep track of already assigned matches
-        assigned_matches = set()
-
         match_columns = [
             col for col in match_scoring_matrix.columns
             if col != 'user_id' and col != 'match' and col.isdigit()
         ]
+        sorted_index = target_users.sort_values(
+            by=['rating', 'registered_on_dttm'],
+            ascending=False
+        ).index
+        priority = match_scoring_matrix.index.get_indexer(sorted_index)
 
-        for user_id in sorted_user_ids:
-            # Get the user's embedding row
-            user_scores = match_scoring_matrix.loc[match_scoring_matrix.user_id == user_id]
-            # Sort matches by score (descending)
-            matches_sorted = user_scores[match_columns].iloc[0].sort_values(ascending=False)
-            # Find the first match that hasn't been assigned yet
-            for match_id in matches_sorted.index:
-                if match_id not in assigned_matches:
-                    assigned_matches.add(match_id)
-                    target_users.loc[target_users.user_id == user_id, 'match'] = match_id
-                    break
-            else:
-                # If all potential matches are taken, delete the target user from the event
-                target_users = target_users.drop(
-                    target_users[target_users['user_id'] == user_id].index
-                )
+        assignment = self.assignment_solver.assign(
+            match_scoring_matrix[match_columns].to_numpy(),
+            priority,
+        )
+        LOGGER.info(
+            f'Matched {len(assignment)} pairs for event#{self._current_event_id} '
+            f'with {assignment.solver} assignment: '
+            f'total score {assignment.total_score}, took {assignment.wall_time:.3f}s'
+        )
+        self.last_assignment = assignment
+
+        matches = pd.Series(
+            np.asarray(match_columns, dtype=object)[assignment.columns],
+            index=match_scoring_matrix.index[assignment.rows],
+        )
+        # target users left without a partner are deleted from the event
+        target_users = target_users.loc[target_users.index.isin(matches.index)].copy()
+        target_users['match'] = matches
 
         if self.debug:
             self.save_df_artifact(target_users, self._current_event_id, 'matching_result')
@@ -322,19 +418,23 @@ class IntelligentAgent:
         for row in data:
             yield event_id, group_id, row[0], row[1], row[2]
 
-    def put_event_data_into_bd(
+    async def put_event_data_into_bd(
             self,
             event_id: int,
-            group_id: int,
-            group_data,
-    ):
-        if self.loop.is_running():
-            task = self.loop.create_task(
-                self.postgres_connector.put_event_data(
-                    data=self.add_event_group_ids_to_pairs(event_id, group_id, group_data)
-                )
+            groups: List[List[Tuple[int, int, int]]],
+    ) -> int:
+        """
+        Saves pairs of all event groups in one transaction.
+        :return: Number of saved pairs.
+        """
+        inserted = await self.postgres_connector.put_event_data(
+            data=itertools.chain.from_iterable(
+                self.add_event_group_ids_to_pairs(event_id, group_id, group_data)
+                for group_id, group_data in enumerate(groups)
             )
-            asyncio.gather(task)
+        )
+        LOGGER.debug(f'Saved {inserted} pairs in {len(groups)} groups for event#{event_id}')
+        return inserted
 
     @staticmethod
     def save_df_artifact(embedding: pd.DataFrame, event_id: int, artifact_type: str):
@@ -365,3 +465,18 @@ class IntelligentAgent:
 
         embedding.to_csv(filepath, index=False)
         LOGGER.debug(f'Saved {artifact_type} dataframe to {filepath}')
+
+
+def generate_event_groups_in_worker(
+        columns: Dict[str, np.ndarray],
+        event_id: int,
+        users_limit: int,
+        debug: bool,
+        assignment_solver: str,
+) -> List[List[Tuple[int, int, int]]]:
+    """
+    Entry point of matchmaking process pool workers.
+    See `IntelligentAgent.cluster_users_for_event`.
+    """
+    agent = IntelligentAgent(debug=debug, assignment_solver=assignment_solver, offline=True)
+    return agent.generate_event_groups(pd.DataFrame(columns), event_id, users_limit)
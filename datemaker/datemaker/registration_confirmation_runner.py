@@ -1,6 +1,8 @@
 import asyncio
-from asyncio import sleep, AbstractEventLoop
+import json
+from asyncio import AbstractEventLoop
 from datetime import timedelta, datetime
+from typing import Dict
 
 import pandas as pd
 
@@ -9,8 +11,10 @@ from chathub_connectors.rabbitmq_connector import AIORabbitMQConnector
 from datemaker import (
     setup_logger,
     EventStateIDs,
-    BotCommands, TG_BOT_ROUTING_KEY, DEBUG, DEFAULT_EVENT_IDEAL_USERS,
+    BotCommands, DEBUG, DEFAULT_EVENT_IDEAL_USERS,
+    DATING_REGISTRATIONS_CHANGED_CHANNEL,
 )
+from .fan_out import BotCommandFanOut, bot_batch_messages
 from .intelligent_agent import IntelligentAgent
 from .meet_api_controller import GoogleMeetApiController
 
@@ -25,6 +29,7 @@ class RegistrationConfirmationRunner:
     confirmation_timeout_offset = (
         timedelta(seconds=1) if DEBUG.lower() == 'true' else timedelta(hours=1)
     )
+    reconciliation_interval = timedelta(minutes=15)
 
     def __init__(
             self,
@@ -43,8 +48,13 @@ class RegistrationConfirmationRunner:
         self.rabbitmq = rabbitmq_controller
         self.running = False
         self.debug = debug
-        self.registrations = []
+        # user id -> registration, kept up to date by notifications
+        self.registrations: Dict[int, dict] = {}
+        self._registrations_changed = asyncio.Event()
+        self.notifications_received = 0
+        self.reconciliations = 0
         self.users_limit = DEFAULT_EVENT_IDEAL_USERS
+        self.fan_out = BotCommandFanOut(rabbitmq_controller)
         loop = custom_event_loop or asyncio.get_event_loop()
         self.intelligence_agent = IntelligentAgent(loop, postgres_controller, debug=self.debug)
         self.registration_end_dttm = (
@@ -71,45 +81,92 @@ class RegistrationConfirmationRunner:
         await self.postgres.set_event_state(self.event_id, state.value)
 
     async def trigger_bot_command(self, command: BotCommands, users: list):
-        for user in users:
-            await self.rabbitmq.publish(
-                message=command.value,
-                routing_key=TG_BOT_ROUTING_KEY,
-                exchange='chathub_direct_main',
-                headers={
-                    'user_id': user.get('user_id'),
-                    'chat_id': user.get('user_id'),
-                    'event_id': self.event_id,
-                }
-            )
+        await self.fan_out.publish(
+            bot_batch_messages(command, [user.get('user_id') for user in users], self.event_id),
+            name=command.value,
+        )
         if users:
             LOGGER.debug(f'Command {command} triggered for {len(users)} users')
 
     async def wait_for_confirmations(self):
-        is_all_confirmed = False  # all users confirmed registrations
-        is_timeout = False        # confirmation time is out (1 hour before event)
-        await self._update_registrations_list()
-        while not is_timeout:  # original is_all_confirmed or is_timeout - rework later
-            LOGGER.debug(f'Waiting confirmations for event {self.event_id}')
-            await sleep(60)
-            is_timeout = self.event_start_time - self.confirmation_timeout_offset < datetime.now()
-            await self._update_registrations_list()
-            is_all_confirmed = len(
-                {user.get('user_id') for user in self.registrations} -
-                {user.get('user_id') for user in self.registrations if user.get('confirmed_on_dttm')}
-            ) == 0 and len(self.registrations) > 0
+        """
+        Keep registrations of the event up to date until the confirmation timeout
+        and send confirmation requests to newly registered users.
+
+        Registration changes are pushed by postgres NOTIFY and applied to the
+        in-memory registrations. The full list is read from the db only at start,
+        every `reconciliation_interval` in case a notification was lost and at the
+        timeout, so the final registrations match the db.
+        """
+        await self.postgres.listen(
+            DATING_REGISTRATIONS_CHANGED_CHANNEL,
+            self.on_registration_changed,
+        )
+        try:
+            await self._reconcile_registrations()
+            while True:
+                remaining = (self.registration_end_dttm - datetime.now()).total_seconds()
+                if remaining <= 0:
+                    break
+                LOGGER.debug(f'Waiting confirmations for event {self.event_id}')
+                try:
+                    await asyncio.wait_for(
+                        self._registrations_changed.wait(),
+                        min(remaining, self.reconciliation_interval.total_seconds()),
+                    )
+                    # changes notified while requests are sent wake up the next wait
+                    self._registrations_changed.clear()
+                    await self._send_confirmation_requests()
+                except asyncio.TimeoutError:
+                    await self._reconcile_registrations()
+        finally:
+            await self.postgres.unlisten(
+                DATING_REGISTRATIONS_CHANGED_CHANNEL,
+                self.on_registration_changed,
+            )
+        is_all_confirmed = len(self.registrations) > 0 and all(
+            user.get('confirmed_on_dttm') for user in self.registrations.values()
+        )
         LOGGER.debug(
-            f'All users confirmed registration: {is_all_confirmed}, '
-            f'timeout: {is_timeout} '
+            f'All users confirmed registration: {is_all_confirmed} '
             f'for event#{self.event_id}'
         )
         LOGGER.info(f'Waiting for confirmation ended for event#{self.event_id}')
 
-    async def _update_registrations_list(self):
-        LOGGER.debug(f'Updating registrations list for event#{self.event_id}')
-        self.registrations = await self.postgres.get_event_registrations(self.event_id)
+    def on_registration_changed(self, payload: str):
+        """
+        Apply a registration change notification.
+        :param payload: json with op (INSERT, UPDATE or DELETE), event_id, user_id
+                    and confirmed_on_dttm.
+        """
+        change = json.loads(payload)
+        if change.get('event_id') != self.event_id:
+            return
+        user_id = change.get('user_id')
+        if change.get('op') == 'DELETE':
+            self.registrations.pop(user_id, None)
+        else:
+            registration = self.registrations.setdefault(user_id, {
+                'user_id': user_id,
+                'confirmation_event_sent': False,
+            })
+            registration['confirmed_on_dttm'] = change.get('confirmed_on_dttm')
+        self.notifications_received += 1
+        self._registrations_changed.set()
+
+    async def _reconcile_registrations(self):
+        LOGGER.debug(f'Reconciling registrations list for event#{self.event_id}')
+        self.registrations = {
+            user.get('user_id'): dict(user)
+            for user in await self.postgres.get_event_registrations(self.event_id)
+        }
+        self.reconciliations += 1
+        await self._send_confirmation_requests()
+
+    async def _send_confirmation_requests(self):
         confirmation_not_sent_users = [
-            user for user in self.registrations if not user.get('confirmation_event_sent')
+            user for user in self.registrations.values()
+            if not user.get('confirmation_event_sent')
         ]
         if len(confirmation_not_sent_users):
             LOGGER.debug(
@@ -125,6 +182,8 @@ class RegistrationConfirmationRunner:
                 event_id=self.event_id,
                 user_ids=[uid.get('user_id') for uid in confirmation_not_sent_users]
             )
+            for user in confirmation_not_sent_users:
+                user['confirmation_event_sent'] = True
 
     async def generate_user_groups(self):
         """
@@ -145,45 +204,34 @@ class RegistrationConfirmationRunner:
             f'Max users in group: {self.users_limit}'
         )
         # collect user data to make groups
-        confirmed_user_ids = {
-            user.get('user_id') for user in self.registrations if user.get('confirmed_on_dttm')
-        }
-        LOGGER.debug(f'Got {len(confirmed_user_ids)} confirmed users for event#{self.event_id}')
-        confirmed_users = []
-        for user_id in confirmed_user_ids:
-            confirmed_users.append(
-                await self.postgres.get_user(user_id)
-            )
-
-        df_registrations = pd.DataFrame(
-            self.registrations,
-            columns=['user_id', 'registered_on_dttm', 'confirmed_on_dttm', 'confirmation_event_sent'],
-        )
         df_users = pd.DataFrame(
-            confirmed_users,
+            await self.postgres.get_confirmed_event_users(self.event_id),
             columns=[
                 'user_id',
-                'username',
-                'password_hash',
-                'bio',
                 'birthday',
                 'sex',
-                'name',
                 'city',
                 'rating',
                 'manual_score',
+                'registered_on_dttm',
+                'confirmed_on_dttm',
             ]
         )
-        df_users = df_users.merge(df_registrations, on='user_id')
+        LOGGER.debug(f'Got {len(df_users)} confirmed users for event#{self.event_id}')
+        if df_users.empty:
+            LOGGER.info(f'No confirmed users for event#{self.event_id}, no groups generated')
+            return
 
-        self.intelligence_agent.cluster_users_for_event(df_users, self.event_id, self.users_limit)
+        await self.intelligence_agent.cluster_users_for_event(
+            df_users, self.event_id, self.users_limit
+        )
         LOGGER.info(f'Generated user groups for event#{self.event_id}')
 
     async def notify_users_registration_complete(self):
-        await sleep(10)
         LOGGER.debug(f'Notifying users that registration for event#{self.event_id} is complete')
         confirmed_user_ids = {
-            user.get('user_id') for user in self.registrations if user.get('confirmed_on_dttm')
+            user_id for user_id, user in self.registrations.items()
+            if user.get('confirmed_on_dttm')
         }
         match_maked_users = {
             row.get('user_id') for row in
@@ -2,25 +2,37 @@ import asyncio
 import json
 import logging
 from asyncio import sleep
-from datetime import datetime
 
+from aio_pika.abc import AbstractIncomingMessage
 from tzlocal import get_localzone
-from pika.spec import BasicProperties
 
-from chathub_connectors.postgres_connector import PostgresConnection, AsyncPgConnector
-from chathub_connectors.rabbitmq_connector import RabbitMQConnector, AIORabbitMQConnector
+from chathub_connectors.envelope import CommandRegistry, Envelope, UnknownCommandError
+from chathub_connectors.postgres_connector import AsyncPgConnector
+from chathub_connectors.rabbitmq_connector import AIORabbitMQConnector, OrderedConcurrentProcessor
 from datemaker import (
     setup_logger,
     DateMakerCommands,
     EventStates,
-    DEBUG, TG_BOT_ROUTING_KEY,
+    DEBUG, TG_BOT_ROUTING_KEY, RABBITMQ_EXCHANGE,
+    DATING_EVENTS_CHANGED_CHANNEL,
+    COMMAND_CONCURRENCY,
 )
 from .dating_event_runner import DateRunner
+from .event_scheduler import EventScheduler
+from .intelligent_agent import IntelligentAgent
 from .meet_api_controller import GoogleMeetApiController
+from .space_pool import MeetSpacePool
 from .registration_confirmation_runner import RegistrationConfirmationRunner
 
 LOGGER = setup_logger(__name__)
 
+# where to send the reply to a call, kept with the request headers
+REPLY_TO_PARAM = 'reply_to'
+CORRELATION_ID_PARAM = 'correlation_id'
+
+# handlers of commands from the bot: (service, user, message_params)
+DATEMAKER_COMMANDS = CommandRegistry()
+
 
 class DateMakerService:
     """
@@ -31,7 +43,7 @@ class DateMakerService:
             # all parameters from GoogleMeetApiController
             meet_creds_file: str,
             meet_token_file: str,
-            # all parameters from RabbitMQConnector (0.0.3)
+            # all parameters from AIORabbitMQConnector
             message_broker_virtual_host: str,
             message_broker_exchange: str,
             message_broker_queue: str,
@@ -47,34 +59,19 @@ class DateMakerService:
             postgres_password: str,
             # other
             debug: bool = False,
+            command_concurrency: int = COMMAND_CONCURRENCY,
     ):
+        """
+        :param command_concurrency: Max of incoming commands processed at once.
+                    Commands of the same user are always processed in order.
+        """
         self.debug = debug
         self.meet_api_controller = GoogleMeetApiController(
             creds_file_path=meet_creds_file,
             token_file_path=meet_token_file,
         )
-        # LEGACY CONTROLLER, TO BE REMOVED
-        self.message_broker_controller = RabbitMQConnector(
-            host=message_broker_host,
-            port=message_broker_port,
-            virtual_host=message_broker_virtual_host,
-            exchange=message_broker_exchange,
-            queue=message_broker_queue,
-            username=message_broker_username,
-            password=message_broker_password,
-            message_callback=self.process_incoming_message,
-            caller_service='datemaker',
-            loglevel=logging.DEBUG if debug else logging.INFO,
-        )
-        # LEGACY CONTROLLER, TO BE REMOVED
-        self.postgres_controller = PostgresConnection(
-            host=postgres_host,
-            port=postgres_port,
-            db=postgres_db,
-            username=postgres_user,
-            password=postgres_password,
-        )
-        # NEW CONTROLLERS, NOW USE ONLY FOR PASSING INTO DATING RUNNER CLASSES
+        # spaces are reused by all events
+        self.space_pool = MeetSpacePool(self.meet_api_controller)
         self.async_pg_controller = AsyncPgConnector(
             host=postgres_host,
             port=postgres_port,
@@ -90,34 +87,50 @@ class DateMakerService:
             username=message_broker_username,
             password=message_broker_password,
             caller_service='datemaker',
+            loglevel=logging.DEBUG if debug else logging.INFO,
+        )
+        self.message_broker_queue = message_broker_queue
+        self.command_processor = OrderedConcurrentProcessor(
+            self.process_incoming_message,
+            key=lambda message: (message.headers or {}).get('user_id'),
+            concurrency=command_concurrency,
+        )
+        self.event_scheduler = EventScheduler(
+            load_events=self._collect_events,
+            start_runner=self._start_runner,
+            transition_offsets={
+                EventStates.NOT_STARTED.value:
+                    RegistrationConfirmationRunner.registration_timeout_offset,
+                EventStates.READY.value: DateRunner.send_rules_offset,
+            },
         )
         LOGGER.info(f'DateMaker service initialized. Debug: {self.debug}')
 
     def run(self):
         """
         Method that runs for managing date-making logic.
-        Most likely, here you should only schedule regular actions: creating
-        event, starting events and saving results. But please remember about
-        functionality for processing incoming messages, it should be able to
-        work as well. In a bad scenario you will have to create separate thread
-        or make this class asynchronous or something else.
+        Incoming commands are consumed from the service queue and processed
+        concurrently with the scheduled dating routines on the same event loop.
         """
         LOGGER.info('Running DateMakerService...')
         try:
             loop = asyncio.get_event_loop()
-            self.message_broker_controller.connect()
-            self.postgres_controller.connect()
             loop.run_until_complete(self.async_pg_controller.connect())
             loop.run_until_complete(self.async_rmq_controller.connect())
             self.meet_api_controller.connect(custom_event_loop=loop)
+            loop.run_until_complete(self.async_rmq_controller.listen_queue(
+                self.message_broker_queue,
+                self.command_processor,
+                # messages waiting for an earlier message of the same user hold prefetch
+                prefetch_count=2 * self.command_processor.concurrency,
+            ))
             loop.create_task(self.run_date_making())
             loop.run_forever()
         except KeyboardInterrupt:
             LOGGER.info('Stopping DateMakerService...')
-            self.message_broker_controller.disconnect()
-            self.postgres_controller.disconnect()
+            IntelligentAgent.shutdown_executor()
 
-    def process_incoming_message(self, channel, method, properties, body):
+    async def process_incoming_message(self, message: AbstractIncomingMessage):
         """
         Method for processing a incoming message from RabbitMQ broker.
         Possible messages can be:
@@ -125,79 +138,69 @@ class DateMakerService:
         - event selection
         - event registration confirmation
 
-        Documentation from pika:
-        https://pika.readthedocs.io/en/stable/modules/channel.html?highlight=on_message_callback#pika.channel.Channel.basic_consume
-
-        :param channel: RabbitMQ channel
-        :param method: RabbitMQ method
-        :param properties: message properties
-        :param body: message body
+        :param message: Incoming message, its headers should contain data to
+                    return answer to right user: user id and chat id (from tg bot).
         """
-        LOGGER.debug(
-            f'Got message on channel {channel.channel_number}: {body}. '
-            f'Method: {method}. Headers: {properties.headers}.'
-        )
-        # properties should contain data to return answer to right user:
-        # - chat id (from tg bot)?
-        # user should be in headers as well, because its ID is necessary for processing
-        message_params = properties.headers
-        message = body.decode('utf-8')
-        try:
-            user = self.postgres_controller.get_user(int(message_params['user_id']))
-            if not user:
-                raise Exception('No user found')
-
-            self._process_commands(message, message_params, user)
-
-        except Exception as e:
-            LOGGER.error(
-                f'Error in processing message "{message}" '
-                f'with params {message_params} '
-                f'from {method.routing_key}. '
-                f'Error: {e}'
-            )
-            self.message_broker_controller.publish(
-                json.dumps({'success': False}),
-                routing_key=TG_BOT_ROUTING_KEY,
-                exchange='chathub_direct_main',
-                properties=BasicProperties(headers=message_params)
+        async with message.process(ignore_processed=True):
+            reply_params = {}
+            if getattr(message, 'reply_to', None):
+                # the request was sent with AIORabbitMQConnector.call
+                reply_params[REPLY_TO_PARAM] = message.reply_to
+                reply_params[CORRELATION_ID_PARAM] = message.correlation_id
+            try:
+                envelope = Envelope.from_message(message.body, message.headers)
+            except Exception as e:
+                LOGGER.error(f'Cannot parse message {message.body[:100]} from {message.routing_key}: {e}')
+                await self._reply({'success': False}, {**(message.headers or {}), **reply_params})
+                return
+            message_params = {**envelope.headers, **reply_params}
+            LOGGER.debug(
+                f'Got command {envelope.command} from {message.routing_key}. Headers: {message_params}.'
             )
+            try:
+                handler = DATEMAKER_COMMANDS.get(envelope.command)
+                user = await self.async_pg_controller.get_user(int(message_params['user_id']))
+                if not user:
+                    raise Exception('No user found')
 
-    def _process_commands(self, message, message_params, user):
-        if DateMakerCommands.LIST_EVENTS.value in message:
-            self.list_events(user, message_params)
+                await handler(self, user, message_params)
 
-        elif DateMakerCommands.REGISTER_USER_TO_EVENT.value in message:
-            event_id = message_params.get('event_id', None)
-            if not event_id:
-                LOGGER.error(
-                    f'No event_id got with registration request for user {user}: {message}'
-                )
-            self.register_user_to_event(user, message_params)
+            except UnknownCommandError as e:
+                LOGGER.error(f'{e}, headers: {message_params}')
+                await self._reply({'success': False}, message_params)
 
-        elif DateMakerCommands.CONFIRM_USER_EVENT_REGISTRATION.value in message:
-            event_id = message_params.get('event_id', None)
-            if not event_id:
-                LOGGER.error(
-                    f'No event_id got with registration confirmation for user {user}: {message}'
-                )
-            self.confirm_user_event_registration(user, message_params)
-
-        elif DateMakerCommands.CANCEL_REGISTRATION.value in message:
-            event_id = int(message_params.get('event_id', -1))
-            if event_id != 0:
-                self.cancel_event_registration(user, message_params)
-            elif event_id == 0:
-                events = self.postgres_controller.get_event_registrations_for_user(user)
-                for event_id in [event['event_id'] for event in events]:
-                    message_params.update({'event_id': event_id})
-                    self.cancel_event_registration(user, message_params)
-            else:
+            except Exception as e:
                 LOGGER.error(
-                    f'No event_id got with registration cancellation for user {user}: {message}'
+                    f'Error in processing command "{envelope.command}" '
+                    f'with params {message_params} '
+                    f'from {message.routing_key}. '
+                    f'Error: {e}'
                 )
+                await self._reply({'success': False}, message_params)
+
+    async def _reply(self, result, message_params: dict):
+        headers = {
+            key: value for key, value in message_params.items()
+            if key not in (REPLY_TO_PARAM, CORRELATION_ID_PARAM)
+        }
+        if REPLY_TO_PARAM in message_params:
+            await self.async_rmq_controller.reply(
+                json.dumps(result),
+                reply_to=message_params[REPLY_TO_PARAM],
+                correlation_id=message_params[CORRELATION_ID_PARAM],
+                headers=headers,
+            )
+        else:
+            # bots without rpc match replies by chat and message ids in the headers
+            await self.async_rmq_controller.publish(
+                json.dumps(result),
+                routing_key=TG_BOT_ROUTING_KEY,
+                exchange=RABBITMQ_EXCHANGE,
+                headers=headers,
+            )
 
-    def list_events(self, user, message_params: dict):
+    @DATEMAKER_COMMANDS.register(DateMakerCommands.LIST_EVENTS)
+    async def list_events(self, user, message_params: dict):
         """
         Method for "listing" events by user request.
         See readme for more info:
@@ -209,7 +212,7 @@ class DateMakerService:
         :param user: Database user object.
         :param message_params: Dictionary of received parameters.
         """
-        events = self.postgres_controller.get_dating_events(timezone='Europe/Moscow')
+        events = await self.async_pg_controller.get_dating_events(timezone='Europe/Moscow')
         events_list = [
             {
                 event.get('id'): {
@@ -218,14 +221,10 @@ class DateMakerService:
                 }
             } for event in events
         ]
-        self.message_broker_controller.publish(
-            json.dumps(events_list),
-            routing_key=TG_BOT_ROUTING_KEY,
-            exchange='chathub_direct_main',
-            properties=BasicProperties(headers=message_params)
-        )
+        await self._reply(events_list, message_params)
 
-    def register_user_to_event(self, user, message_params: dict):
+    @DATEMAKER_COMMANDS.register(DateMakerCommands.REGISTER_USER_TO_EVENT)
+    async def register_user_to_event(self, user, message_params: dict):
         """
         Method for completing user registration request.
         See readme for more info:
@@ -237,35 +236,21 @@ class DateMakerService:
         :param user: Database user object.
         :return:
         """
+        if not message_params.get('event_id'):
+            LOGGER.error(f'No event_id got with registration request for user {user}')
         event_id = int(message_params['event_id'])
-        is_registered = False
-
-        event_registrations = self.postgres_controller.get_event_registrations(
-            event_id
+        is_registered = await self.async_pg_controller.register_for_event(
+            user=user,
+            event_id=event_id
         )
 
-        registered_users = [
-            user.get('user_id') for user in event_registrations
-        ]
-
-        if user.get('id') not in registered_users:
-            self.postgres_controller.register_for_event(
-                user=user,
-                event_id=event_id
-            )
-            is_registered = True
-
         result = {
             'user_registered': is_registered
         }
-        self.message_broker_controller.publish(
-            json.dumps(result),
-            routing_key=TG_BOT_ROUTING_KEY,
-            exchange='chathub_direct_main',
-            properties=BasicProperties(headers=message_params)
-        )
+        await self._reply(result, message_params)
 
-    def confirm_user_event_registration(
+    @DATEMAKER_COMMANDS.register(DateMakerCommands.CONFIRM_USER_EVENT_REGISTRATION)
+    async def confirm_user_event_registration(
             self,
             user,
             message_params: dict,
@@ -283,58 +268,42 @@ class DateMakerService:
         :param message_params:
         :param user: On developer's decision.
         """
+        if not message_params.get('event_id'):
+            LOGGER.error(f'No event_id got with registration confirmation for user {user}')
         event_id = int(message_params['event_id'])
-        is_confirmed = False
-
-        event_registrations = self.postgres_controller.get_event_registrations(
-            event_id
+        is_confirmed = await self.async_pg_controller.confirm_registration(
+            user=user,
+            event_id=event_id
         )
 
-        registered_users = [
-            user.get('user_id') for user in event_registrations
-        ]
-
-        if user.get('id') in registered_users:
-            self.postgres_controller.confirm_registration(
-                user=user,
-                event_id=event_id
-            )
-            is_confirmed = True
-
         result = {
             'registration_confirmed': is_confirmed
         }
-        self.message_broker_controller.publish(
-            json.dumps(result),
-            routing_key=TG_BOT_ROUTING_KEY,
-            exchange='chathub_direct_main',
-            properties=BasicProperties(headers=message_params)
-        )
+        await self._reply(result, message_params)
 
-    def cancel_event_registration(self, user, message_params: dict):
-        event_id = int(message_params['event_id'])
-        is_cancelled = False
-        event_registrations = self.postgres_controller.get_event_registrations(
-            event_id
-        )
-        registered_users = [
-            user.get('user_id') for user in event_registrations
+    @DATEMAKER_COMMANDS.register(DateMakerCommands.CANCEL_REGISTRATION)
+    async def cancel_event_registration(self, user, message_params: dict):
+        """
+        Cancels registration to the event, event_id 0 cancels all registrations of the user.
+        The bot waits for one reply, so cancelling all of them is answered once.
+        """
+        event_id = int(message_params.get('event_id', -1))
+        if event_id < 0:
+            LOGGER.error(f'No event_id got with registration cancellation for user {user}')
+            await self._reply({'success': False}, message_params)
+            return
+        if event_id == 0:
+            events = await self.async_pg_controller.get_event_registrations_for_user(user)
+            event_ids = [event['event_id'] for event in events]
+        else:
+            event_ids = [event_id]
+        results = [
+            await self.async_pg_controller.cancel_registration(user=user, event_id=event_id)
+            for event_id in event_ids
         ]
 
-        if user.get('id') in registered_users:
-            self.postgres_controller.cancel_registration(
-                user=user,
-                event_id=event_id
-            )
-            is_cancelled = True
-
-        result = {'registration_cancelled': is_cancelled}
-        self.message_broker_controller.publish(
-            json.dumps(result),
-            routing_key=TG_BOT_ROUTING_KEY,
-            exchange='chathub_direct_main',
-            properties=BasicProperties(headers=message_params)
-        )
+        result = {'registration_cancelled': any(results)}
+        await self._reply(result, message_params)
 
     def generate_events(self):
         """
@@ -349,86 +318,52 @@ class DateMakerService:
     async def run_date_making(self):
         """
         Managing dating routines:
-        - checking event schedule
+        - scheduling event transitions
         - managing DateRunner instances
         """
-        loop = asyncio.get_running_loop()
         if not DEBUG:
             await sleep(10)
-        while True:
-            events = await self._collect_events()
-            await self._process_events(events, loop)
-            await sleep(59)
-
-    async def _process_events(self, events, loop):
-        # for event in events create processor and run
-        if events:
-            LOGGER.debug('Processing events')
-        for event in events:
-            if event.get('state_name') == EventStates.READY.value:
-                runner = DateRunner(
-                    event_id=event.get('id'),
-                    start_time=event.get('start_dttm'),
-                    meet_api_controller=self.meet_api_controller,
-                    postgres_controller=self.async_pg_controller,
-                    rabbitmq_controller=self.async_rmq_controller,
-                    custom_event_loop=loop,
-                    debug=self.debug,
-                )
-                loop.create_task(runner.run_event())
-                loop.create_task(runner.save_event_results())
-            elif event.get('state_name') == EventStates.NOT_STARTED.value:
-                runner = RegistrationConfirmationRunner(
-                    event_id=event.get('id'),
-                    start_time=event.get('start_dttm'),
-                    meet_api_controller=self.meet_api_controller,
-                    postgres_controller=self.async_pg_controller,
-                    rabbitmq_controller=self.async_rmq_controller,
-                    custom_event_loop=loop,
-                    debug=self.debug,
-                )
-                loop.create_task(runner.handle_preparations())
+        await self.async_pg_controller.listen(
+            DATING_EVENTS_CHANGED_CHANNEL,
+            self.event_scheduler.notify,
+        )
+        await self.event_scheduler.run()
 
-    async def _collect_events(self):
+    async def _start_runner(self, event: dict):
         """
-        Collect events to process: registration confirmations and dating events.
-        :return:
+        Run the service part of the event in its current state.
+        :param event: Due event with id, start_dttm and state_name.
         """
-        LOGGER.debug('Collecting events')
-        events = self.postgres_controller.get_dating_events(
-            limit=10,
-            timezone=get_localzone(),
-        )
-        dating_events = [
-            e
-            for e
-            in events
-            if (
-                # ready to start
-                e.get('state_name', '') == EventStates.READY.value and
-                # should start in 5 minutes
-                e.get('start_dttm') - datetime.now() < DateRunner.send_rules_offset
-            )
-        ]
-        confirmations = [
-            e
-            for e
-            in events
-            if (
-                # ready to process
-                e.get('state_name', '') == EventStates.NOT_STARTED.value and
-                # starts tomorrow - registration should start 1 day before the event starts
-                e.get('start_dttm') - datetime.now() <
-                RegistrationConfirmationRunner.registration_timeout_offset
-            )
-        ]
-        events = dating_events + confirmations
-        if len(events):
-            LOGGER.info(
-                f'Got {len(events)} ({len(dating_events)} events + {len(confirmations)} confirmations) events to process'
+        loop = asyncio.get_running_loop()
+        if event.get('state_name') == EventStates.READY.value:
+            runner = DateRunner(
+                event_id=event.get('id'),
+                start_time=event.get('start_dttm'),
+                meet_api_controller=self.meet_api_controller,
+                postgres_controller=self.async_pg_controller,
+                rabbitmq_controller=self.async_rmq_controller,
+                custom_event_loop=loop,
+                debug=self.debug,
+                space_pool=self.space_pool,
             )
-        else:
-            LOGGER.debug(
-                f'Got {len(events)} ({len(dating_events)} + {len(confirmations)}) events to process'
+            await asyncio.gather(runner.run_event(), runner.save_event_results())
+        elif event.get('state_name') == EventStates.NOT_STARTED.value:
+            runner = RegistrationConfirmationRunner(
+                event_id=event.get('id'),
+                start_time=event.get('start_dttm'),
+                meet_api_controller=self.meet_api_controller,
+                postgres_controller=self.async_pg_controller,
+                rabbitmq_controller=self.async_rmq_controller,
+                custom_event_loop=loop,
+                debug=self.debug,
             )
+            await runner.handle_preparations()
+
+    async def _collect_events(self):
+        """
+        Collect events waiting for a transition: registration confirmations and
+        dating events.
+        """
+        events = await self.async_pg_controller.get_scheduled_events(timezone=get_localzone())
+        LOGGER.debug(f'Collected {len(events)} scheduled events')
         return events
@@ -0,0 +1,262 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, List
+
+from google.api_core.exceptions import FailedPrecondition
+from google.apps.meet_v2 import Space
+from grpc import StatusCode
+from grpc.aio import AioRpcError
+
+from datemaker import (
+    setup_logger,
+    MEET_SPACE_CREATE_CONCURRENCY,
+    MEET_SPACE_POOL_MAX_IDLE,
+    MEET_SPACE_MAX_USES,
+    MEET_END_CALL_CONCURRENCY,
+    MEET_END_CALL_TIMEOUT,
+)
+from .meet_api_controller import GoogleMeetApiController
+
+LOGGER = setup_logger(__name__)
+
+
+class MeetSpacePool:
+    """
+    Pool of public Google Meet spaces shared by all events of the service.
+
+    Creating a public space takes two API round trips, so spaces are created
+    ahead of time, concurrently, and a space whose call was ended goes back to
+    the pool for the next round of the same event instead of a new one being
+    created. Participants of an event know the links of its spaces, so used
+    spaces are never given to another event and are dropped when the event
+    drains them.
+
+    Example:
+    pool = MeetSpacePool(meet_api_controller)
+    await pool.prewarm(20)
+    spaces = await pool.acquire_many(20, event_id)
+    ...
+    await pool.release_many(spaces, event_id)
+    ...
+    pool.drain(event_id)
+    """
+
+    def __init__(
+            self,
+            meet_api_controller: GoogleMeetApiController,
+            create_concurrency: int = MEET_SPACE_CREATE_CONCURRENCY,
+            max_idle: int = MEET_SPACE_POOL_MAX_IDLE,
+            max_uses: int = MEET_SPACE_MAX_USES,
+            end_call_concurrency: int = MEET_END_CALL_CONCURRENCY,
+            end_call_timeout: float = MEET_END_CALL_TIMEOUT,
+    ):
+        """
+        :param create_concurrency: Max spaces created at once.
+        :param max_idle: Max spaces kept in the pool, extra released spaces are dropped.
+        :param max_uses: Calls of an event a space is used for before it is dropped,
+                    0 for no limit. Participants of past calls know the link of the space.
+        :param end_call_concurrency: Max calls ended at once.
+        :param end_call_timeout: Seconds to wait for a call to end, the space
+                    is dropped after that since the call may still go on.
+        """
+        self.meet_api = meet_api_controller
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.end_call_timeout = end_call_timeout
+        self._create_semaphore = asyncio.Semaphore(create_concurrency)
+        self._end_call_semaphore = asyncio.Semaphore(end_call_concurrency)
+        # spaces no one has been invited to yet
+        self._idle: Deque[Space] = deque()
+        # used spaces by the event they can be reused in
+        self._recycled: Dict[Hashable, Deque[Space]] = {}
+        self._uses: Dict[str, int] = {}
+        # spaces being created for the pool
+        self._creating = 0
+        # stats
+        self.in_use = 0
+        self.created = 0
+        self.create_failed = 0
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+        self.dropped = 0
+        self.total_create_latency = 0.0
+        self.max_create_latency = 0.0
+        self.calls_ended = 0
+        self.calls_not_started = 0
+        self.end_call_timeouts = 0
+        self.end_call_failed = 0
+        self.max_end_call_latency = 0.0
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle) + sum(len(spaces) for spaces in self._recycled.values())
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'idle': self.idle,
+            'in_use': self.in_use,
+            'created': self.created,
+            'create_failed': self.create_failed,
+            'hits': self.hits,
+            'misses': self.misses,
+            'recycled': self.recycled,
+            'dropped': self.dropped,
+            'avg_create_latency': self.total_create_latency / self.created if self.created else 0.0,
+            'max_create_latency': self.max_create_latency,
+            'calls_ended': self.calls_ended,
+            'calls_not_started': self.calls_not_started,
+            'end_call_timeouts': self.end_call_timeouts,
+            'end_call_failed': self.end_call_failed,
+            'max_end_call_latency': self.max_end_call_latency,
+        }
+
+    async def prewarm(self, size: int) -> int:
+        """
+        Create spaces concurrently until the pool has at least `size` idle ones,
+        counting the ones already being created.
+        :return: Number of spaces created.
+        """
+        missing = size - self.idle - self._creating
+        if missing <= 0:
+            return 0
+        self._creating += missing
+        try:
+            spaces = await asyncio.gather(
+                *(self._create() for _ in range(missing)),
+                return_exceptions=True,
+            )
+        finally:
+            self._creating -= missing
+        created = [space for space in spaces if isinstance(space, Space)]
+        self._idle.extend(created)
+        for error in [space for space in spaces if not isinstance(space, Space)][:3]:
+            LOGGER.error(f'Failed to create a meet space: {error}')
+        LOGGER.debug(f'Pre-warmed {len(created)}/{missing} meet spaces, {self.idle} idle')
+        return len(created)
+
+    async def acquire(self, event_id: Hashable = None) -> Space:
+        """
+        A space used before in the event, an unused one, or a new one if the
+        pool has neither.
+        """
+        recycled = self._recycled.get(event_id)
+        if recycled:
+            space = recycled.popleft()
+            self.hits += 1
+        elif self._idle:
+            space = self._idle.popleft()
+            self.hits += 1
+        else:
+            self.misses += 1
+            space = await self._create()
+        self.in_use += 1
+        self._uses[space.name] = self._uses.get(space.name, 0) + 1
+        return space
+
+    async def acquire_many(self, count: int, event_id: Hashable = None) -> List[Space]:
+        """
+        `count` spaces, or none if any of them could not be created.
+        """
+        results = await asyncio.gather(
+            *(self.acquire(event_id) for _ in range(count)),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if not isinstance(result, Space)]
+        if errors:
+            for space in results:
+                if isinstance(space, Space):
+                    self.in_use -= 1
+                    self._uses[space.name] -= 1
+                    if self._uses[space.name]:
+                        self._recycled.setdefault(event_id, deque()).appendleft(space)
+                    else:
+                        del self._uses[space.name]
+                        self._idle.appendleft(space)
+            raise errors[0]
+        return results
+
+    async def release(self, space: Space, event_id: Hashable = None):
+        """
+        End the call of the space and put the space back to the pool for the
+        next calls of the event.
+        """
+        self.in_use -= 1
+        if not await self._end_call(space):
+            self._drop(space)
+            return
+
+        if self.idle >= self.max_idle or (self.max_uses and self._uses[space.name] >= self.max_uses):
+            self._drop(space)
+            return
+        self._recycled.setdefault(event_id, deque()).append(space)
+        self.recycled += 1
+
+    async def release_many(self, spaces: List[Space], event_id: Hashable = None):
+        await asyncio.gather(*(self.release(space, event_id) for space in spaces))
+
+    def drain(self, event_id: Hashable = None) -> int:
+        """
+        Drop the idle spaces used in the event, their links must not be given
+        to participants of other events.
+        :return: Number of spaces dropped.
+        """
+        spaces = self._recycled.pop(event_id, ())
+        for space in spaces:
+            self._drop(space)
+        return len(spaces)
+
+    async def _end_call(self, space: Space) -> bool:
+        """
+        :return: Whether the space has no call going on and can be reused.
+        """
+        async with self._end_call_semaphore:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.meet_api.end_active_call(space), self.end_call_timeout)
+            except FailedPrecondition:
+                # no one joined the call
+                self.calls_not_started += 1
+                return True
+            except AioRpcError as e:
+                if e.code() == StatusCode.FAILED_PRECONDITION:
+                    self.calls_not_started += 1
+                    return True
+                # the call may still go on
+                self.end_call_failed += 1
+                LOGGER.warning(f'Failed to end the call of space {space.name}, dropping it: {e.code()}')
+                return False
+            except asyncio.TimeoutError:
+                self.end_call_timeouts += 1
+                LOGGER.warning(
+                    f'Call of space {space.name} did not end in {self.end_call_timeout}s, dropping the space'
+                )
+                return False
+            except Exception as e:
+                self.end_call_failed += 1
+                LOGGER.warning(f'Failed to end the call of space {space.name}, dropping it: {e}')
+                return False
+            finally:
+                self.max_end_call_latency = max(self.max_end_call_latency, time.perf_counter() - start)
+        self.calls_ended += 1
+        return True
+
+    def _drop(self, space: Space):
+        self._uses.pop(space.name, None)
+        self.dropped += 1
+
+    async def _create(self) -> Space:
+        async with self._create_semaphore:
+            start = time.perf_counter()
+            try:
+                space = await self.meet_api.create_public_space()
+            except Exception:
+                self.create_failed += 1
+                raise
+        latency = time.perf_counter() - start
+        self.created += 1
+        self.total_create_latency += latency
+        self.max_create_latency = max(self.max_create_latency, latency)
+        return space
@@ -0,0 +1,57 @@
+"""
+Benchmark for the matchmaking embedding of IntelligentAgent.
+
+Compares the previous nested-loop scoring with the vectorized one on synthetic
+users. The nested loop is quadratic in pandas scans, so it is only run for the
+smallest size by default.
+
+Usage (from the datemaker directory):
+    python -m tests.benchmark_intelligent_agent
+    python -m tests.benchmark_intelligent_agent --sizes 100 1000 10000 --reference-limit 1000
+"""
+import argparse
+import asyncio
+import time
+from unittest.mock import MagicMock
+
+from datemaker.intelligent_agent import IntelligentAgent
+from tests.test_intelligent_agent import make_users, reference_embedding
+
+
+def measure(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def run_benchmark(sizes, reference_limit):
+    loop = asyncio.new_event_loop()
+    agent = IntelligentAgent(custom_event_loop=loop, postgres_connector=MagicMock())
+    agent._current_event_id = 0
+
+    print(f'{"users":>8} {"target x additive":>18} {"vectorized, s":>14} {"nested loop, s":>15}')
+    for size in sizes:
+        users = agent.prepare_data(make_users(size))
+        target, additive = agent._split_into_genders(users)
+        vectorized = measure(agent._calculate_matchmaking_embedding, target, additive)
+        reference = (
+            f'{measure(reference_embedding, target, additive):15.3f}'
+            if size <= reference_limit else f'{"skipped":>15}'
+        )
+        shape = f'{len(target)} x {len(additive)}'
+        print(f'{size:>8} {shape:>18} {vectorized:14.3f} {reference}')
+
+    loop.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Matchmaking embedding benchmark.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000])
+    parser.add_argument(
+        '--reference-limit',
+        type=int,
+        default=100,
+        help='Largest users count to run the nested-loop implementation for',
+    )
+    args = parser.parse_args()
+    run_benchmark(args.sizes, args.reference_limit)
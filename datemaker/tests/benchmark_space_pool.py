@@ -0,0 +1,61 @@
+"""
+Benchmark for MeetSpacePool with the fake Meet client.
+
+Compares creating a public space for every pair of every round one after
+another, as DateRunner did before the pool, with pre-warming the pool for the
+largest round and reusing its spaces in the next rounds of the event. Used
+spaces are dropped after every event, the next one gets new links.
+
+Usage (from the datemaker directory):
+    python -m tests.benchmark_space_pool
+    python -m tests.benchmark_space_pool --pairs 50 --rounds 8 --events 3 --latency 0.15
+"""
+import argparse
+import asyncio
+import time
+
+from datemaker.space_pool import MeetSpacePool
+from tests.test_space_pool import FakeMeetApi
+
+
+async def sequential(meet: FakeMeetApi, pairs: int, rounds: int, events: int) -> float:
+    start = time.perf_counter()
+    for _ in range(events * pairs * rounds):
+        await meet.create_public_space()
+    return time.perf_counter() - start
+
+
+async def pooled(meet: FakeMeetApi, pairs: int, rounds: int, events: int, concurrency: int):
+    pool = MeetSpacePool(meet, create_concurrency=concurrency)
+    start = time.perf_counter()
+    for event_id in range(events):
+        await pool.prewarm(pairs)
+        for _ in range(rounds):
+            spaces = await pool.acquire_many(pairs, event_id)
+            await pool.release_many(spaces, event_id)
+        pool.drain(event_id)
+    return time.perf_counter() - start, pool
+
+
+def run_benchmark(pairs, rounds, events, latency, concurrency):
+    print(f'{events} events x {rounds} rounds x {pairs} pairs, API round trip {latency * 1000:.0f}ms')
+    meet = FakeMeetApi(latency=latency)
+    elapsed = asyncio.run(sequential(meet, pairs, rounds, events))
+    print(f'sequential: {len(meet.created):5} spaces created in {elapsed:6.2f}s')
+
+    meet = FakeMeetApi(latency=latency)
+    elapsed, pool = asyncio.run(pooled(meet, pairs, rounds, events, concurrency))
+    print(f'pool:       {len(meet.created):5} spaces created in {elapsed:6.2f}s '
+          f'(including ending calls after every round)')
+    print(f'pool stats: {pool.stats}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=25, help='Pairs in a round')
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--events', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of an API round trip')
+    parser.add_argument('--concurrency', type=int, default=10, help='Spaces created at once')
+    args = parser.parse_args()
+    run_benchmark(args.pairs, args.rounds, args.events, args.latency, args.concurrency)
@@ -0,0 +1,95 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+
+from datemaker import assignment
+from datemaker.assignment import (
+    GreedyAssignmentSolver,
+    OptimalAssignmentSolver,
+    get_assignment_solver,
+)
+from datemaker.intelligent_agent import IntelligentAgent
+from tests.test_intelligent_agent import make_users
+
+
+class TestAssignmentSolvers:
+    # greedy takes (0, 0) first and forces (1, 1), optimal crosses the pairs
+    scores = np.array([
+        [10, 9],
+        [8, 1],
+    ])
+
+    def test_greedy(self):
+        result = GreedyAssignmentSolver().assign(self.scores, np.array([0, 1]))
+        assert result.rows.tolist() == [0, 1]
+        assert result.columns.tolist() == [0, 1]
+        assert result.total_score == 11
+        assert result.solver == 'greedy'
+
+    def test_greedy_respects_priority(self):
+        result = GreedyAssignmentSolver().assign(self.scores, np.array([1, 0]))
+        assert result.columns.tolist() == [1, 0]
+        assert result.total_score == 17
+
+    def test_optimal(self):
+        result = OptimalAssignmentSolver().assign(self.scores, np.array([0, 1]))
+        assert result.rows.tolist() == [0, 1]
+        assert result.columns.tolist() == [1, 0]
+        assert result.total_score == 17
+        assert result.wall_time >= 0
+
+    def test_more_targets_than_partners(self):
+        scores = np.array([[1], [5], [3]])
+        greedy = GreedyAssignmentSolver().assign(scores, np.array([0, 1, 2]))
+        optimal = OptimalAssignmentSolver().assign(scores, np.array([0, 1, 2]))
+        assert greedy.rows.tolist() == [0]
+        assert optimal.rows.tolist() == [1]
+
+    def test_empty_matrix(self):
+        result = OptimalAssignmentSolver().assign(np.empty((0, 3)), np.empty(0, dtype=int))
+        assert len(result) == 0
+        assert result.total_score == 0
+
+    @pytest.mark.parametrize('seed', range(5))
+    def test_optimal_is_never_worse(self, seed):
+        scores = np.random.default_rng(seed).integers(-10, 14, (30, 40))
+        priority = np.arange(30)
+        greedy = GreedyAssignmentSolver().assign(scores, priority)
+        optimal = OptimalAssignmentSolver().assign(scores, priority)
+        assert len(optimal) == len(greedy) == 30
+        assert optimal.total_score >= greedy.total_score
+
+    def test_get_solver(self):
+        assert isinstance(get_assignment_solver('optimal'), OptimalAssignmentSolver)
+        assert isinstance(get_assignment_solver('greedy'), GreedyAssignmentSolver)
+        with pytest.raises(ValueError):
+            get_assignment_solver('random')
+
+    def test_fallback_without_scipy(self):
+        with patch.object(assignment, 'linear_sum_assignment', None):
+            assert isinstance(get_assignment_solver('optimal'), GreedyAssignmentSolver)
+
+
+class TestSplitIntoGroups:
+    @pytest.mark.parametrize('solver', ['greedy', 'optimal'])
+    def test_every_partner_used_once(self, solver):
+        loop = asyncio.new_event_loop()
+        agent = IntelligentAgent(
+            custom_event_loop=loop,
+            postgres_connector=MagicMock(),
+            assignment_solver=solver,
+        )
+        agent._current_event_id = 0
+        users = agent.prepare_data(make_users(50, seed=4))
+        target, additive = agent._split_into_genders(users)
+        embedding = agent._calculate_matchmaking_embedding(target, additive)
+
+        groups = agent._split_into_groups(target, embedding, users_limit=10)
+
+        matched = [user for group in groups for user in group.match.tolist()]
+        assert len(matched) == len(set(matched)) == min(len(target), len(additive))
+        assert all(len(group) <= 5 for group in groups)
+        assert agent.last_assignment.solver == solver
+        loop.close()
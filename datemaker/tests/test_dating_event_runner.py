@@ -0,0 +1,46 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+from datemaker import BotCommands, EventStateIDs
+from datemaker.dating_event_runner import DateRunner
+from tests.test_fan_out import FakeRabbitMQ
+
+
+def test_final_computes_matches_once_after_rating_window():
+    calls = []
+    recipients = []
+    postgres = AsyncMock()
+    postgres.compute_event_matches.side_effect = lambda event_id: calls.append('matches')
+    rabbitmq = FakeRabbitMQ()
+    original_publish = rabbitmq.publish
+
+    async def publish(message, routing_key, exchange, headers=None, confirm=False):
+        calls.append(headers['command'])
+        recipients.append(json.loads(message)['recipients'])
+        await original_publish(message, routing_key, exchange, headers, confirm)
+
+    rabbitmq.publish = publish
+
+    async def run():
+        runner = DateRunner(7, datetime.now(), MagicMock(), postgres, rabbitmq)
+        runner.rating_window = timedelta(seconds=0.1)
+        runner.user_ids_in_event = [1, 2, 3]
+        # the state machines of both groups finish the event
+        final = asyncio.gather(runner.run_dating_final(), runner.run_dating_final())
+        await asyncio.sleep(0.05)
+        # ratings of the last round are still coming
+        assert calls == [BotCommands.SEND_FINAL_DATING_MESSAGE.value]
+        await final
+        return runner
+
+    runner = asyncio.run(run())
+
+    postgres.compute_event_matches.assert_awaited_once_with(7)
+    assert calls.index('matches') > calls.index(BotCommands.SEND_FINAL_DATING_MESSAGE.value)
+    # one batch message of every command for all participants
+    assert calls[calls.index('matches') + 1:] == [BotCommands.SEND_MATCH_MESSAGE.value]
+    assert recipients == [[1, 2, 3], [1, 2, 3]]
+    postgres.set_event_state.assert_awaited_once_with(7, EventStateIDs.FINISHED.value)
+    assert not runner.running
@@ -0,0 +1,161 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from datemaker import EventStates
+from datemaker.event_scheduler import EventScheduler
+
+OFFSETS = {
+    EventStates.NOT_STARTED.value: timedelta(days=1),
+    EventStates.READY.value: timedelta(minutes=5),
+}
+
+
+def make_event(event_id, state, due_in):
+    """
+    Event which becomes due in `due_in` seconds.
+    """
+    return {
+        'id': event_id,
+        'start_dttm': datetime.now() + OFFSETS[state.value] + timedelta(seconds=due_in),
+        'state_name': state.value,
+    }
+
+
+class FakeService:
+    def __init__(self, events, runner_duration=0.0, fail=False, failed_loads=0):
+        self.events = events
+        self.failed_loads = failed_loads
+        self.loads = 0
+        self.started = []
+        self.runner_duration = runner_duration
+        self.fail = fail
+
+    async def load_events(self):
+        self.loads += 1
+        if self.failed_loads:
+            self.failed_loads -= 1
+            raise ConnectionError('postgres is down')
+        return list(self.events)
+
+    async def start_runner(self, event):
+        self.started.append((event['id'], event['state_name'], datetime.now()))
+        await asyncio.sleep(self.runner_duration)
+        if self.fail:
+            raise RuntimeError('runner failed')
+        # runners move events to the next state
+        self.events = [e for e in self.events if e['id'] != event['id']]
+
+    def scheduler(self, **kwargs):
+        return EventScheduler(self.load_events, self.start_runner, OFFSETS, **kwargs)
+
+
+async def run_for(scheduler, seconds):
+    task = asyncio.ensure_future(scheduler.run())
+    await asyncio.sleep(seconds)
+    task.cancel()
+
+
+class TestEventScheduler:
+    def test_starts_runners_at_deadline(self):
+        service = FakeService([
+            make_event(2, EventStates.READY, due_in=0.2),
+            make_event(1, EventStates.NOT_STARTED, due_in=0.1),
+            make_event(3, EventStates.READY, due_in=30),
+        ])
+        start = datetime.now()
+
+        asyncio.run(run_for(service.scheduler(), 0.4))
+
+        assert [(eid, state) for eid, state, _ in service.started] == [
+            (1, EventStates.NOT_STARTED.value),
+            (2, EventStates.READY.value),
+        ]
+        delays = [(started - start).total_seconds() for _, _, started in service.started]
+        assert 0.1 <= delays[0] < 0.18
+        assert 0.2 <= delays[1] < 0.28
+
+    def test_ignores_other_states(self):
+        event = make_event(1, EventStates.READY, due_in=0)
+        event['state_name'] = EventStates.RUNNING.value
+        service = FakeService([event])
+
+        asyncio.run(run_for(service.scheduler(), 0.1))
+
+        assert service.started == []
+
+    def test_one_runner_per_event(self):
+        # the runner has not changed event state yet, so every reload returns it again
+        service = FakeService([make_event(1, EventStates.READY, due_in=0)], runner_duration=0.3)
+
+        async def run():
+            scheduler = service.scheduler()
+            task = asyncio.ensure_future(scheduler.run())
+            for _ in range(5):
+                await asyncio.sleep(0.02)
+                scheduler.notify('1')
+            task.cancel()
+
+        asyncio.run(run())
+
+        assert len(service.started) == 1
+        assert service.loads > 2
+
+    def test_notify_wakes_scheduler_up(self):
+        service = FakeService([])
+
+        async def run():
+            scheduler = service.scheduler(resync_interval=60)
+            task = asyncio.ensure_future(scheduler.run())
+            await asyncio.sleep(0.05)
+            service.events.append(make_event(7, EventStates.READY, due_in=0))
+            scheduler.notify('7')
+            await asyncio.sleep(0.05)
+            task.cancel()
+
+        asyncio.run(run())
+
+        assert [eid for eid, _, _ in service.started] == [7]
+
+    def test_periodic_resync(self):
+        service = FakeService([])
+
+        asyncio.run(run_for(service.scheduler(resync_interval=0.05), 0.22))
+
+        assert service.loads >= 4
+
+    def test_failed_runner_retried_after_delay(self):
+        service = FakeService([make_event(1, EventStates.READY, due_in=0)], fail=True)
+
+        asyncio.run(run_for(service.scheduler(retry_delay=timedelta(seconds=0.2)), 0.3))
+
+        assert len(service.started) == 2
+        assert (service.started[1][2] - service.started[0][2]).total_seconds() >= 0.2
+
+    def test_next_state_not_delayed(self):
+        service = FakeService([make_event(1, EventStates.NOT_STARTED, due_in=0)])
+
+        async def start_runner(event):
+            service.started.append((event['id'], event['state_name'], datetime.now()))
+            if event['state_name'] == EventStates.NOT_STARTED.value:
+                # the next state is due right away
+                service.events = [make_event(1, EventStates.READY, due_in=0)]
+            else:
+                service.events = []
+
+        scheduler = EventScheduler(
+            service.load_events, start_runner, OFFSETS, retry_delay=timedelta(seconds=10)
+        )
+        asyncio.run(run_for(scheduler, 0.1))
+
+        assert [state for _, state, _ in service.started] == [
+            EventStates.NOT_STARTED.value,
+            EventStates.READY.value,
+        ]
+
+    def test_failed_reload_retried(self):
+        service = FakeService([make_event(1, EventStates.READY, due_in=0)], failed_loads=1)
+
+        asyncio.run(run_for(service.scheduler(retry_delay=timedelta(seconds=0.05)), 0.15))
+
+        assert service.loads >= 2
+        assert [eid for eid, _, _ in service.started] == [1]
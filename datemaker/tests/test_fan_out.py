@@ -0,0 +1,137 @@
+import asyncio
+import json
+
+from chathub_connectors.envelope import Envelope
+from chathub_connectors.rabbitmq_connector import AIORabbitMQConnector
+from datemaker import BotCommands
+from datemaker.fan_out import BotCommandFanOut, bot_batch_messages, bot_command_message
+
+
+class FakeRabbitMQ(AIORabbitMQConnector):
+    """
+    Connector with a fake single publish, `publish_many` is the real one.
+    """
+
+    def __init__(self, fail_for=()):
+        super().__init__()
+        self.fail_for = set(fail_for)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.published = []
+        self.confirmed = []
+
+    async def publish_many(self, messages, routing_key, exchange, concurrency=None, confirm=False):
+        if not confirm:
+            return await super().publish_many(messages, routing_key, exchange, concurrency)
+        # the broker nacks every failing user once
+        results = []
+        for message, headers in messages:
+            if headers['user_id'] in self.fail_for:
+                self.fail_for.discard(headers['user_id'])
+                results.append(ConnectionError('nack'))
+            else:
+                self.confirmed.append((message, headers))
+                results.append(None)
+        return results
+
+    async def publish(self, message, routing_key, exchange, headers=None, confirm=False):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if headers.get('user_id') in self.fail_for:
+            raise ConnectionError('channel closed')
+        self.published.append((message, headers))
+
+
+class TestBotCommandFanOut:
+    def test_bot_command_message(self):
+        message, headers = bot_command_message(
+            BotCommands.INVITE_TO_MEETING, 5, 2, {'url': 'https://meet'}
+        )
+        assert json.loads(message) == {'url': 'https://meet'}
+        assert headers == {
+            'user_id': 5,
+            'chat_id': 5,
+            'event_id': 2,
+            'command': 'invite_to_meeting',
+            'envelope_version': 1,
+            'payload_type': 'json',
+        }
+        envelope = Envelope.from_message(*bot_command_message(BotCommands.SEND_RULES, 5, 2))
+        assert (envelope.command, envelope.payload) == ('send_rules', None)
+
+    def test_bot_batch_messages(self):
+        messages = bot_batch_messages(
+            BotCommands.SEND_BREAK_MESSAGE, list(range(250)), 2, batch_size=100
+        )
+
+        envelopes = [Envelope.from_message(body, headers) for body, headers in messages]
+        assert [len(envelope.recipients) for envelope in envelopes] == [100, 100, 50]
+        assert [e.headers for e in envelopes[0].expand()][:2] == [
+            {'event_id': 2, 'user_id': 0, 'chat_id': 0},
+            {'event_id': 2, 'user_id': 1, 'chat_id': 1},
+        ]
+        assert bot_batch_messages(BotCommands.SEND_BREAK_MESSAGE, [], 2) == []
+
+    def test_bot_batch_messages_disabled(self):
+        messages = bot_batch_messages(BotCommands.SEND_BREAK_MESSAGE, [5, 6], 2, batch_size=0)
+
+        envelopes = [Envelope.from_message(body, headers) for body, headers in messages]
+        assert [(e.version, e.is_batch, e.headers['chat_id']) for e in envelopes] == [(1, False, 5), (1, False, 6)]
+
+    def test_publishes_concurrently_with_cap(self):
+        rabbitmq = FakeRabbitMQ()
+        fan_out = BotCommandFanOut(rabbitmq, concurrency=8)
+        messages = [
+            bot_command_message(BotCommands.SEND_BREAK_MESSAGE, uid, 1) for uid in range(100)
+        ]
+
+        published = asyncio.run(fan_out.publish(messages))
+
+        assert published == 100
+        assert len(rabbitmq.published) == 100
+        assert rabbitmq.max_in_flight == 8
+        assert fan_out.last_batch_size == 100
+        # 100 messages, 8 at a time, 10ms each: far below a sequential second
+        assert fan_out.last_batch_latency < 0.5
+
+    def test_failures_do_not_stop_batch(self):
+        rabbitmq = FakeRabbitMQ(fail_for={3, 7})
+        fan_out = BotCommandFanOut(rabbitmq, concurrency=4)
+        messages = [
+            bot_command_message(BotCommands.SEND_BREAK_MESSAGE, uid, 1) for uid in range(10)
+        ]
+
+        published = asyncio.run(fan_out.publish(messages))
+
+        assert published == 8
+        assert (fan_out.published, fan_out.failed, fan_out.batches) == (8, 2, 1)
+
+    def test_empty_batch(self):
+        fan_out = BotCommandFanOut(FakeRabbitMQ())
+        assert asyncio.run(fan_out.publish([])) == 0
+        assert fan_out.batches == 0
+
+    def test_confirmed_batch_resends_unconfirmed(self):
+        rabbitmq = FakeRabbitMQ(fail_for={3, 7})
+        fan_out = BotCommandFanOut(rabbitmq)
+        messages = [
+            bot_command_message(BotCommands.INVITE_TO_MEETING, uid, 1, {}) for uid in range(10)
+        ]
+
+        published = asyncio.run(fan_out.publish(messages, confirm=True))
+
+        assert published == 10
+        assert [headers['user_id'] for _, headers in rabbitmq.confirmed[-2:]] == [3, 7]
+        assert (fan_out.retried, fan_out.failed) == (2, 0)
+
+    def test_confirmed_batch_gives_up_after_retries(self):
+        rabbitmq = FakeRabbitMQ(fail_for={3})
+        fan_out = BotCommandFanOut(rabbitmq, confirm_retries=0)
+        messages = [
+            bot_command_message(BotCommands.INVITE_TO_MEETING, uid, 1, {}) for uid in range(5)
+        ]
+
+        assert asyncio.run(fan_out.publish(messages, confirm=True)) == 4
+        assert fan_out.failed == 1
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import date
+from unittest.mock import MagicMock, AsyncMock
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from datemaker.intelligent_agent import IntelligentAgent, generate_event_groups_in_worker
+
+
+def make_users(size: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Synthetic confirmed users in the shape `generate_user_groups` passes to the agent.
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'user_id': np.arange(1, size + 1),
+        'birthday': [
+            date(int(year), int(month), int(day))
+            for year, month, day in zip(
+                rng.integers(1980, 2005, size),
+                rng.integers(1, 13, size),
+                rng.integers(1, 29, size),
+            )
+        ],
+        'sex': rng.choice(['M', 'F'], size),
+        'city': rng.choice(['Moscow', 'Saint Petersburg', 'Kazan', None], size),
+        'rating': rng.random(size),
+        'manual_score': rng.integers(1, 4, size),
+        'registered_on_dttm': pd.date_range('2024-01-01', periods=size, freq='min'),
+    })
+
+
+def reference_embedding(target: pd.DataFrame, additive: pd.DataFrame) -> pd.DataFrame:
+    """
+    Previous nested-loop implementation of the scoring matrix, kept as the oracle.
+    """
+    embedding: pd.DataFrame = target[['user_id']].copy(deep=True)
+    for additive_user in additive.user_id.values:
+        embedding[str(additive_user)] = 0
+        for target_user in target.user_id.values:
+            age_diff = abs(
+                target.loc[target.user_id == target_user].age.values[0] -
+                additive.loc[additive.user_id == additive_user].age.values[0]
+            )
+            score = 2 + 2 - age_diff
+            same_city = (
+                target.loc[target.user_id == target_user].city.values[0] ==
+                additive.loc[additive.user_id == additive_user].city.values[0]
+            )
+            score += 2 if same_city else 0
+            manual_diff = abs(
+                target.loc[target.user_id == target_user].manual_score.values[0] -
+                additive.loc[additive.user_id == additive_user].manual_score.values[0]
+            )
+            score += 6 - 2 * manual_diff
+            embedding.loc[embedding.user_id == target_user, str(additive_user)] = score
+
+    embedding['match'] = embedding[
+        [str(x) for x in additive.user_id.values.tolist()]
+    ].idxmax(axis=1)
+    return embedding
+
+
+@pytest.fixture
+def agent():
+    loop = asyncio.new_event_loop()
+    yield IntelligentAgent(custom_event_loop=loop, postgres_connector=MagicMock())
+    loop.close()
+
+
+class TestMatchmakingEmbedding:
+    @pytest.mark.parametrize('size,seed', [(2, 0), (15, 1), (40, 2), (61, 3)])
+    def test_matches_reference_implementation(self, agent, size, seed):
+        users = agent.prepare_data(make_users(size, seed))
+        target, additive = agent._split_into_genders(users)
+        agent._current_event_id = 0
+
+        expected = reference_embedding(target, additive)
+        result = agent._calculate_matchmaking_embedding(target, additive)
+
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    def test_scores(self):
+        scores = IntelligentAgent._calculate_scores(
+            target_age=np.array([25, 30]),
+            additive_age=np.array([25, 27, 35]),
+            target_city=np.array(['Moscow', 'Kazan'], dtype=object),
+            additive_city=np.array(['Moscow', 'Moscow', 'Kazan'], dtype=object),
+            target_manual_score=np.array([2, 1]),
+            additive_manual_score=np.array([2, 3, 1]),
+        )
+        np.testing.assert_array_equal(scores, [
+            [4 + 2 + 6, 2 + 2 + 4, -6 + 0 + 4],
+            [-1 + 0 + 4, 1 + 0 + 2, -1 + 2 + 6],
+        ])
+
+
+class TestClusterUsersForEvent:
+    def test_worker_entry_point_matches_agent(self, agent):
+        users = make_users(30, seed=5)
+        expected = agent.generate_event_groups(users.copy(), 1, 10)
+
+        groups = generate_event_groups_in_worker(
+            IntelligentAgent.to_columns(users), 1, 10, False, agent.assignment_solver.name
+        )
+
+        assert groups == expected
+        assert all(
+            isinstance(value, int)
+            for group in groups for pair in group for value in pair
+        )
+
+    def test_runs_in_process_pool(self):
+        postgres_connector = MagicMock()
+        postgres_connector.put_event_data = AsyncMock(side_effect=lambda data: len(list(data)))
+
+        async def cluster():
+            agent = IntelligentAgent(postgres_connector=postgres_connector)
+            return await agent.cluster_users_for_event(make_users(40, seed=6), 7, 10)
+
+        try:
+            inserted = asyncio.run(cluster())
+        finally:
+            IntelligentAgent.shutdown_executor()
+
+        postgres_connector.put_event_data.assert_awaited_once()
+        assert inserted > 0
+
+
+class TestPutEventDataIntoBd:
+    def test_all_groups_written_at_once(self, agent):
+        written = []
+
+        async def put_event_data(data):
+            written.extend(data)
+            return len(written)
+
+        agent.postgres_connector.put_event_data = put_event_data
+        groups = [[(0, 1, 2), (1, 3, 4)], [(0, 5, 6)]]
+
+        inserted = asyncio.run(agent.put_event_data_into_bd(3, groups))
+
+        assert inserted == 3
+        assert written == [(3, 0, 0, 1, 2), (3, 0, 1, 3, 4), (3, 1, 0, 5, 6)]
@@ -0,0 +1,161 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, AsyncMock
+
+import pytest
+
+from datemaker.registration_confirmation_runner import RegistrationConfirmationRunner
+from tests.test_intelligent_agent import make_users
+
+
+@pytest.fixture
+def runner():
+    loop = asyncio.new_event_loop()
+    postgres = MagicMock()
+    postgres.get_dating_events = AsyncMock(return_value=[{'users_limit': 10}])
+    runner = RegistrationConfirmationRunner(
+        event_id=3,
+        start_time=datetime.now() + timedelta(days=1),
+        meet_api_controller=MagicMock(),
+        postgres_controller=postgres,
+        rabbitmq_controller=MagicMock(),
+        custom_event_loop=loop,
+    )
+    runner.intelligence_agent.cluster_users_for_event = AsyncMock(return_value=0)
+    yield runner
+    loop.close()
+
+
+class TestGenerateUserGroups:
+    def test_single_query_feeds_clustering(self, runner):
+        users = make_users(6)
+        users['confirmed_on_dttm'] = users.registered_on_dttm
+        records = list(users[[
+            'user_id', 'birthday', 'sex', 'city', 'rating', 'manual_score',
+            'registered_on_dttm', 'confirmed_on_dttm',
+        ]].itertuples(index=False))
+        runner.postgres.get_confirmed_event_users = AsyncMock(return_value=records)
+
+        asyncio.run(runner.generate_user_groups())
+
+        runner.postgres.get_confirmed_event_users.assert_awaited_once_with(3)
+        df_users, event_id, users_limit = (
+            runner.intelligence_agent.cluster_users_for_event.await_args.args
+        )
+        assert (event_id, users_limit) == (3, 10)
+        assert df_users.user_id.tolist() == users.user_id.tolist()
+        assert df_users.city.tolist() == users.city.tolist()
+
+    def test_no_confirmed_users(self, runner):
+        runner.postgres.get_confirmed_event_users = AsyncMock(return_value=[])
+
+        asyncio.run(runner.generate_user_groups())
+
+        runner.intelligence_agent.cluster_users_for_event.assert_not_awaited()
+
+
+def notification(op, user_id, event_id=3, confirmed_on_dttm=None):
+    return json.dumps({
+        'op': op,
+        'event_id': event_id,
+        'user_id': user_id,
+        'confirmed_on_dttm': confirmed_on_dttm,
+    })
+
+
+class TestWaitForConfirmations:
+    @pytest.fixture
+    def listening_runner(self, runner):
+        postgres = runner.postgres
+        postgres.listeners = []
+        postgres.listen = AsyncMock(
+            side_effect=lambda channel, callback: postgres.listeners.append(callback)
+        )
+        postgres.unlisten = AsyncMock(
+            side_effect=lambda channel, callback: postgres.listeners.remove(callback)
+        )
+        rows = [
+            {'user_id': 1, 'confirmed_on_dttm': None, 'confirmation_event_sent': True},
+            {'user_id': 2, 'confirmed_on_dttm': None, 'confirmation_event_sent': False},
+        ]
+
+        def save_event_confirmation_sent(event_id, user_ids):
+            for row in rows:
+                if row['user_id'] in user_ids:
+                    row['confirmation_event_sent'] = True
+
+        postgres.get_event_registrations = AsyncMock(return_value=rows)
+        postgres.save_event_confirmation_sent = AsyncMock(
+            side_effect=save_event_confirmation_sent
+        )
+        runner.trigger_bot_command = AsyncMock()
+        runner.registration_end_dttm = datetime.now() + timedelta(seconds=0.3)
+        return runner
+
+    def test_applies_notifications_without_polling(self, listening_runner):
+        runner = listening_runner
+
+        async def run():
+            waiting = asyncio.ensure_future(runner.wait_for_confirmations())
+            await asyncio.sleep(0.05)
+            notify = runner.postgres.listeners[0]
+            notify(notification('INSERT', 5))
+            notify(notification('INSERT', 6))
+            notify(notification('INSERT', 7, event_id=4))
+            await asyncio.sleep(0.05)
+            notify(notification('UPDATE', 2, confirmed_on_dttm='2025-01-01T10:00:00'))
+            notify(notification('DELETE', 1))
+            await asyncio.sleep(0)
+            registrations = {uid: dict(user) for uid, user in runner.registrations.items()}
+            await waiting
+            return registrations
+
+        registrations = asyncio.run(run())
+
+        # at start and at the timeout
+        assert runner.reconciliations == 2
+        runner.postgres.get_event_registrations.assert_awaited_with(3)
+        sent = [
+            [user['user_id'] for user in call.args[1]]
+            for call in runner.trigger_bot_command.await_args_list
+        ]
+        assert sent == [[2], [5, 6]]
+        assert set(registrations) == {2, 5, 6}
+        assert registrations[2]['confirmed_on_dttm'] == '2025-01-01T10:00:00'
+        assert runner.postgres.listeners == []
+
+    def test_reconciles_periodically(self, listening_runner):
+        runner = listening_runner
+        runner.reconciliation_interval = timedelta(seconds=0.12)
+
+        asyncio.run(runner.wait_for_confirmations())
+
+        # at start, twice by interval and at the timeout
+        assert runner.reconciliations == 4
+        # user 2 gets the confirmation request only once
+        assert runner.trigger_bot_command.await_count == 1
+
+    def test_notification_while_sending_requests(self, listening_runner):
+        runner = listening_runner
+        sent = []
+
+        async def trigger_bot_command(command, users):
+            sent.append([user['user_id'] for user in users])
+            if sent[-1] == [5]:
+                # registered while the requests were being sent
+                runner.postgres.listeners[0](notification('INSERT', 8))
+            await asyncio.sleep(0.01)
+
+        runner.trigger_bot_command = AsyncMock(side_effect=trigger_bot_command)
+
+        async def run():
+            waiting = asyncio.ensure_future(runner.wait_for_confirmations())
+            await asyncio.sleep(0.05)
+            runner.postgres.listeners[0](notification('INSERT', 5))
+            await asyncio.sleep(0.1)
+            result = list(sent)
+            await waiting
+            return result
+
+        assert asyncio.run(run()) == [[2], [5], [8]]
@@ -0,0 +1,184 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock
+
+import pytest
+
+from chathub_connectors.envelope import Envelope
+from datemaker.service import DateMakerService
+
+
+class FakeIncomingMessage:
+    def __init__(self, body, reply_to=None, correlation_id=None, **headers):
+        self.body = body.encode()
+        self.headers = headers
+        self.routing_key = 'datemaker_dev'
+        self.reply_to = reply_to
+        self.correlation_id = correlation_id
+        self.processed = False
+
+    @asynccontextmanager
+    async def process(self, ignore_processed=False):
+        yield
+        self.processed = True
+
+
+@pytest.fixture
+def service():
+    service = DateMakerService(
+        meet_creds_file='creds.json',
+        meet_token_file='token.json',
+        message_broker_virtual_host='/',
+        message_broker_exchange='exchange',
+        message_broker_queue='datemaker_dev',
+        message_broker_username='guest',
+        message_broker_password='guest',
+        message_broker_host='localhost',
+        message_broker_port=5672,
+        postgres_host='localhost',
+        postgres_port=5432,
+        postgres_db='chathub',
+        postgres_user='datemaker',
+        postgres_password='',
+        command_concurrency=4,
+    )
+    postgres = service.async_pg_controller
+    postgres.get_user = AsyncMock(side_effect=lambda user_id: {'id': user_id})
+    registrations = set()
+
+    async def register_for_event(user, event_id):
+        await asyncio.sleep(0.01)
+        registered = (user['id'], event_id) not in registrations
+        registrations.add((user['id'], event_id))
+        return registered
+
+    async def cancel_registration(user, event_id):
+        await asyncio.sleep(0.01)
+        cancelled = (user['id'], event_id) in registrations
+        registrations.discard((user['id'], event_id))
+        return cancelled
+
+    postgres.register_for_event = AsyncMock(side_effect=register_for_event)
+    postgres.cancel_registration = AsyncMock(side_effect=cancel_registration)
+    service.async_rmq_controller.publish = AsyncMock()
+    service.async_rmq_controller.reply = AsyncMock()
+    return service
+
+
+def replies(service):
+    return [
+        (call.kwargs['headers']['user_id'], json.loads(call.args[0]))
+        for call in service.async_rmq_controller.publish.await_args_list
+    ]
+
+
+class TestCommands:
+    def test_commands_processed_concurrently_in_user_order(self, service):
+        # every user sends the same registration twice
+        messages = [
+            FakeIncomingMessage('register_event', user_id=uid, chat_id=uid, event_id=1)
+            for _ in range(2) for uid in range(8)
+        ]
+
+        async def consume():
+            for message in messages:
+                await service.command_processor(message)
+            await service.command_processor.join()
+
+        asyncio.run(consume())
+
+        assert all(message.processed for message in messages)
+        assert service.command_processor.max_in_flight == 4
+        for uid in range(8):
+            assert [result for user_id, result in replies(service) if user_id == uid] == [
+                {'user_registered': True},
+                {'user_registered': False},
+            ]
+
+    def test_error_reply(self, service):
+        service.async_pg_controller.get_user = AsyncMock(return_value=None)
+
+        asyncio.run(service.process_incoming_message(
+            FakeIncomingMessage('register_event', user_id=5, chat_id=5, event_id=1)
+        ))
+
+        assert replies(service) == [(5, {'success': False})]
+
+    def test_single_statement_operations(self, service):
+        postgres = service.async_pg_controller
+        postgres.get_event_registrations = AsyncMock()
+
+        async def run():
+            for command in ['register_event', 'register_event', 'cancel_registration',
+                            'cancel_registration']:
+                await service.process_incoming_message(
+                    FakeIncomingMessage(command, user_id=5, chat_id=5, event_id=1)
+                )
+
+        asyncio.run(run())
+
+        postgres.get_event_registrations.assert_not_awaited()
+        assert replies(service) == [
+            (5, {'user_registered': True}),
+            (5, {'user_registered': False}),
+            (5, {'registration_cancelled': True}),
+            (5, {'registration_cancelled': False}),
+        ]
+
+    def test_cancel_all_replied_once(self, service):
+        postgres = service.async_pg_controller
+        registrations = [[{'event_id': 1}, {'event_id': 2}], []]
+        postgres.get_event_registrations_for_user = AsyncMock(side_effect=registrations)
+
+        async def run():
+            await service.process_incoming_message(
+                FakeIncomingMessage('register_event', user_id=5, chat_id=5, event_id=2)
+            )
+            # all registrations, then none are left
+            for _ in range(2):
+                await service.process_incoming_message(
+                    FakeIncomingMessage('cancel_registration', user_id=5, chat_id=5, event_id=0)
+                )
+            await service.process_incoming_message(
+                FakeIncomingMessage('cancel_registration', user_id=5, chat_id=5)
+            )
+
+        asyncio.run(run())
+
+        assert postgres.cancel_registration.await_count == 2
+        assert replies(service) == [
+            (5, {'user_registered': True}),
+            (5, {'registration_cancelled': True}),
+            (5, {'registration_cancelled': False}),
+            (5, {'success': False}),
+        ]
+
+    def test_envelope_commands(self, service):
+        async def run():
+            for command in ['register_event', 'unknown_command']:
+                body, headers = Envelope(command, headers={'user_id': 5, 'chat_id': 5, 'event_id': 1}).encode()
+                message = FakeIncomingMessage('', user_id=5)
+                message.body, message.headers = body, headers
+                await service.process_incoming_message(message)
+
+        asyncio.run(run())
+
+        assert replies(service) == [(5, {'user_registered': True}), (5, {'success': False})]
+        # the envelope headers are not sent back
+        assert service.async_rmq_controller.publish.await_args_list[0].kwargs['headers'] == {
+            'user_id': 5, 'chat_id': 5, 'event_id': 1,
+        }
+
+    def test_reply_to_call(self, service):
+        asyncio.run(service.process_incoming_message(FakeIncomingMessage(
+            'register_event', reply_to='bot.replies', correlation_id='abc', user_id=5, chat_id=5, event_id=1
+        )))
+
+        service.async_rmq_controller.publish.assert_not_awaited()
+        service.async_rmq_controller.reply.assert_awaited_once_with(
+            json.dumps({'user_registered': True}),
+            reply_to='bot.replies',
+            correlation_id='abc',
+            headers={'user_id': 5, 'chat_id': 5, 'event_id': 1},
+        )
@@ -0,0 +1,239 @@
+import asyncio
+import itertools
+import time
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pandas as pd
+import pytest
+from google.api_core.exceptions import FailedPrecondition
+from google.apps.meet_v2 import Space
+from grpc import StatusCode
+from grpc.aio import AioRpcError, Metadata
+
+from datemaker.dating_event_runner import DateRunner
+from datemaker.space_pool import MeetSpacePool
+from tests.test_fan_out import FakeRabbitMQ
+
+
+class FakeMeetApi:
+    """
+    Local Meet client: creating a public space takes two round trips of
+    `latency` seconds, like create_space + make_space_public.
+    """
+
+    def __init__(self, latency=0.01, fail_creates=0):
+        self.latency = latency
+        self.fail_creates = fail_creates
+        self.names = itertools.count(1)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.created = []
+        self.active_calls = set()
+        self.ended = []
+        # spaces whose call does not end in time
+        self.hanging = set()
+        # rpc errors of ending the call by space
+        self.end_errors = {}
+        self.ending = 0
+        self.max_ending = 0
+
+    async def create_public_space(self) -> Space:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(2 * self.latency)
+        finally:
+            self.in_flight -= 1
+        if self.fail_creates:
+            self.fail_creates -= 1
+            raise ConnectionError('meet is down')
+        number = next(self.names)
+        space = Space(name=f'spaces/{number}', meeting_uri=f'https://meet.google.com/{number}')
+        self.created.append(space)
+        return space
+
+    def join(self, space: Space):
+        self.active_calls.add(space.name)
+
+    async def end_active_call(self, space: Space):
+        self.ending += 1
+        self.max_ending = max(self.max_ending, self.ending)
+        try:
+            await asyncio.sleep(60 if space.name in self.hanging else self.latency)
+        finally:
+            self.ending -= 1
+        if space.name in self.end_errors:
+            raise AioRpcError(self.end_errors[space.name], Metadata(), Metadata())
+        if space.name not in self.active_calls:
+            raise FailedPrecondition('no active conference')
+        self.active_calls.discard(space.name)
+        self.ended.append(space.name)
+
+
+class TestMeetSpacePool:
+    def test_prewarm_creates_concurrently(self):
+        meet = FakeMeetApi()
+        pool = MeetSpacePool(meet, create_concurrency=5)
+
+        async def run():
+            created = await asyncio.gather(pool.prewarm(12), pool.prewarm(12))
+            assert sorted(created) == [0, 12]
+            assert await pool.prewarm(10) == 0
+
+        asyncio.run(run())
+
+        assert meet.max_in_flight == 5
+        assert pool.idle == 12
+        assert pool.stats['created'] == 12
+        assert pool.stats['avg_create_latency'] > 0
+
+    def test_spaces_recycled(self):
+        meet = FakeMeetApi()
+        pool = MeetSpacePool(meet)
+
+        async def run():
+            await pool.prewarm(2)
+            first = await pool.acquire_many(3)
+            meet.join(first[0])
+            await pool.release_many(first)
+            second = await pool.acquire_many(3)
+            return first, second
+
+        first, second = asyncio.run(run())
+
+        assert len(meet.created) == 3
+        assert {space.name for space in second} == {space.name for space in first}
+        assert meet.ended == [first[0].name]
+        assert (pool.hits, pool.misses, pool.recycled, pool.in_use) == (5, 1, 3, 3)
+
+    def test_max_idle_and_uses(self):
+        meet = FakeMeetApi()
+        pool = MeetSpacePool(meet, max_idle=1, max_uses=2)
+
+        async def run():
+            spaces = await pool.acquire_many(2)
+            await pool.release_many(spaces)
+            assert (pool.idle, pool.dropped) == (1, 1)
+            for _ in range(2):
+                space = await pool.acquire()
+                await pool.release(space)
+
+        asyncio.run(run())
+
+        # the kept space was used for the second time and dropped, then a new one was created
+        assert (pool.idle, pool.dropped, len(meet.created)) == (1, 2, 3)
+
+    def test_used_spaces_stay_in_their_event(self):
+        meet = FakeMeetApi()
+        pool = MeetSpacePool(meet)
+
+        async def run():
+            await pool.prewarm(3)
+            first = await pool.acquire_many(2, 'first')
+            await pool.release_many(first, 'first')
+            # the other event gets the unused space and a new one
+            second = await pool.acquire_many(2, 'second')
+            again = await pool.acquire_many(2, 'first')
+            await pool.release_many(second, 'second')
+            await pool.release_many(again, 'first')
+            assert pool.drain('first') == 2
+            return first, second, again
+
+        first, second, again = asyncio.run(run())
+
+        assert not {space.name for space in first} & {space.name for space in second}
+        assert {space.name for space in again} == {space.name for space in first}
+        assert len(meet.created) == 4
+        assert (pool.idle, pool.dropped) == (2, 2)
+
+    def test_calls_ended_concurrently_with_timeout(self):
+        meet = FakeMeetApi(latency=0.05)
+        pool = MeetSpacePool(meet, end_call_concurrency=4, end_call_timeout=0.2)
+
+        async def run():
+            spaces = await pool.acquire_many(10)
+            for space in spaces[:8]:
+                meet.join(space)
+            meet.hanging.add(spaces[0].name)
+            start = time.perf_counter()
+            await pool.release_many(spaces)
+            return time.perf_counter() - start
+
+        elapsed = asyncio.run(run())
+
+        # 10 calls of 50ms, 4 at once, one waits for the 200ms timeout
+        assert elapsed < 0.4
+        assert meet.max_ending == 4
+        assert (pool.calls_ended, pool.calls_not_started, pool.end_call_timeouts) == (7, 2, 1)
+        # the call that did not end may still go on, its space is not reused
+        assert (pool.idle, pool.dropped) == (9, 1)
+
+    def test_space_dropped_on_rpc_error(self):
+        meet = FakeMeetApi()
+        pool = MeetSpacePool(meet)
+
+        async def run():
+            spaces = await pool.acquire_many(3)
+            for space in spaces:
+                meet.join(space)
+            meet.end_errors[spaces[0].name] = StatusCode.UNAVAILABLE
+            meet.end_errors[spaces[1].name] = StatusCode.FAILED_PRECONDITION
+            await pool.release_many(spaces)
+
+        asyncio.run(run())
+
+        # an unavailable api may have left the call going on
+        assert (pool.calls_ended, pool.calls_not_started, pool.end_call_failed) == (1, 1, 1)
+        assert (pool.idle, pool.dropped) == (2, 1)
+
+    def test_failed_create_returns_acquired_spaces(self):
+        meet = FakeMeetApi()
+        pool = MeetSpacePool(meet)
+
+        async def run():
+            await pool.prewarm(1)
+            meet.fail_creates = 1
+            with pytest.raises(ConnectionError):
+                await pool.acquire_many(2)
+
+        asyncio.run(run())
+
+        assert (pool.idle, pool.in_use, pool.create_failed) == (1, 0, 1)
+
+
+class TestDateRunnerSpaces:
+    def test_rounds_reuse_prewarmed_spaces(self):
+        meet = FakeMeetApi()
+        pool = MeetSpacePool(meet)
+        rabbitmq = FakeRabbitMQ()
+
+        async def run():
+            runner = DateRunner(
+                7, datetime.now(), meet, AsyncMock(), rabbitmq, space_pool=pool,
+            )
+            runner.intelligence_agent = MagicMock()
+            # two groups, two rounds: at most 2 pairs at once
+            runner.event_data = pd.DataFrame(
+                [[0, 0, 1, 2], [1, 0, 3, 4], [0, 1, 1, 4], [1, 1, 3, 2]],
+                columns=['group_no', 'turn_no', 'user_1_id', 'user_2_id'],
+            )
+            runner.user_ids_in_event = {1, 2, 3, 4}
+            await asyncio.gather(runner.create_spaces_for_event(), runner.create_spaces_for_event())
+            for round_num in range(2):
+                # both group state machines run the round
+                await asyncio.gather(runner.run_dating_round(round_num), runner.run_dating_round(round_num))
+                await asyncio.gather(runner.run_dating_break(round_num), runner.run_dating_break(round_num))
+            return runner
+
+        runner = asyncio.run(run())
+
+        assert 0 < runner.last_break_transition <= runner.max_break_transition
+        assert len(meet.created) == 2
+        assert pool.stats['hits'] == 4 and pool.stats['misses'] == 0
+        assert runner.round_spaces == {}
+        invited = {
+            message for message, headers in rabbitmq.confirmed
+            if headers['command'] == 'invite_to_meeting'
+        }
+        assert len(invited) == 2
@@ -0,0 +1,19 @@
+-- migrate:up
+CREATE OR REPLACE FUNCTION public.notify_dating_events_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify(
+        'dating_events_changed',
+        CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER dating_events_changed
+AFTER INSERT OR DELETE OR UPDATE OF start_dttm, state_id ON public.dating_events
+FOR EACH ROW EXECUTE FUNCTION public.notify_dating_events_changed();
+
+-- migrate:down
+DROP TRIGGER IF EXISTS dating_events_changed ON public.dating_events;
+DROP FUNCTION IF EXISTS public.notify_dating_events_changed();
@@ -0,0 +1,27 @@
+-- migrate:up
+CREATE OR REPLACE FUNCTION public.notify_dating_registrations_changed()
+RETURNS TRIGGER AS $$
+DECLARE
+    registration RECORD;
+BEGIN
+    registration := CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+    PERFORM pg_notify(
+        'dating_registrations_changed',
+        json_build_object(
+            'op', TG_OP,
+            'event_id', registration.event_id,
+            'user_id', registration.user_id,
+            'confirmed_on_dttm', registration.confirmed_on_dttm
+        )::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER dating_registrations_changed
+AFTER INSERT OR DELETE OR UPDATE OF confirmed_on_dttm ON public.dating_registrations
+FOR EACH ROW EXECUTE FUNCTION public.notify_dating_registrations_changed();
+
+-- migrate:down
+DROP TRIGGER IF EXISTS dating_registrations_changed ON public.dating_registrations;
+DROP FUNCTION IF EXISTS public.notify_dating_registrations_changed();
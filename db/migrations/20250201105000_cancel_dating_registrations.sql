@@ -0,0 +1,6 @@
+-- migrate:up
+-- datemaker cancels registrations by deleting them
+GRANT DELETE ON public.dating_registrations TO service_datemaker;
+
+-- migrate:down
+REVOKE DELETE ON public.dating_registrations FROM service_datemaker;
@@ -0,0 +1,28 @@
+-- migrate:up
+-- keep one registration per user and event, a confirmed one if there is any
+DELETE FROM public.dating_registrations
+WHERE ctid IN (
+    SELECT ctid
+    FROM (
+        SELECT
+            ctid,
+            ROW_NUMBER() OVER (
+                PARTITION BY event_id, user_id
+                ORDER BY confirmed_on_dttm NULLS LAST, registered_on_dttm
+            ) AS registration_no
+        FROM public.dating_registrations
+    ) AS registrations
+    WHERE registration_no > 1
+);
+
+ALTER TABLE public.dating_registrations
+ADD CONSTRAINT dating_registrations_event_user_key UNIQUE (event_id, user_id);
+
+-- by event is served by the unique key, by user (registrations list, cancel all) by this one
+CREATE INDEX IF NOT EXISTS dating_registrations_user_event_idx
+ON public.dating_registrations (user_id, event_id);
+
+-- migrate:down
+DROP INDEX IF EXISTS public.dating_registrations_user_event_idx;
+ALTER TABLE public.dating_registrations
+DROP CONSTRAINT IF EXISTS dating_registrations_event_user_key;
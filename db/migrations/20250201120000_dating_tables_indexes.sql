@@ -0,0 +1,33 @@
+-- migrate:up
+-- dating_registrations is indexed by 20250201110000_unique_dating_registrations
+
+-- upcoming events
+CREATE INDEX IF NOT EXISTS dating_events_start_dttm_idx
+ON public.dating_events (start_dttm);
+
+-- event pairs and groups
+CREATE INDEX IF NOT EXISTS dating_event_groups_event_group_turn_idx
+ON public.dating_event_groups (event_id, group_no, turn_no);
+
+-- latest images of a user
+CREATE INDEX IF NOT EXISTS images_owner_upload_dttm_idx
+ON public.images (owner, upload_dttm DESC);
+
+-- matches and mismatches views join reactions by source and target users
+CREATE INDEX IF NOT EXISTS likes_source_target_event_idx
+ON public.likes (source_user_id, target_user_id, event_id);
+CREATE INDEX IF NOT EXISTS likes_target_event_idx
+ON public.likes (target_user_id, event_id);
+CREATE INDEX IF NOT EXISTS dislikes_source_target_event_idx
+ON public.dislikes (source_user_id, target_user_id, event_id);
+CREATE INDEX IF NOT EXISTS dislikes_target_event_idx
+ON public.dislikes (target_user_id, event_id);
+
+-- migrate:down
+DROP INDEX IF EXISTS public.dislikes_target_event_idx;
+DROP INDEX IF EXISTS public.dislikes_source_target_event_idx;
+DROP INDEX IF EXISTS public.likes_target_event_idx;
+DROP INDEX IF EXISTS public.likes_source_target_event_idx;
+DROP INDEX IF EXISTS public.images_owner_upload_dttm_idx;
+DROP INDEX IF EXISTS public.dating_event_groups_event_group_turn_idx;
+DROP INDEX IF EXISTS public.dating_events_start_dttm_idx;
@@ -0,0 +1,25 @@
+-- migrate:up
+-- mutual likes of finished events, written once by datemaker when an event finishes
+-- instead of recomputing the matches view for every participant
+CREATE TABLE public.event_matches
+(
+    event_id BIGINT NOT NULL,
+    user_1_id BIGINT NOT NULL,
+    user_2_id BIGINT NOT NULL,
+    PRIMARY KEY (event_id, user_1_id, user_2_id)
+);
+
+GRANT INSERT, SELECT, DELETE ON public.event_matches TO developer, service_datemaker;
+GRANT SELECT ON public.event_matches TO service_bot;
+
+-- likes of an event, to compute its matches
+CREATE INDEX IF NOT EXISTS likes_event_source_target_idx
+ON public.likes (event_id, source_user_id, target_user_id);
+
+INSERT INTO public.event_matches (event_id, user_1_id, user_2_id)
+SELECT DISTINCT event_id, user_1_id, user_2_id
+FROM public.matches;
+
+-- migrate:down
+DROP INDEX IF EXISTS public.likes_event_source_target_idx;
+DROP TABLE public.event_matches;